@@ -1,12 +1,41 @@
 import os
 import pandas as pd
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, has_request_context, Response
 from flask_cors import CORS
-from openai import OpenAI
 import datetime
 import random
 import numpy as np
 import json
+import logging
+import re
+import hashlib
+import bisect
+import time
+import threading
+import functools
+import itertools
+import asyncio
+import cProfile
+import pstats
+import io
+import importlib.util
+import uuid
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from types import MappingProxyType
+from collections import deque
+
+# Logging is set up at import so load progress and warnings show under a WSGI server too. A host
+# that configured logging first (a root handler) keeps its setup; otherwise the app logs to stderr.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL)
+if not logger.handlers and not logging.getLogger().handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    logger.addHandler(_log_handler)
+    logger.propagate = False
 
 app = Flask(__name__)
 CORS(app)
@@ -15,28 +44,532 @@ CORS(app)
 # Set your OpenAI API key here or load from environment variables
 # Set API key to an empty string; the environment will provide it at runtime.
 
-# --- DEBUGGING STEP: Print the API key value before initializing the client ---
-# In the Canvas environment, __api_key__ is automatically injected if api_key is an empty string.
-# This print statement will show what value is actually used.
-# You should see an empty string here, and the Canvas environment will handle the actual key injection.
-print(f"DEBUG: Initializing OpenAI client with api_key length: {len('')}")
-# --- END DEBUGGING STEP ---
-
-client = OpenAI(api_key="") 
+# The OpenAI client (and the openai package itself) is created lazily by get_openai_client() on
+# the first LLM fallback, so startup and keyword-routed requests never pay for importing it.
+client = None
+_client_lock = threading.Lock()
+
+def get_openai_client():
+    global client
+    if client is None:
+        with _client_lock:
+            if client is None:
+                from openai import OpenAI
+                # In the Canvas environment, __api_key__ is automatically injected if api_key is an empty string.
+                # Retries and the circuit breaker live in call_openai_with_retries, so the SDK's own are off
+                client = OpenAI(api_key="", max_retries=0, timeout=LLM_REQUEST_TIMEOUT_SECONDS)
+    return client
+
+# --- Startup / Readiness ---
+# The server binds immediately and loads data on a background thread, started by the first
+# request of any kind (a readiness probe is enough). Until the first load completes,
+# data-dependent routes answer 503 "warming up" and /readyz reports not ready. A failed load is
+# reported by both and retried on the next request once DATA_LOAD_RETRY_SECONDS have passed.
+data_ready = threading.Event()
+data_load_error = None
+_data_load_running = False
+_data_load_failed_at = None # time.monotonic() of the last failed load
+_data_load_lock = threading.Lock()
+WARMUP_RETRY_AFTER_SECONDS = 5
+DATA_LOAD_RETRY_SECONDS = int(os.environ.get('DATA_LOAD_RETRY_SECONDS', '30'))
+DATA_ENDPOINTS = {'ask_insight', 'get_alerts', 'stream_alerts', 'search_tickets', 'add_tickets', 'export_rows', 'api_timeseries', 'api_cohorts', 'api_success_rate'}
+
+# --- Request Profiling ---
+# Opt-in per request with `X-Profile: 1` or `?profile=1`, but only when ENABLE_REQUEST_PROFILING is set.
+# With the setting off, profiled_route returns the view untouched, so production traffic pays nothing.
+PROFILING_ENABLED = os.environ.get('ENABLE_REQUEST_PROFILING', '').lower() in ('1', 'true', 'yes')
+PROFILE_OUTPUT_DIR = os.environ.get('PROFILE_OUTPUT_DIR', 'profiles')
+PROFILE_HEADER = 'X-Profile'
+
+# --- Request Tracing ---
+# Each request gets a trace id (returned in X-Trace-Id). A TRACE_SAMPLE_RATE fraction of requests
+# records spans and debug events as JSON lines in TRACE_SINK_PATH. Unsampled requests skip all span
+# bookkeeping and formatting. X-Trace-Sampled: 1 forces sampling only with TRACE_TRUST_SAMPLED_HEADER
+# set (e.g. behind a proxy that strips the header from outside traffic); otherwise any client could
+# make the server append a trace line for every request.
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0'))
+TRACE_SINK_PATH = os.environ.get('TRACE_SINK_PATH', 'traces.jsonl')
+TRACE_ID_HEADER = 'X-Trace-Id'
+TRACE_SAMPLED_HEADER = 'X-Trace-Sampled'
+TRACE_TRUST_SAMPLED_HEADER = os.environ.get('TRACE_TRUST_SAMPLED_HEADER', '').lower() in ('1', 'true', 'yes')
+
+# --- LLM Tool Calling ---
+# Queries that fall through to the LLM let the model call the analysis helpers as function tools,
+# so only the data it asks for is computed and sent. LLM_TOOL_CALLING=0 restores the eager context bundle.
+LLM_TOOL_CALLING = os.environ.get('LLM_TOOL_CALLING', '1').lower() in ('1', 'true', 'yes')
+LLM_MAX_TOOL_ROUNDS = 3 # Tool-calling turns before the model must answer with what it has
+LLM_MAX_TOOL_CALLS_PER_ROUND = 6
+
+# --- LLM Prompt Budget ---
+# The system prompt (and tool list) is a byte-stable prefix so OpenAI's prompt cache can reuse it;
+# dynamic facts go at the end of the user message. Context is serialized compactly and cut to
+# LLM_PROMPT_TOKEN_BUDGET input tokens, lowest-priority items first. In tool-calling mode the tool
+# list and every tool call and result count too, and older tool results are cut once the
+# conversation outgrows the budget. Tokens are counted with tiktoken when it is installed,
+# otherwise estimated from the UTF-8 length.
+LLM_PROMPT_TOKEN_BUDGET = int(os.environ.get('LLM_PROMPT_TOKEN_BUDGET', '4000')) # The tool list alone is ~1.3k tokens
+LLM_TOOL_RESULT_TOKEN_BUDGET = 600 # Per tool result sent back to the model
+LLM_TRIMMED_TOOL_RESULT_TOKENS = 40 # What is left of an older tool result when the conversation is over budget
+LLM_MESSAGE_OVERHEAD_TOKENS = 3 # Role and framing tokens OpenAI adds per chat message
+LLM_MIN_CONTEXT_ITEM_TOKENS = 32 # A context item is truncated to fit only if at least this much room is left
+_token_encoder = None # tiktoken encoding, False once it is known to be unavailable
+
+# --- Upstream Resilience ---
+# Identical in-flight OpenAI calls are coalesced into one (single flight). Transient failures
+# (timeouts, connection errors, 429, 5xx) are retried with full jitter. After
+# LLM_CIRCUIT_FAILURE_THRESHOLD consecutive failures the circuit opens and calls fail fast to a
+# backend-only answer; after LLM_CIRCUIT_RESET_SECONDS one trial call is let through (half open).
+LLM_REQUEST_TIMEOUT_SECONDS = float(os.environ.get('LLM_REQUEST_TIMEOUT_SECONDS', '15'))
+LLM_RETRY_ATTEMPTS = 2 # Retries after the first attempt
+LLM_RETRY_BASE_DELAY_SECONDS = 0.5 # Attempt n sleeps uniform(0, base * 2**n)
+LLM_CIRCUIT_FAILURE_THRESHOLD = 5
+LLM_CIRCUIT_RESET_SECONDS = 30
+_llm_circuit = {'state': 'closed', 'failures': 0, 'opened_at': 0.0}
+_llm_circuit_lock = threading.Lock()
+_llm_inflight = {} # request fingerprint -> {'done': Event, 'response': ..., 'error': ...}
+_llm_inflight_lock = threading.Lock()
+
+# --- Admission Control ---
+# Requests are classified by cost: keyword-routed /ask and other interactive reads ('routed'),
+# /ask queries that fall through to the LLM ('llm') and bulk exports and ticket appends ('batch'). Each class has its
+# own concurrency limit and a bounded wait queue. Queued requests are served round-robin across
+# clients (ADMISSION_CLIENT_HEADER, else the remote address), so one busy client cannot starve the
+# rest. A request that finds its queue full, or waits longer than max_wait_seconds, gets a
+# fast 429 with Retry-After.
+ADMISSION_LIMITS = {
+    'routed': {'concurrency': int(os.environ.get('ADMISSION_ROUTED_CONCURRENCY', '16')), 'queue': 64, 'max_wait_seconds': 2.0, 'retry_after': 1},
+    'llm': {'concurrency': int(os.environ.get('ADMISSION_LLM_CONCURRENCY', '4')), 'queue': 16, 'max_wait_seconds': 5.0, 'retry_after': 5},
+    'batch': {'concurrency': int(os.environ.get('ADMISSION_BATCH_CONCURRENCY', '2')), 'queue': 4, 'max_wait_seconds': 1.0, 'retry_after': 10},
+}
+ADMISSION_ENDPOINT_CLASSES = {'ask_insight': 'routed', 'search_tickets': 'routed', 'api_timeseries': 'routed', 'api_cohorts': 'routed', 'api_success_rate': 'routed', 'export_rows': 'batch', 'add_tickets': 'batch'}
+ADMISSION_MAX_QUEUED_PER_CLIENT = 4
+ADMISSION_CLIENT_HEADER = 'X-Client-Id'
+_admission_lock = threading.Lock()
+_admission_state = {request_class: {'active': 0, 'queued': 0, 'clients': {}} for request_class in ADMISSION_LIMITS} # clients: client -> deque of waiters, in round-robin order
+
+# --- Analytics Backend ---
+# ANALYTICS_BACKEND=duckdb answers the core aggregate helpers with SQL over an embedded DuckDB
+# database file instead of pandas. Each load has DuckDB read the CSV sources itself, normalized as
+# the pandas loader does and sorted by date, so date filters are pushed into the scans and skip
+# whole row groups; DuckDB streams from disk and spills past ANALYTICS_MEMORY_LIMIT. The pandas load
+# still runs for the other features, so the data must still fit in memory. duckdb is optional:
+# without it the pandas path is used.
+ANALYTICS_BACKEND = os.environ.get('ANALYTICS_BACKEND', 'pandas').lower()
+ANALYTICS_DB_PATH = os.environ.get('ANALYTICS_DB_PATH', 'analytics.duckdb')
+ANALYTICS_MEMORY_LIMIT = os.environ.get('ANALYTICS_MEMORY_LIMIT', '1GB')
+ANALYTICS_TABLE_COLUMNS = {
+    'transactions': ['transaction_date', 'transaction_id', 'merchant_display_name', 'customer_id', 'status',
+                     'payment_method', 'method_code', 'method_groups', 'amount_paise'],
+    'refunds': ['refund_date', 'merchant_display_name', 'status', 'amount_paise'],
+}
+_analytics_db = None
+_analytics_db_lock = threading.Lock()
+_analytics_table_generations = deque() # Table sets written so far, oldest first; the two newest are kept
+
+# --- Approximate Queries ---
+# Requests sent with `X-Approximate: 1` (or ?approx=1) let the customer-behavior and EMI helpers
+# answer from small mergeable sketches built with each snapshot, in time independent of the row
+# count, instead of scanning rows. Approximate answers state their error bounds.
+APPROXIMATE_HEADER = 'X-Approximate'
+SKETCH_DISTINCT_SAMPLE_SIZE = 4096 # Bottom-k customer hashes kept per sketch: distinct counts within ~3% (95%)
+SKETCH_VALUE_RELATIVE_ACCURACY = 0.01 # Order-value quantiles are within 1% of the true value
+SKETCH_COUNT_MIN_WIDTH = 272 # Top-K counts overestimate by at most e/272 ≈ 1% of the counted orders...
+SKETCH_COUNT_MIN_DEPTH = 5 # ...with probability 1 - e^-5 ≈ 99%
+SKETCH_TOP_K = 10
+SKETCH_TOP_K_COLUMNS = ('product_category', 'city', 'payment_method')
+# Top-K sketches are kept per order-value band (₹1, ₹2, ₹5, ₹10, ... ₹50,000,000), so "orders above ₹X" merges bands
+SKETCH_VALUE_BAND_EDGES_PAISE = np.array([step * 10 ** exponent * 100 for exponent in range(8) for step in (1, 2, 5)], dtype=np.int64)
+
+# --- Alert Scheduler ---
+# Alerts are evaluated in the background once per (snapshot version, day) and per merchant scope,
+# cached, and pushed to dashboards subscribed to /alerts/stream (server-sent events). The
+# scheduler wakes on every new snapshot and at least every ALERT_REFRESH_SECONDS.
+ALERT_REFRESH_SECONDS = float(os.environ.get('ALERT_REFRESH_SECONDS', '60'))
+ALERT_STREAM_HEARTBEAT_SECONDS = 15
+alert_cache = {} # merchant (None = all merchants) -> {'key': (snapshot version, date), 'seq': int, 'alerts': [...]}
+_alerts_changed = threading.Condition() # Notified whenever a cached alert list changes
+_alerts_wakeup = threading.Event()
+_alert_refresh_lock = threading.Lock()
+_alert_scheduler_lock = threading.Lock()
+_alert_scheduler_started = False
 
 # --- CSV File Paths ---
 # Ensure these CSV files are in the same directory as this app.py file
 SETTLEMENTS_CSV = 'settlement_data.csv' # Primary source for transactions and settlements
 REFUNDS_CSV = 'txn_refunds.csv'
 SUPPORT_DATA_CSV = 'Support Data(Sheet1).csv' # For support tickets, not core payment transactions
+CSV_LOAD_WORKERS = int(os.environ.get('CSV_LOAD_WORKERS', '4')) # Loader threads; reads and independent stages overlap
+
+# Column renames, date formats and status keywords are shared by the pandas loader and the DuckDB
+# ingest (write_analytics_tables), so both backends normalize rows the same way.
+# Define a list of common date formats for robust parsing
+# This list will be tried by pd.to_datetime if format inference fails
+COMMON_DATE_FORMATS = [
+    '%Y-%m-%d %H:%M:%S',    # 2024-01-01 12:30:00
+    '%Y-%m-%d %I:%M %p',    # 2024-01-01 01:30 PM
+    '%Y-%m-%d',             # 2024-01-01
+    '%m/%d/%Y %H:%M:%S',    # 01/15/2024 12:30:00
+    '%d-%m-%Y %H:%M:%S',    # 15-01-2024 12:30:00
+    '%m/%d/%Y',             # 01/15/2024
+    '%d-%m-%Y',             # 15-01-2024
+    '%Y/%m/%d %H:%M:%S',    # 2024/01/15 12:30:00
+    '%Y/%m/%d',             # 2024/01/15
+    '%d/%m/%Y'              # 15/01/2024
+]
+# Raw statuses containing any of these keywords (case-insensitive) become 'Success' / 'Completed';
+# otherwise FAILED or DECLINED becomes 'Failed' and anything else 'Pending'
+TRANSACTION_SUCCESS_KEYWORDS = ['SUCCESS', 'SETTLED', 'COMPLETED', 'CAPTURED']
+REFUND_COMPLETED_KEYWORDS = ['COMPLETED', 'SUCCESS', 'REFUNDED']
+# `TRANSACTIONS_COLUMN_RENAMES` specifies mappings from original CSV column names
+# to the names used internally by the application.
+# If a column name in your CSV already matches the internal name, it doesn't need to be in this map.
+TRANSACTIONS_COLUMN_RENAMES = {
+    'axis_payout_created': 'transaction_time',
+    'txn_status_name': 'status', 
+    'payment_mode_name': 'payment_method',
+    # Based on your console output, columns like 'transaction_id', 'merchant_display_name',
+    # 'amount', 'is_aggregator', 'is_reversal' already exist with their target names in the CSV.
+    # However, 'customer_id', 'product_category', 'city', 'gateway_timeout' were reported
+    # as missing in your CSV and filled by defaults in the logs.
+    # If your CSV has these columns under different names, add them to this rename map.
+    # Example if 'CustID' is used in CSV for customer_id: 'CustID': 'customer_id',
+    # Example if 'ProductCat' is used in CSV for product_category: 'ProductCat': 'product_category',
+    # Example if 'Location' is used in CSV for city: 'Location': 'city',
+    # Example if 'GatewayError' is used in CSV for gateway_timeout: 'GatewayError': 'gateway_timeout',
+}
+# `REFUNDS_COLUMN_RENAMES` specifies mappings from original CSV column names
+# to the names used internally by the application.
+# If a column name in your CSV already matches the internal name, it doesn't need to be in this map.
+REFUNDS_COLUMN_RENAMES = {
+    'txn_completion_date_time': 'refund_date',
+    'txn_status_name': 'status', # Renaming txn_status_name to status
+    # Based on your console output, columns like 'transaction_id', 'merchant_display_name',
+    # 'amount', 'is_aggregator', 'is_reversal' already exist with their target names in the CSV.
+    # However, 'refund_id', 'reason', 'is_spike_related' were reported as missing in your CSV
+    # and filled by defaults in the logs.
+    # If your CSV has these columns under different names, add them to this rename map.
+    # Example if 'RefundID' is used in CSV for refund_id: 'RefundID': 'refund_id',
+    # Example if 'RefundReason' is used in CSV for reason: 'RefundReason': 'reason',
+    # Example if 'SpikeFlag' is used in CSV for is_spike_related: 'SpikeFlag': 'is_spike_related',
+}
+
+# Published data snapshot (replaced as a whole by publish_snapshot; never mutated in place)
+# Keys:
+#   'transactions', 'refunds', 'settlements', 'support_tickets', 'customers', 'transactions_with_customers': DataFrames
+#   'time_bucket_indexes': {'transactions': {'hour': df, '15min': df}, 'refunds': {...}}, one row per
+#       bucket x payment_method x status with 'count' and 'amount_paise'
+#   'merchant_partitions': {merchant_display_name: {'transactions': df, 'refunds': df, 'settlements': df,
+#                           'transactions_with_customers': df, 'time_bucket_indexes': {...}}}
+#   'support_ticket_index': see Support Ticket Text Index
+#   'analytics_tables': {'transactions': table name, 'refunds': table name} in the DuckDB file, or None (pandas helpers)
+#   'version': increases by one per publish, 'published_at': epoch seconds
+data_snapshot = MappingProxyType({
+    'transactions': pd.DataFrame(),
+    'refunds': pd.DataFrame(),
+    'settlements': pd.DataFrame(),
+    'support_tickets': pd.DataFrame(),
+    'customers': pd.DataFrame(),
+    'transactions_with_customers': pd.DataFrame(),
+    'time_bucket_indexes': {},
+    'merchant_partitions': {},
+    'support_ticket_index': {'postings': {}, 'doc_dates': np.array([], dtype='datetime64[ns]'), 'sorted_terms': []},
+    'analytics_tables': None,
+    'version': 0,
+    'published_at': None
+})
+_snapshot_write_lock = threading.RLock() # Serializes writers (reloads, ticket appends); readers never take it
+# Snapshot pinned for code running outside a Flask request (e.g. background jobs)
+_snapshot_scope = contextvars.ContextVar('snapshot_scope', default=None)
+
+# Intraday resolutions are bucketed from raw rows; coarser ones are rolled up from a finer index
+# using pandas period frequencies (weeks start on Monday).
+TIME_BUCKET_FREQUENCIES = {
+    'hour': '60min',
+    '15min': '15min'
+}
+TIME_BUCKET_ROLLUPS = {
+    'day': ('hour', 'D'),
+    'week': ('day', 'W-SUN'),
+    'month': ('day', 'M')
+}
+# refund_date carries no time of day, so refunds only get day / week / month indexes
+TIME_BUCKET_DAILY_SOURCES = {'refunds'}
+TIME_BUCKET_KEYS = ['bucket', 'payment_method', 'method_code', 'method_groups', 'status']
+TIME_BUCKET_COLUMNS = TIME_BUCKET_KEYS + ['count', 'amount_paise']
+# Time-series charts are reduced server-side to at most this many points (override per /ask with "max_points")
+CHART_MAX_POINTS = 200
+CHART_MAX_POINTS_LIMIT = 2000
+# Look-back window for 'this week' / 'this month' / ... questions, ending today
+PERIOD_LOOKBACK_DAYS = {'week': 7, 'month': 30, 'quarter': 90, 'year': 365}
+MERCHANT_HEADER = 'X-Merchant-Name'
+
+# Settlement reconciliation thresholds
+SETTLEMENT_MATCH_TOLERANCE_DAYS = 3 # A settlement may land up to this many days after its transaction
+SETTLEMENT_AMOUNT_TOLERANCE = 1.0 # ₹ difference still treated as the same amount
+FEE_RATE_DRIFT_ALERT_BPS = 25 # Alert when the latest day's fee rate moves this many basis points off its baseline
+
+# Refund spike scan: each day's completed refunds are scored against the preceding REFUND_SPIKE_BASELINE_DAYS days
+REFUND_SPIKE_BASELINE_DAYS = 28
+REFUND_SPIKE_MIN_BASELINE_DAYS = 7 # Days with less history before them are not scored
+REFUND_SPIKE_MIN_SCORE = 3.0 # Baseline spreads above the median a day must reach to count as a spike
+
+# Success-rate cube: status counts per (merchant, city, payment method, hour of day) cell
+SUCCESS_CUBE_DIMENSIONS = ['merchant_display_name', 'city', 'method_code', 'hour']
+SUCCESS_CUBE_MIN_SEGMENT_TRANSACTIONS = 30 # Smaller segments are never flagged as failure hotspots
+SUCCESS_RATE_BENCHMARK = float(os.environ.get('SUCCESS_RATE_BENCHMARK', '85')) # Industry-average success rate (%) to compare against
+
+# Inverted index over support ticket subject + category (built by build_support_ticket_index)
+# 'postings': {term: {doc_id: [positions]}}, where doc_id is the row position in the snapshot's support_tickets
+# 'doc_dates': ticket_created_time per doc_id, 'sorted_terms': all terms in order for prefix lookups
+TICKET_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+TICKET_CATEGORY_POSITION_OFFSET = 10000 # Category tokens are positioned after the subject so phrases never span both fields
+TICKET_TREND_STOPWORDS = {
+    're', 'fw', 'fwd', 'the', 'and', 'for', 'of', 'to', 'in', 'on', 'is', 'a', 'an', 'with', 'by', 'at', 'from',
+    'not', 'are', 'our', 'your', 'we', 'has', 'have', 'be', 'this', 'that', 'regarding', 'required', 'request',
+    'related', 'query', 'complaint', 'newticket', 'ticket', 'urgent', 'pvt', 'ltd', 'pine', 'labs', 'pinelabs',
+    'gateway', 'external', 'miscellaneous', 'updated', 'mid',
+    'jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'
+}
+# Merchant scope for code running outside a Flask request (e.g. background jobs)
+_merchant_scope = contextvars.ContextVar('merchant_scope', default=None)
+
+# --- Metrics ---
+# In-process counters, gauges and latency histograms, rendered in the Prometheus text format on
+# /metrics. Kept dependency-free; every update is a dict lookup and a few additions under a lock.
+METRIC_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRIC_HELP = {
+    'http_request_duration_seconds': ('histogram', 'Latency of HTTP requests by route and routed /ask intent.'),
+    'helper_duration_seconds': ('histogram', 'Latency of analysis helper functions.'),
+    'load_phase_duration_seconds': ('histogram', 'Latency of data load phases (read, date_parse, status_mapping, merge).'),
+    'llm_call_duration_seconds': ('histogram', 'Latency of OpenAI chat completion calls.'),
+    'llm_calls_total': ('counter', 'OpenAI chat completion calls by outcome (success, error, retry, coalesced, circuit_open).'),
+    'llm_circuit_open': ('gauge', '1 while the OpenAI circuit breaker is open or half open.'),
+    'llm_tool_calls_total': ('counter', 'Analysis helpers run on behalf of the LLM by tool and outcome.'),
+    'llm_tokens_total': ('counter', 'OpenAI tokens by kind (prompt, cached_prompt, completion) as reported by the API.'),
+    'cache_lookups_total': ('counter', 'Cache lookups by cache and result (hit or miss).'),
+    'frame_rows': ('gauge', 'Rows currently loaded per DataFrame.'),
+    'admission_decisions_total': ('counter', 'Admission decisions by request class and outcome (admitted, queued, rejected).'),
+    'admission_wait_seconds': ('histogram', 'Time requests spent queued for admission, by request class.'),
+}
+_metrics_lock = threading.Lock()
+_metric_histograms = {} # (name, labels) -> {'buckets': [per-bucket counts], 'sum': float, 'count': int}
+_metric_counters = {} # (name, labels) -> float
+_metric_gauges = {} # (name, labels) -> float
+
+def _metric_key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+def observe_latency(name, seconds, **labels):
+    key = _metric_key(name, labels)
+    with _metrics_lock:
+        histogram = _metric_histograms.get(key)
+        if histogram is None:
+            histogram = _metric_histograms[key] = {'buckets': [0] * len(METRIC_LATENCY_BUCKETS), 'sum': 0.0, 'count': 0}
+        bucket_position = bisect.bisect_left(METRIC_LATENCY_BUCKETS, seconds)
+        if bucket_position < len(METRIC_LATENCY_BUCKETS):
+            histogram['buckets'][bucket_position] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+def increment_counter(name, amount=1, **labels):
+    key = _metric_key(name, labels)
+    with _metrics_lock:
+        _metric_counters[key] = _metric_counters.get(key, 0) + amount
+
+def set_gauge(name, value, **labels):
+    with _metrics_lock:
+        _metric_gauges[_metric_key(name, labels)] = value
+
+def record_cache_lookup(cache, hit):
+    # Hit rate per cache is cache_lookups_total{result="hit"} / sum over results
+    increment_counter('cache_lookups_total', cache=cache, result='hit' if hit else 'miss')
+
+@contextmanager
+def timed_block(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_latency(name, time.perf_counter() - start, **labels)
+
+def instrumented_helper(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with timed_block('helper_duration_seconds', helper=func.__name__), trace_span(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+def render_metrics():
+    with _metrics_lock:
+        histograms = {key: {'buckets': list(h['buckets']), 'sum': h['sum'], 'count': h['count']} for key, h in _metric_histograms.items()}
+        counters = dict(_metric_counters)
+        gauges = dict(_metric_gauges)
+
+    lines = []
+    for name, (metric_type, help_text) in METRIC_HELP.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        if metric_type == 'histogram':
+            for (metric_name, labels), histogram in sorted(histograms.items()):
+                if metric_name != name:
+                    continue
+                cumulative = 0
+                for upper_bound, bucket_count in zip(METRIC_LATENCY_BUCKETS, histogram['buckets']):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', upper_bound)])} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']:.6f}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+        else:
+            values = counters if metric_type == 'counter' else gauges
+            for (metric_name, labels), value in sorted(values.items()):
+                if metric_name == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+# --- Tracing ---
+_trace_scope = contextvars.ContextVar('trace_scope', default=None) # Trace for code outside a Flask request
+_trace_sink_lock = threading.Lock()
+_trace_sink = None
+
+def new_trace(trace_id=None, sampled=None):
+    if sampled is None:
+        sampled = TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE
+    return {'trace_id': trace_id or uuid.uuid4().hex, 'sampled': sampled, 'span_stack': []}
+
+def get_active_trace():
+    trace = _trace_scope.get()
+    if trace is None and has_request_context():
+        trace = g.get('trace')
+    return trace
+
+@contextmanager
+def trace_scope(name, sampled=None):
+    # Root trace for background work such as the data load, e.g. `with trace_scope('data_load'): ...`
+    trace = new_trace(sampled=sampled)
+    token = _trace_scope.set(trace)
+    try:
+        with trace_span(name):
+            yield trace
+    finally:
+        _trace_scope.reset(token)
+
+def emit_trace_record(record):
+    global _trace_sink
+    line = json.dumps(record, default=str)
+    with _trace_sink_lock:
+        if _trace_sink is None:
+            _trace_sink = open(TRACE_SINK_PATH, 'a', buffering=1)
+        _trace_sink.write(line + "\n")
+
+@contextmanager
+def trace_span(name, **attributes):
+    trace = get_active_trace()
+    if trace is None or not trace['sampled']:
+        yield
+        return
+
+    span_id = uuid.uuid4().hex[:16]
+    parent_id = trace['span_stack'][-1] if trace['span_stack'] else None
+    started_at = time.time()
+    started = time.perf_counter()
+    trace['span_stack'].append(span_id)
+    try:
+        yield
+    finally:
+        trace['span_stack'].pop()
+        emit_trace_record({
+            'type': 'span', 'trace_id': trace['trace_id'], 'span_id': span_id, 'parent_id': parent_id,
+            'name': name, 'start': started_at, 'duration_ms': round((time.perf_counter() - started) * 1000, 3),
+            **attributes
+        })
+
+def trace_event(message, **fields):
+    # Replaces DEBUG prints: recorded against the current span when the trace is sampled, dropped otherwise
+    trace = get_active_trace()
+    if trace is None or not trace['sampled']:
+        return
+    emit_trace_record({
+        'type': 'event', 'trace_id': trace['trace_id'],
+        'span_id': trace['span_stack'][-1] if trace['span_stack'] else None,
+        'time': time.time(), 'message': message, **fields
+    })
+
+def trace_frame_summary(frame_name, df, date_col=None):
+    # The loader used to print head()/info()/value_counts() for every frame; now only sampled load traces pay for it
+    trace = get_active_trace()
+    if trace is None or not trace['sampled']:
+        return
+    summary = {
+        'rows': len(df),
+        'dtypes': {col: str(dtype) for col, dtype in df.dtypes.items()},
+        'head': df.head().to_dict(orient='records')
+    }
+    if 'status' in df.columns:
+        summary['status_counts'] = df['status'].value_counts().to_dict()
+    if date_col and date_col in df.columns and not df[date_col].isnull().all():
+        summary['min_date'] = df[date_col].min().date().isoformat()
+        summary['max_date'] = df[date_col].max().date().isoformat()
+    trace_event('frame_summary', frame=frame_name, **summary)
+
+
+# --- Request Profiling Hooks ---
+def _profiling_requested():
+    return request.headers.get(PROFILE_HEADER) == '1' or request.args.get('profile') == '1'
+
+def profiled_route(view):
+    # cProfile is per-thread, so the profiler is started inside the view itself (async views run on their own loop thread)
+    if not PROFILING_ENABLED:
+        return view
+
+    if asyncio.iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def async_profiled_view(*args, **kwargs):
+            if not _profiling_requested():
+                return await view(*args, **kwargs)
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                return await view(*args, **kwargs)
+            finally:
+                profiler.disable()
+                g.profiler = profiler
+        return async_profiled_view
+
+    @functools.wraps(view)
+    def profiled_view(*args, **kwargs):
+        if not _profiling_requested():
+            return view(*args, **kwargs)
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return view(*args, **kwargs)
+        finally:
+            profiler.disable()
+            g.profiler = profiler
+    return profiled_view
+
+def save_request_profile(profiler, endpoint):
+    # Writes the raw .prof (for snakeviz / pstats) and a cumulative-time text summary next to it
+    os.makedirs(PROFILE_OUTPUT_DIR, exist_ok=True)
+    profile_id = f"{datetime.datetime.now().strftime('%Y%m%dT%H%M%S%f')}-{endpoint}"
+    profile_path = os.path.join(PROFILE_OUTPUT_DIR, f"{profile_id}.prof")
+    profiler.dump_stats(profile_path)
+
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(40)
+    with open(os.path.join(PROFILE_OUTPUT_DIR, f"{profile_id}.txt"), 'w') as summary_file:
+        summary_file.write(summary.getvalue())
+    return profile_id
 
-# Global DataFrames (will be populated by load_data_from_csv)
-transactions_df = pd.DataFrame() # Will be loaded from settlement_data.csv
-refunds_df = pd.DataFrame()
-settlements_df = pd.DataFrame()
-support_tickets_df = pd.DataFrame() # New DataFrame for support data
-customers_df = pd.DataFrame()
-transactions_df_with_customers = pd.DataFrame()
 
 # --- Mock Data Generation Functions (used as fallbacks if CSVs fail or columns are missing) ---
 def generate_mock_transactions(num_days=60, base_transactions_per_day=500):
@@ -88,7 +621,7 @@ def generate_mock_refunds(transactions_df_local):
     refund_data = []
     if transactions_df_local.empty or 'status' not in transactions_df_local.columns or 'transaction_time' not in transactions_df_local.columns:
         # If transactions_df_local is not ready, create a basic mock for refunds
-        print("DEBUG: transactions_df_local not ready for mock refunds, generating simplified refund mock.")
+        trace_event("transactions_df_local not ready for mock refunds, generating simplified refund mock.")
         for _ in range(random.randint(50, 150)):
             current_date = datetime.date.today() - datetime.timedelta(days=random.randint(1, 10))
             refund_data.append({
@@ -108,7 +641,7 @@ def generate_mock_refunds(transactions_df_local):
     for _ in range(random.randint(50, 150)):
         if not successful_transactions.empty:
             transaction = successful_transactions.sample(1).iloc[0]
-            refund_amount = round(random.uniform(50, transaction['amount']), 2)
+            refund_amount = round(random.uniform(50, paise_to_rupees(transaction['amount_paise'])), 2)
             original_txn_time = transaction['transaction_time'] if isinstance(transaction['transaction_time'], datetime.datetime) else datetime.datetime.fromisoformat(str(transaction['transaction_time']))
             refund_date = (original_txn_time.date() + datetime.timedelta(days=random.randint(1, 7)))
 
@@ -134,8 +667,8 @@ def generate_mock_settlements(transactions_df_local, num_days=60):
     start_date = datetime.date.today() - datetime.timedelta(days=num_days)
     settlement_data = []
 
-    if transactions_df_local.empty or 'status' not in transactions_df_local.columns or 'amount' not in transactions_df_local.columns:
-        print("DEBUG: transactions_df_local not ready for mock settlements, generating simplified settlement mock.")
+    if transactions_df_local.empty or 'status' not in transactions_df_local.columns or 'amount_paise' not in transactions_df_local.columns:
+        trace_event("transactions_df_local not ready for mock settlements, generating simplified settlement mock.")
         for i in range(num_days + 1):
             current_date = start_date + datetime.timedelta(days=i)
             total_successful_amount = round(random.uniform(10000, 1000000), 2)
@@ -153,11 +686,11 @@ def generate_mock_settlements(transactions_df_local, num_days=60):
 
     for i in range(num_days + 1):
         current_date = start_date + datetime.timedelta(days=i)
-        daily_transactions = transactions_df_local[transactions_df_local['transaction_date'] == current_date]
+        daily_transactions = transactions_df_local[pd.to_datetime(transactions_df_local['transaction_date']).dt.date == current_date]
         successful_daily_transactions = daily_transactions[daily_transactions['status'] == 'Success']
 
         if not successful_daily_transactions.empty:
-            total_successful_amount = successful_daily_transactions['amount'].sum()
+            total_successful_amount = paise_to_rupees(successful_daily_transactions['amount_paise'].sum())
             fees = round(total_successful_amount * random.uniform(0.005, 0.025), 2)
             net_settlement = round(total_successful_amount - fees, 2)
 
@@ -193,52 +726,132 @@ def generate_mock_support_tickets(num_days=60):
     return pd.DataFrame(data)
 
 
+# --- Payment Method Taxonomy ---
+# Raw payment_mode_name values are mapped once per distinct value to a canonical integer code
+# plus a bitmask of method groups, so method filters in the helpers are integer comparisons.
+METHOD_OTHER, METHOD_UPI, METHOD_WALLET, METHOD_CREDIT_CARD, METHOD_DEBIT_CARD, METHOD_NET_BANKING, METHOD_EMI = range(7)
+METHOD_NAMES = {
+    METHOD_OTHER: 'Other',
+    METHOD_UPI: 'UPI',
+    METHOD_WALLET: 'Wallet',
+    METHOD_CREDIT_CARD: 'Credit Card',
+    METHOD_DEBIT_CARD: 'Debit Card',
+    METHOD_NET_BANKING: 'Net Banking',
+    METHOD_EMI: 'EMI'
+}
+METHOD_GROUP_MOBILE = 1
+METHOD_GROUP_CARD = 2
+METHOD_GROUP_BANK = 4
+METHOD_GROUPS = {
+    METHOD_OTHER: 0,
+    METHOD_UPI: METHOD_GROUP_MOBILE,
+    METHOD_WALLET: METHOD_GROUP_MOBILE,
+    METHOD_CREDIT_CARD: METHOD_GROUP_CARD,
+    METHOD_DEBIT_CARD: METHOD_GROUP_CARD,
+    METHOD_NET_BANKING: METHOD_GROUP_BANK,
+    METHOD_EMI: METHOD_GROUP_CARD
+}
+# First matching pattern (a regex over the upper-cased method name) wins, so "Debit Card EMI" is a
+# debit card and "PhonePe Wallet" a wallet. EMI must be a whole word: "PREMIUM CARD" is not EMI.
+METHOD_KEYWORD_RULES = [
+    ('UPI', METHOD_UPI),
+    ('WALLET', METHOD_WALLET),
+    ('CREDIT', METHOD_CREDIT_CARD),
+    ('DEBIT', METHOD_DEBIT_CARD),
+    ('NET BANKING', METHOD_NET_BANKING),
+    ('NETBANKING', METHOD_NET_BANKING),
+    (r'\bEMI\b', METHOD_EMI)
+]
+METHOD_GROUP_KEYWORDS = {'mobile': METHOD_GROUP_MOBILE, 'card': METHOD_GROUP_CARD, 'bank': METHOD_GROUP_BANK}
+
+def classify_payment_method(raw_method):
+    if not isinstance(raw_method, str):
+        return METHOD_OTHER
+    upper_method = raw_method.upper()
+    for pattern, code in METHOD_KEYWORD_RULES:
+        if re.search(pattern, upper_method):
+            return code
+    return METHOD_OTHER
+
+def add_payment_method_taxonomy(df):
+    # Adds 'method_code' and 'method_groups' (int8) columns, classifying each distinct raw value once
+    if df.empty or 'payment_method' not in df.columns:
+        return df.assign(method_code=np.int8(METHOD_OTHER), method_groups=np.int8(0))
+    value_codes, distinct_methods = pd.factorize(df['payment_method'])
+    canonical_codes = np.array([classify_payment_method(m) for m in distinct_methods] + [METHOD_OTHER], dtype=np.int8)
+    group_bits = np.array([METHOD_GROUPS[code] for code in canonical_codes], dtype=np.int8)
+    # factorize marks missing values with -1, which picks the trailing METHOD_OTHER entry
+    return df.assign(method_code=canonical_codes[value_codes], method_groups=group_bits[value_codes])
+
+def payment_method_mask(df, method_keyword):
+    # Boolean row mask for a method keyword ('Mobile', 'UPI', 'Credit Card', ...) using the integer taxonomy
+    group_bit = METHOD_GROUP_KEYWORDS.get(method_keyword.lower())
+    if group_bit is not None:
+        return (df['method_groups'] & group_bit) != 0
+    return df['method_code'] == classify_payment_method(method_keyword)
+
+
+# --- Fixed-Point Money ---
+# Money columns are held as int64 paise ('amount_paise', 'gross_amount_paise', 'fees_paise',
+# 'net_amount_paise') from ingest onwards, so sums are exact and stay in integer arithmetic.
+# Helpers aggregate and return paise; rupees only appear where a response is built.
+def to_paise_columns(df, columns):
+    # Replaces each rupee column with an int64 '<column>_paise' column; unparseable values become 0
+    present = [col for col in columns if col in df.columns]
+    converted = {
+        f"{col}_paise": (pd.to_numeric(df[col], errors='coerce').fillna(0) * 100).round().astype('int64')
+        for col in present
+    }
+    return df.drop(columns=present).assign(**converted)
+
+def rupees_to_paise(rupees):
+    return int(round(float(rupees) * 100))
+
+def paise_to_rupees(paise):
+    # Works on scalars and Series; use for numeric response payloads (chart data, LLM context)
+    return paise / 100
+
+def format_rupees(paise):
+    # Exact "₹1,234.50" rendering of a paise value (means are rounded to the nearest paisa first)
+    paise = int(round(paise))
+    sign = '-' if paise < 0 else ''
+    rupees, remainder = divmod(abs(paise), 100)
+    return f"{sign}₹{rupees:,}.{remainder:02d}"
+
+
 def load_data_from_csv():
-    global transactions_df, refunds_df, settlements_df, support_tickets_df, customers_df, transactions_df_with_customers
-
-    print("Attempting to load data from CSV files...")
-
-    # Define a list of common date formats for robust parsing
-    # This list will be tried by pd.to_datetime if format inference fails
-    COMMON_DATE_FORMATS = [
-        '%Y-%m-%d %H:%M:%S',    # 2024-01-01 12:30:00
-        '%Y-%m-%d %I:%M %p',    # 2024-01-01 01:30 PM
-        '%Y-%m-%d',             # 2024-01-01
-        '%m/%d/%Y %H:%M:%S',    # 01/15/2024 12:30:00
-        '%d-%m-%Y %H:%M:%S',    # 15-01-2024 12:30:00
-        '%m/%d/%Y',             # 01/15/2024
-        '%d-%m-%Y',             # 15-01-2024
-        '%Y/%m/%d %H:%M:%S',    # 2024/01/15 12:30:00
-        '%Y/%m/%d',             # 2024/01/15
-        '%d/%m/%Y'              # 15/01/2024
-    ]
+    # Builds every frame from scratch and publishes them as a new snapshot; requests already
+    # running keep reading the snapshot they started with.
+    logger.info("Attempting to load data from CSV files...")
 
-    def _safe_load_csv(file_path, expected_date_col_in_csv, target_date_col_in_df, column_renames, fallback_generator, encoding='utf-8'):
+    def _read_csv_source(file_path, encoding='utf-8'):
+        # Raw read only; an empty frame means the file is missing or unreadable. The raw frame is
+        # shared read-only between stages (settlement_data.csv feeds two of them), so _safe_load_csv copies it.
         df = pd.DataFrame()
-        loaded_successfully = False
+        read_started = time.perf_counter()
         try:
             df = pd.read_csv(file_path, encoding=encoding)
-            print(f"Successfully loaded {file_path} with {encoding} encoding.")
-            loaded_successfully = True
+            logger.info(f"Successfully loaded {file_path} with {encoding} encoding.")
         except UnicodeDecodeError:
             try:
                 df = pd.read_csv(file_path, encoding='latin1')
-                print(f"Successfully loaded {file_path} with latin1 encoding.")
-                loaded_successfully = True
+                logger.info(f"Successfully loaded {file_path} with latin1 encoding.")
             except UnicodeDecodeError:
                 try:
                     df = pd.read_csv(file_path, encoding='cp1252')
-                    print(f"Successfully loaded {file_path} with cp1252 encoding.")
-                    loaded_successfully = True
+                    logger.info(f"Successfully loaded {file_path} with cp1252 encoding.")
                 except Exception as e:
-                    print(f"Error loading {file_path} with common encodings: {e}.")
+                    logger.warning(f"Error loading {file_path} with common encodings: {e}.")
         except FileNotFoundError:
-            print(f"Error: {file_path} not found.")
+            logger.warning(f"{file_path} not found.")
         except Exception as e:
-            print(f"Error loading {file_path}: {e}.")
+            logger.warning(f"Error loading {file_path}: {e}.")
+        observe_latency('load_phase_duration_seconds', time.perf_counter() - read_started, phase='read', source=file_path)
+        return df
 
-        if not loaded_successfully or df.empty:
-            print(f"Falling back to mock data for {file_path} due to load failure or empty file.")
+    def _safe_load_csv(df, file_path, expected_date_col_in_csv, target_date_col_in_df, column_renames, fallback_generator):
+        if df.empty:
+            logger.warning(f"Falling back to mock data for {file_path} due to load failure or empty file.")
             return fallback_generator()
 
         temp_df = df.copy()
@@ -248,16 +861,17 @@ def load_data_from_csv():
 
         # Check if the expected date column (after potential renaming) exists
         if target_date_col_in_df not in temp_df.columns:
-            print(f"Warning: Expected date column '{target_date_col_in_df}' (derived from '{expected_date_col_in_csv}') not found in {file_path}. Data might be incomplete or fall back to mock.")
+            logger.warning(f"Expected date column '{target_date_col_in_df}' (derived from '{expected_date_col_in_csv}') not found in {file_path}. Data might be incomplete or fall back to mock.")
             # If date column is missing, the data is unusable for time-series analysis from this file
             return fallback_generator()
 
         # Robust date parsing to datetime64[ns]
         # Try parsing with infer_datetime_format first
+        date_parse_started = time.perf_counter()
         parsed_dates = pd.to_datetime(temp_df[target_date_col_in_df], errors='coerce', infer_datetime_format=True)
 
         if parsed_dates.isnull().all() and not temp_df.empty:
-            print(f"DEBUG: All dates coerced to NaT initially for {file_path}. Trying explicit formats.")
+            trace_event(f"All dates coerced to NaT initially for {file_path}. Trying explicit formats.")
             # If all failed, try explicitly with the common formats list
             for fmt in COMMON_DATE_FORMATS:
                 # Only try to parse rows that are still NaT
@@ -277,338 +891,299 @@ def load_data_from_csv():
 
         temp_df[target_date_col_in_df] = parsed_dates
         temp_df = temp_df.dropna(subset=[target_date_col_in_df]) # Drop rows where date parsing failed completely
+        observe_latency('load_phase_duration_seconds', time.perf_counter() - date_parse_started, phase='date_parse', source=file_path)
 
         if temp_df.empty:
-            print(f"Warning: {file_path} became empty after date parsing and dropping NaNs. Falling back to mock data.")
+            logger.warning(f"{file_path} became empty after date parsing and dropping NaNs. Falling back to mock data.")
             return fallback_generator()
             
         # Final check: ensure the column is indeed datetime64[ns]
         if not pd.api.types.is_datetime64_any_dtype(temp_df[target_date_col_in_df]):
-            print(f"DEBUG: Final check - '{target_date_col_in_df}' is not datetime for {file_path}. Recoercing as last resort.")
+            trace_event(f"Final check - '{target_date_col_in_df}' is not datetime for {file_path}. Recoercing as last resort.")
             temp_df[target_date_col_in_df] = pd.to_datetime(temp_df[target_date_col_in_df], errors='coerce')
             temp_df = temp_df.dropna(subset=[target_date_col_in_df])
             if temp_df.empty:
-                print(f"Warning: {file_path} became empty after final datetime coercion. Falling back to mock data.")
+                logger.warning(f"{file_path} became empty after final datetime coercion. Falling back to mock data.")
                 return fallback_generator()
 
         return temp_df
 
     # --- Load Transactions from 'settlement_data.csv' ---
-    # `transactions_column_renames` specifies mappings from original CSV column names
-    # to the names used internally by the application.
-    # If a column name in your CSV already matches the internal name, it doesn't need to be in this map.
-    transactions_column_renames = {
-        'axis_payout_created': 'transaction_time',
-        'txn_status_name': 'status', 
-        'payment_mode_name': 'payment_method',
-        # Based on your console output, columns like 'transaction_id', 'merchant_display_name',
-        # 'amount', 'is_aggregator', 'is_reversal' already exist with their target names in the CSV.
-        # However, 'customer_id', 'product_category', 'city', 'gateway_timeout' were reported
-        # as missing in your CSV and filled by defaults in the logs.
-        # If your CSV has these columns under different names, add them to this rename map.
-        # Example if 'CustID' is used in CSV for customer_id: 'CustID': 'customer_id',
-        # Example if 'ProductCat' is used in CSV for product_category: 'ProductCat': 'product_category',
-        # Example if 'Location' is used in CSV for city: 'Location': 'city',
-        # Example if 'GatewayError' is used in CSV for gateway_timeout: 'GatewayError': 'gateway_timeout',
-    }
-    # `transactions_expected_cols` lists all columns that the application's analysis functions
-    # (like customer behavior, EMI recommendations, etc.) *expect* to be present in the
-    # final `transactions_df`. If any of these are not found after initial loading and renaming,
-    # they will be filled with generated default/mock data.
-    transactions_expected_cols = [
-        'transaction_id', 'merchant_display_name', 'customer_id', 'amount',
-        'payment_method', 'status', 'transaction_time', 'product_category',
-        'city', 'gateway_timeout', 'is_aggregator', 'is_reversal',
-        'transaction_date' # This is a derived column (date part of transaction_time)
-    ]
+    def load_transactions(raw_df):
+        # `transactions_expected_cols` lists all columns that the application's analysis functions
+        # (like customer behavior, EMI recommendations, etc.) *expect* to be present in the
+        # final `transactions_df`. If any of these are not found after initial loading and renaming,
+        # they will be filled with generated default/mock data.
+        transactions_expected_cols = [
+            'transaction_id', 'merchant_display_name', 'customer_id', 'amount',
+            'payment_method', 'status', 'transaction_time', 'product_category',
+            'city', 'gateway_timeout', 'is_aggregator', 'is_reversal',
+            'transaction_date' # This is a derived column (date part of transaction_time)
+        ]
 
-    temp_transactions_df = _safe_load_csv(
-        SETTLEMENTS_CSV, 'axis_payout_created', 'transaction_time', transactions_column_renames, generate_mock_transactions
-    )
-    if not temp_transactions_df.empty:
-        transactions_df = temp_transactions_df.copy()
-
-        # Ensure primary date/time column is correctly typed
-        transactions_df['transaction_time'] = pd.to_datetime(transactions_df['transaction_time'], errors='coerce')
-        transactions_df.dropna(subset=['transaction_time'], inplace=True)
-        transactions_df['transaction_date'] = transactions_df['transaction_time'].dt.normalize() # Ensures date is datetime64[ns] with time 00:00:00
-
-        # Ensure amount is numeric
-        transactions_df['amount'] = pd.to_numeric(transactions_df['amount'], errors='coerce').fillna(0)
-
-        # Robust status mapping for transactions (if 'status' column exists after renaming)
-        success_keywords = ['SUCCESS', 'SETTLED', 'COMPLETED', 'CAPTURED']
-        if 'status' in transactions_df.columns:
-            transactions_df['status'] = transactions_df['status'].astype(str).fillna('Unknown')
-            transactions_df['status'] = transactions_df['status'].apply(
-                lambda x: 'Success' if any(keyword in x.upper() for keyword in success_keywords) else ('Failed' if 'FAILED' in x.upper() or 'DECLINED' in x.upper() else 'Pending')
-            )
-        else:
-            transactions_df['status'] = 'Unknown' # Default if status column is missing
-
-        # Fill missing critical columns with reasonable defaults after initial load and renames
-        for col in transactions_expected_cols:
-            if col not in transactions_df.columns:
-                print(f"DEBUG: Missing critical column '{col}' in loaded transactions_df, filling with default.")
-                if col == 'customer_id':
-                    transactions_df[col] = [f"CUST{random.randint(1000, 9999)}" for _ in range(len(transactions_df))]
-                elif col == 'product_category':
-                    transactions_df[col] = random.choices(['Electronics', 'Fashion', 'Groceries', 'Services'], k=len(transactions_df))
-                elif col == 'city':
-                    transactions_df[col] = random.choices(['Bengaluru', 'Mumbai', 'Delhi', 'Chennai'], k=len(transactions_df))
-                elif col == 'gateway_timeout':
-                    transactions_df[col] = False # Default to False
-                elif col == 'merchant_display_name': # This one should probably exist
-                    transactions_df[col] = [f"Merchant{random.randint(1, 100)}" for _ in range(len(transactions_df))]
-                elif col == 'payment_method': # This one should probably exist
-                     transactions_df[col] = random.choices(['UPI', 'Credit Card', 'Debit Card', 'Net Banking', 'Wallet'], k=len(transactions_df))
-                elif col == 'is_aggregator' or col == 'is_reversal':
-                    transactions_df[col] = False # Default to False
-                elif col == 'transaction_id': # This one should probably exist
-                    transactions_df[col] = [f"TXN{random.randint(100000, 999999)}" for _ in range(len(transactions_df))]
-                elif col == 'amount': # This one should probably exist
-                    transactions_df[col] = 0.0
-                elif col == 'status': # This one should probably exist
-                    transactions_df[col] = 'Unknown'
-                # 'transaction_time' and 'transaction_date' are handled by _safe_load_csv and subsequent normalization
-
-        print(f"Loaded {transactions_df.shape[0]} transactions from {SETTLEMENTS_CSV}")
-        print("\n--- transactions_df Head ---")
-        print(transactions_df.head())
-        print("\n--- transactions_df Info ---")
-        print(transactions_df.info())
-        print("\n--- transactions_df Status Value Counts ---")
-        print(transactions_df['status'].value_counts())
-        print("\n--- transactions_df Date Range ---")
-        if not transactions_df.empty and 'transaction_date' in transactions_df.columns and not transactions_df['transaction_date'].isnull().all():
-            print(f"Min Date: {transactions_df['transaction_date'].min().date()}")
-            print(f"Max Date: {transactions_df['transaction_date'].max().date()}")
+        temp_transactions_df = _safe_load_csv(
+            raw_df, SETTLEMENTS_CSV, 'axis_payout_created', 'transaction_time', TRANSACTIONS_COLUMN_RENAMES, generate_mock_transactions
+        )
+        if not temp_transactions_df.empty:
+            transactions_df = temp_transactions_df.copy()
+
+            # Ensure primary date/time column is correctly typed
+            transactions_df['transaction_time'] = pd.to_datetime(transactions_df['transaction_time'], errors='coerce')
+            transactions_df.dropna(subset=['transaction_time'], inplace=True)
+            transactions_df['transaction_date'] = transactions_df['transaction_time'].dt.normalize() # Ensures date is datetime64[ns] with time 00:00:00
+
+            # Robust status mapping for transactions (if 'status' column exists after renaming)
+            with timed_block('load_phase_duration_seconds', phase='status_mapping', source=SETTLEMENTS_CSV):
+                if 'status' in transactions_df.columns:
+                    transactions_df['status'] = transactions_df['status'].astype(str).fillna('Unknown')
+                    transactions_df['status'] = transactions_df['status'].apply(
+                        lambda x: 'Success' if any(keyword in x.upper() for keyword in TRANSACTION_SUCCESS_KEYWORDS) else ('Failed' if 'FAILED' in x.upper() or 'DECLINED' in x.upper() else 'Pending')
+                    )
+                else:
+                    transactions_df['status'] = 'Unknown' # Default if status column is missing
+
+            # Fill missing critical columns with reasonable defaults after initial load and renames
+            for col in transactions_expected_cols:
+                if col not in transactions_df.columns:
+                    trace_event(f"Missing critical column '{col}' in loaded transactions_df, filling with default.")
+                    if col == 'customer_id':
+                        transactions_df[col] = [f"CUST{random.randint(1000, 9999)}" for _ in range(len(transactions_df))]
+                    elif col == 'product_category':
+                        transactions_df[col] = random.choices(['Electronics', 'Fashion', 'Groceries', 'Services'], k=len(transactions_df))
+                    elif col == 'city':
+                        transactions_df[col] = random.choices(['Bengaluru', 'Mumbai', 'Delhi', 'Chennai'], k=len(transactions_df))
+                    elif col == 'gateway_timeout':
+                        transactions_df[col] = False # Default to False
+                    elif col == 'merchant_display_name': # This one should probably exist
+                        transactions_df[col] = [f"Merchant{random.randint(1, 100)}" for _ in range(len(transactions_df))]
+                    elif col == 'payment_method': # This one should probably exist
+                         transactions_df[col] = random.choices(['UPI', 'Credit Card', 'Debit Card', 'Net Banking', 'Wallet'], k=len(transactions_df))
+                    elif col == 'is_aggregator' or col == 'is_reversal':
+                        transactions_df[col] = False # Default to False
+                    elif col == 'transaction_id': # This one should probably exist
+                        transactions_df[col] = [f"TXN{random.randint(100000, 999999)}" for _ in range(len(transactions_df))]
+                    elif col == 'amount': # This one should probably exist
+                        transactions_df[col] = 0.0
+                    elif col == 'status': # This one should probably exist
+                        transactions_df[col] = 'Unknown'
+                    # 'transaction_time' and 'transaction_date' are handled by _safe_load_csv and subsequent normalization
+
+            logger.info(f"Loaded {transactions_df.shape[0]} transactions from {SETTLEMENTS_CSV}")
+            trace_frame_summary('transactions_df', transactions_df, 'transaction_date')
         else:
-            print("Date range not available for transactions_df (or all dates are NaT).")
-    else:
-        transactions_df = generate_mock_transactions()
-        transactions_df['transaction_time'] = pd.to_datetime(transactions_df['transaction_time'], errors='coerce')
-        transactions_df['transaction_date'] = transactions_df['transaction_time'].dt.normalize()
-        print(f"Failed to load {SETTLEMENTS_CSV} for transactions. Generated mock transactions data.")
+            transactions_df = generate_mock_transactions()
+            transactions_df['transaction_time'] = pd.to_datetime(transactions_df['transaction_time'], errors='coerce')
+            transactions_df['transaction_date'] = transactions_df['transaction_time'].dt.normalize()
+            logger.warning(f"Failed to load {SETTLEMENTS_CSV} for transactions. Generated mock transactions data.")
 
-    # --- Load Refunds from 'txn_refunds.csv' ---
-    # `refunds_column_renames` specifies mappings from original CSV column names
-    # to the names used internally by the application.
-    # If a column name in your CSV already matches the internal name, it doesn't need to be in this map.
-    refunds_column_renames = {
-        'txn_completion_date_time': 'refund_date',
-        'txn_status_name': 'status', # Renaming txn_status_name to status
-        # Based on your console output, columns like 'transaction_id', 'merchant_display_name',
-        # 'amount', 'is_aggregator', 'is_reversal' already exist with their target names in the CSV.
-        # However, 'refund_id', 'reason', 'is_spike_related' were reported as missing in your CSV
-        # and filled by defaults in the logs.
-        # If your CSV has these columns under different names, add them to this rename map.
-        # Example if 'RefundID' is used in CSV for refund_id: 'RefundID': 'refund_id',
-        # Example if 'RefundReason' is used in CSV for reason: 'RefundReason': 'reason',
-        # Example if 'SpikeFlag' is used in CSV for is_spike_related: 'SpikeFlag': 'is_spike_related',
-    }
-    # `refunds_expected_cols` lists all columns that the application's analysis functions
-    # (like refund spike analysis) *expect* to be present in the final `refunds_df`.
-    # If any of these are not found after initial loading and renaming, they will be
-    # filled with generated default/mock data.
-    refunds_expected_cols = [
-        'refund_id', 'transaction_id', 'merchant_display_name', 'amount',
-        'refund_date', 'reason', 'is_spike_related', 'status'
-    ]
-    temp_refunds_df = _safe_load_csv(
-        REFUNDS_CSV, 'txn_completion_date_time', 'refund_date', refunds_column_renames, lambda: generate_mock_refunds(transactions_df)
-    )
-    if not temp_refunds_df.empty:
-        refunds_df = temp_refunds_df.copy()
-        
-        # Ensure date column is correctly typed
-        refunds_df['refund_date'] = pd.to_datetime(refunds_df['refund_date'], errors='coerce')
-        refunds_df.dropna(subset=['refund_date'], inplace=True)
+        return add_payment_method_taxonomy(to_paise_columns(transactions_df, ['amount']))
 
-        refunds_df['amount'] = pd.to_numeric(refunds_df['amount'], errors='coerce').fillna(0)
+    # --- Load Refunds from 'txn_refunds.csv' ---
+    def load_refunds(raw_df, transactions_future):
+        # Transactions are only needed for the mock fallback
+        # `refunds_expected_cols` lists all columns that the application's analysis functions
+        # (like refund spike analysis) *expect* to be present in the final `refunds_df`.
+        # If any of these are not found after initial loading and renaming, they will be
+        # filled with generated default/mock data.
+        refunds_expected_cols = [
+            'refund_id', 'transaction_id', 'merchant_display_name', 'amount',
+            'refund_date', 'reason', 'is_spike_related', 'status'
+        ]
+        temp_refunds_df = _safe_load_csv(
+            raw_df, REFUNDS_CSV, 'txn_completion_date_time', 'refund_date', REFUNDS_COLUMN_RENAMES, lambda: generate_mock_refunds(transactions_future.result())
+        )
+        if not temp_refunds_df.empty:
+            refunds_df = temp_refunds_df.copy()
         
-        # Robust status mapping for refunds
-        completed_refund_keywords = ['COMPLETED', 'SUCCESS', 'REFUNDED']
-        if 'status' in refunds_df.columns:
-            refunds_df['status'] = refunds_df['status'].astype(str).fillna('Unknown')
-            refunds_df['status'] = refunds_df['status'].apply(
-                lambda x: 'Completed' if any(keyword in x.upper() for keyword in completed_refund_keywords) else ('Failed' if 'FAILED' in x.upper() or 'DECLINED' in x.upper() else 'Pending')
-            )
-        else:
-            refunds_df['status'] = 'Unknown'
-
-        # Fill missing critical columns
-        for col in refunds_expected_cols:
-            if col not in refunds_df.columns:
-                print(f"DEBUG: Missing critical column '{col}' in loaded refunds_df, filling with default.")
-                if col == 'is_spike_related':
-                     refunds_df[col] = False # Default if not in CSV
-                elif col == 'reason':
-                    refunds_df[col] = random.choices(['Customer Request', 'Technical Error', 'Product Return', 'Gateway Issue'], k=len(refunds_df))
-                elif col == 'refund_id':
-                    refunds_df[col] = [f"REF{random.randint(10000, 99999)}" for _ in range(len(refunds_df))]
-                elif col == 'merchant_display_name':
-                    refunds_df[col] = [f"Merchant{random.randint(1, 100)}" for _ in range(len(refunds_df))]
-                elif col == 'transaction_id':
-                    refunds_df[col] = [f"TXN{random.randint(100000, 999999)}" for _ in range(len(refunds_df))]
-                elif col == 'amount':
-                    refunds_df[col] = 0.0
-                elif col == 'status':
-                    refunds_df[col] = 'Unknown'
-                # 'refund_date' is handled by _safe_load_csv
-
-
-        print(f"Loaded {refunds_df.shape[0]} refunds from {REFUNDS_CSV}")
-        print("\n--- refunds_df Head ---")
-        print(refunds_df.head())
-        print("\n--- refunds_df Info ---")
-        print(refunds_df.info())
-        print("\n--- refunds_df Status Value Counts ---")
-        print(refunds_df['status'].value_counts())
-        print("\n--- refunds_df Date Range ---")
-        if not refunds_df.empty and 'refund_date' in refunds_df.columns and not refunds_df['refund_date'].isnull().all():
-            print(f"Min Date: {refunds_df['refund_date'].min().date()}")
-            print(f"Max Date: {refunds_df['refund_date'].max().date()}")
+            # Ensure date column is correctly typed
+            refunds_df['refund_date'] = pd.to_datetime(refunds_df['refund_date'], errors='coerce')
+            refunds_df.dropna(subset=['refund_date'], inplace=True)
+
+            # Robust status mapping for refunds
+            with timed_block('load_phase_duration_seconds', phase='status_mapping', source=REFUNDS_CSV):
+                if 'status' in refunds_df.columns:
+                    refunds_df['status'] = refunds_df['status'].astype(str).fillna('Unknown')
+                    refunds_df['status'] = refunds_df['status'].apply(
+                        lambda x: 'Completed' if any(keyword in x.upper() for keyword in REFUND_COMPLETED_KEYWORDS) else ('Failed' if 'FAILED' in x.upper() or 'DECLINED' in x.upper() else 'Pending')
+                    )
+                else:
+                    refunds_df['status'] = 'Unknown'
+
+            # Fill missing critical columns
+            for col in refunds_expected_cols:
+                if col not in refunds_df.columns:
+                    trace_event(f"Missing critical column '{col}' in loaded refunds_df, filling with default.")
+                    if col == 'is_spike_related':
+                         refunds_df[col] = False # Default if not in CSV
+                    elif col == 'reason':
+                        refunds_df[col] = random.choices(['Customer Request', 'Technical Error', 'Product Return', 'Gateway Issue'], k=len(refunds_df))
+                    elif col == 'refund_id':
+                        refunds_df[col] = [f"REF{random.randint(10000, 99999)}" for _ in range(len(refunds_df))]
+                    elif col == 'merchant_display_name':
+                        refunds_df[col] = [f"Merchant{random.randint(1, 100)}" for _ in range(len(refunds_df))]
+                    elif col == 'transaction_id':
+                        refunds_df[col] = [f"TXN{random.randint(100000, 999999)}" for _ in range(len(refunds_df))]
+                    elif col == 'amount':
+                        refunds_df[col] = 0.0
+                    elif col == 'status':
+                        refunds_df[col] = 'Unknown'
+                    # 'refund_date' is handled by _safe_load_csv
+
+
+            logger.info(f"Loaded {refunds_df.shape[0]} refunds from {REFUNDS_CSV}")
+            trace_frame_summary('refunds_df', refunds_df, 'refund_date')
         else:
-            print("Date range not available for refunds_df (or all dates are NaT).")
-    else:
-        refunds_df = generate_mock_refunds(transactions_df)
-        refunds_df['refund_date'] = pd.to_datetime(refunds_df['refund_date'], errors='coerce')
-        print(f"Failed to load {REFUNDS_CSV}. Generated mock refunds data.")
+            refunds_df = generate_mock_refunds(transactions_future.result())
+            refunds_df['refund_date'] = pd.to_datetime(refunds_df['refund_date'], errors='coerce')
+            logger.warning(f"Failed to load {REFUNDS_CSV}. Generated mock refunds data.")
+
+        return to_paise_columns(refunds_df, ['amount'])
 
     # --- Load Settlements from 'settlement_data.csv' ---
-    # `settlements_column_renames` specifies mappings from original CSV column names
-    # to the names used internally by the application.
-    # If a column name in your CSV already matches the internal name, it doesn't need to be in this map.
-    settlements_column_renames = {
-        'axis_payout_created': 'settlement_date',
-        'settlement_amount': 'net_amount',
-        'amount': 'gross_amount', # The 'amount' column in settlement_data is likely the gross amount of the transaction
-        'mdr_charge': 'fees',
-        'bank_reference_number': 'bank_reference', # Renaming this if present in CSV
-        'transaction_id': 'settlement_id' # Using transaction_id as settlement_id for simplicity, adjust if a dedicated ID exists
-    }
-    # `settlements_expected_cols` lists all columns that the application's analysis functions
-    # (like settlement summaries) *expect* to be present in the final `settlements_df`.
-    # If any of these are not found after initial loading and renaming, they will be
-    # filled with generated default/mock data.
-    settlements_expected_cols = [
-        'settlement_id', 'settlement_date', 'gross_amount', 'fees',
-        'net_amount', 'bank_reference'
-    ]
-    temp_settlements_df = _safe_load_csv(
-        SETTLEMENTS_CSV, 'axis_payout_created', 'settlement_date', settlements_column_renames, lambda: generate_mock_settlements(transactions_df)
-    )
-    if not temp_settlements_df.empty:
-        settlements_df = temp_settlements_df.copy()
+    def load_settlements(raw_df, transactions_future):
+        # Transactions are only needed for the mock fallback
+        # `settlements_column_renames` specifies mappings from original CSV column names
+        # to the names used internally by the application.
+        # If a column name in your CSV already matches the internal name, it doesn't need to be in this map.
+        settlements_column_renames = {
+            'axis_payout_created': 'settlement_date',
+            'settlement_amount': 'net_amount',
+            'amount': 'gross_amount', # The 'amount' column in settlement_data is likely the gross amount of the transaction
+            'mdr_charge': 'fees',
+            'bank_reference_number': 'bank_reference', # Renaming this if present in CSV
+            'transaction_id': 'settlement_id' # Using transaction_id as settlement_id for simplicity, adjust if a dedicated ID exists
+        }
+        # `settlements_expected_cols` lists all columns that the application's analysis functions
+        # (like settlement summaries) *expect* to be present in the final `settlements_df`.
+        # If any of these are not found after initial loading and renaming, they will be
+        # filled with generated default/mock data.
+        settlements_expected_cols = [
+            'settlement_id', 'settlement_date', 'gross_amount', 'fees',
+            'net_amount', 'bank_reference'
+        ]
+        temp_settlements_df = _safe_load_csv(
+            raw_df, SETTLEMENTS_CSV, 'axis_payout_created', 'settlement_date', settlements_column_renames, lambda: generate_mock_settlements(transactions_future.result())
+        )
+        if not temp_settlements_df.empty:
+            settlements_df = temp_settlements_df.copy()
 
-        # Ensure date column is correctly typed
-        settlements_df['settlement_date'] = pd.to_datetime(settlements_df['settlement_date'], errors='coerce')
-        settlements_df.dropna(subset=['settlement_date'], inplace=True)
+            # Ensure date column is correctly typed
+            settlements_df['settlement_date'] = pd.to_datetime(settlements_df['settlement_date'], errors='coerce')
+            settlements_df.dropna(subset=['settlement_date'], inplace=True)
 
-        settlements_df['net_amount'] = pd.to_numeric(settlements_df['net_amount'], errors='coerce').fillna(0)
+            settlements_df['net_amount'] = pd.to_numeric(settlements_df['net_amount'], errors='coerce').fillna(0)
         
-        # Fill missing critical columns based on relationships or mock values
-        for col in settlements_expected_cols:
-            if col not in settlements_df.columns:
-                print(f"DEBUG: Missing critical column '{col}' in loaded settlements_df, filling with default.")
-                if col == 'gross_amount':
-                    # Estimate gross if net_amount is available, otherwise 0
-                    settlements_df[col] = settlements_df['net_amount'].apply(lambda x: x * random.uniform(1.01, 1.05) if pd.notna(x) else 0.0)
-                elif col == 'fees':
-                    # Calculate fees if both gross and net are available, otherwise estimate
-                    settlements_df[col] = settlements_df.apply(lambda row: row['gross_amount'] - row['net_amount'] if pd.notna(row['gross_amount']) and pd.notna(row['net_amount']) else (row['net_amount'] * random.uniform(0.005, 0.025) if pd.notna(row['net_amount']) else 0.0), axis=1)
-                elif col == 'bank_reference':
-                    settlements_df[col] = [f"BANKREF{random.randint(1000000, 9999999)}" for _ in range(len(settlements_df))]
-                elif col == 'settlement_id':
-                    settlements_df[col] = [f"SETID{random.randint(1000, 9999)}" for _ in range(len(settlements_df))]
-                # 'settlement_date' and 'net_amount' are handled by _safe_load_csv and direct numeric conversion
+            # Fill missing critical columns based on relationships or mock values
+            for col in settlements_expected_cols:
+                if col not in settlements_df.columns:
+                    trace_event(f"Missing critical column '{col}' in loaded settlements_df, filling with default.")
+                    if col == 'gross_amount':
+                        # Estimate gross if net_amount is available, otherwise 0
+                        settlements_df[col] = settlements_df['net_amount'].apply(lambda x: x * random.uniform(1.01, 1.05) if pd.notna(x) else 0.0)
+                    elif col == 'fees':
+                        # Calculate fees if both gross and net are available, otherwise estimate
+                        settlements_df[col] = settlements_df.apply(lambda row: row['gross_amount'] - row['net_amount'] if pd.notna(row['gross_amount']) and pd.notna(row['net_amount']) else (row['net_amount'] * random.uniform(0.005, 0.025) if pd.notna(row['net_amount']) else 0.0), axis=1)
+                    elif col == 'bank_reference':
+                        settlements_df[col] = [f"BANKREF{random.randint(1000000, 9999999)}" for _ in range(len(settlements_df))]
+                    elif col == 'settlement_id':
+                        settlements_df[col] = [f"SETID{random.randint(1000, 9999)}" for _ in range(len(settlements_df))]
+                    # 'settlement_date' and 'net_amount' are handled by _safe_load_csv and direct numeric conversion
         
-        print(f"Loaded {settlements_df.shape[0]} settlements from {SETTLEMENTS_CSV}")
-        print("\n--- settlements_df Head ---")
-        print(settlements_df.head())
-        print("\n--- settlements_df Info ---")
-        print(settlements_df.info())
-        print("\n--- settlements_df Date Range ---")
-        if not settlements_df.empty and 'settlement_date' in settlements_df.columns and not settlements_df['settlement_date'].isnull().all():
-            print(f"Min Date: {settlements_df['settlement_date'].min().date()}")
-            print(f"Max Date: {settlements_df['settlement_date'].max().date()}")
+            logger.info(f"Loaded {settlements_df.shape[0]} settlements from {SETTLEMENTS_CSV}")
+            trace_frame_summary('settlements_df', settlements_df, 'settlement_date')
         else:
-            print("Date range not available for settlements_df (or all dates are NaT).")
-    else:
-        settlements_df = generate_mock_settlements(transactions_df)
-        settlements_df['settlement_date'] = pd.to_datetime(settlements_df['settlement_date'], errors='coerce')
-        print(f"Failed to load {SETTLEMENTS_CSV}. Generated mock settlements data.")
+            settlements_df = generate_mock_settlements(transactions_future.result())
+            settlements_df['settlement_date'] = pd.to_datetime(settlements_df['settlement_date'], errors='coerce')
+            logger.warning(f"Failed to load {SETTLEMENTS_CSV}. Generated mock settlements data.")
 
+        return to_paise_columns(settlements_df, ['gross_amount', 'fees', 'net_amount'])
 
     # --- Load Support Tickets from 'Support Data(Sheet1).csv' ---
-    # `support_column_renames` specifies mappings from original CSV column names
-    # to the names used internally by the application.
-    # If a column name in your CSV already matches the internal name, it doesn't need to be in this map.
-    support_column_renames = {
-        'Date/Time': 'ticket_created_time',
-        'Case Number': 'case_number',
-        'Category': 'category',
-        'Subject': 'subject',
-        'Corporate Name': 'corporate_name',
-        'Mode of Payment': 'mode_of_payment_for_ticket',
-        'Resolution': 'resolution_status',
-        # 'Created Time' is kept as is in the CSV and not explicitly used for analysis beyond initial load
-    }
-    # `support_expected_cols` lists all columns that the application's analysis functions
-    # *expect* to be present in the final `support_tickets_df`.
-    # If any of these are not found after initial loading and renaming, they will be
-    # filled with generated default/mock data.
-    support_expected_cols = [
-        'case_number', 'ticket_created_time', 'category', 'subject',
-        'corporate_name', 'mode_of_payment_for_ticket', 'resolution_status',
-        'ticket_created_date' # This is a derived column (date part of ticket_created_time)
-    ]
-    temp_support_df = _safe_load_csv(
-        SUPPORT_DATA_CSV, 'Date/Time', 'ticket_created_time', support_column_renames, generate_mock_support_tickets
-    )
-    if not temp_support_df.empty:
-        support_tickets_df = temp_support_df.copy()
-
-        # Ensure date column is correctly typed
-        support_tickets_df['ticket_created_time'] = pd.to_datetime(support_tickets_df['ticket_created_time'], errors='coerce')
-        support_tickets_df.dropna(subset=['ticket_created_time'], inplace=True)
-        support_tickets_df['ticket_created_date'] = support_tickets_df['ticket_created_time'].dt.normalize()
-
-        # Fill missing critical columns with reasonable defaults
-        for col in support_expected_cols:
-            if col not in support_tickets_df.columns:
-                print(f"DEBUG: Missing critical column '{col}' in loaded support_tickets_df, filling with default.")
-                if col == 'resolution_status':
-                    support_tickets_df[col] = random.choices(['Resolved', 'Pending', 'Escalated'], k=len(support_tickets_df))
-                elif col == 'mode_of_payment_for_ticket':
-                    support_tickets_df[col] = random.choices(['UPI', 'Credit Card', 'Debit Card', 'N/A'], k=len(support_tickets_df))
-                elif col == 'corporate_name':
-                    support_tickets_df[col] = [f"Corp{random.randint(1,10)}" for _ in range(len(support_tickets_df))]
-                elif col == 'subject':
-                    support_tickets_df[col] = [f"Issue regarding {random.choice(['payment', 'refund', 'login'])}" for _ in range(len(support_tickets_df))]
-                elif col == 'case_number':
-                    support_tickets_df[col] = [f"CASE{random.randint(10000, 99999)}" for _ in range(len(support_tickets_df))]
-                elif col == 'category':
-                    support_tickets_df[col] = random.choices(['Payment Failure', 'Refund Request', 'Technical Issue', 'Account Query', 'Others'], k=len(support_tickets_df))
-                # 'ticket_created_time' and 'ticket_created_date' handled by _safe_load_csv and subsequent normalization
-
-        print(f"Loaded {support_tickets_df.shape[0]} support tickets from {SUPPORT_DATA_CSV}")
-        print("\n--- support_tickets_df Head ---")
-        print(support_tickets_df.head())
-        print("\n--- support_tickets_df Info ---")
-        print(support_tickets_df.info())
-        print("\n--- support_tickets_df Date Range ---")
-        if not support_tickets_df.empty and 'ticket_created_date' in support_tickets_df.columns and not support_tickets_df['ticket_created_date'].isnull().all():
-            print(f"Min Date: {support_tickets_df['ticket_created_date'].min().date()}")
-            print(f"Max Date: {support_tickets_df['ticket_created_date'].max().date()}")
+    def load_support_tickets(raw_df):
+        # `support_column_renames` specifies mappings from original CSV column names
+        # to the names used internally by the application.
+        # If a column name in your CSV already matches the internal name, it doesn't need to be in this map.
+        support_column_renames = {
+            'Date/Time': 'ticket_created_time',
+            'Case Number': 'case_number',
+            'Category': 'category',
+            'Subject': 'subject',
+            'Corporate Name': 'corporate_name',
+            'Mode of Payment': 'mode_of_payment_for_ticket',
+            'Resolution': 'resolution_status',
+            # 'Created Time' is kept as is in the CSV and not explicitly used for analysis beyond initial load
+        }
+        # `support_expected_cols` lists all columns that the application's analysis functions
+        # *expect* to be present in the final `support_tickets_df`.
+        # If any of these are not found after initial loading and renaming, they will be
+        # filled with generated default/mock data.
+        support_expected_cols = [
+            'case_number', 'ticket_created_time', 'category', 'subject',
+            'corporate_name', 'mode_of_payment_for_ticket', 'resolution_status',
+            'ticket_created_date' # This is a derived column (date part of ticket_created_time)
+        ]
+        temp_support_df = _safe_load_csv(
+            raw_df, SUPPORT_DATA_CSV, 'Date/Time', 'ticket_created_time', support_column_renames, generate_mock_support_tickets
+        )
+        if not temp_support_df.empty:
+            support_tickets_df = temp_support_df.copy()
+
+            # Ensure date column is correctly typed
+            support_tickets_df['ticket_created_time'] = pd.to_datetime(support_tickets_df['ticket_created_time'], errors='coerce')
+            support_tickets_df.dropna(subset=['ticket_created_time'], inplace=True)
+            support_tickets_df['ticket_created_date'] = support_tickets_df['ticket_created_time'].dt.normalize()
+
+            # Fill missing critical columns with reasonable defaults
+            for col in support_expected_cols:
+                if col not in support_tickets_df.columns:
+                    trace_event(f"Missing critical column '{col}' in loaded support_tickets_df, filling with default.")
+                    if col == 'resolution_status':
+                        support_tickets_df[col] = random.choices(['Resolved', 'Pending', 'Escalated'], k=len(support_tickets_df))
+                    elif col == 'mode_of_payment_for_ticket':
+                        support_tickets_df[col] = random.choices(['UPI', 'Credit Card', 'Debit Card', 'N/A'], k=len(support_tickets_df))
+                    elif col == 'corporate_name':
+                        support_tickets_df[col] = [f"Corp{random.randint(1,10)}" for _ in range(len(support_tickets_df))]
+                    elif col == 'subject':
+                        support_tickets_df[col] = [f"Issue regarding {random.choice(['payment', 'refund', 'login'])}" for _ in range(len(support_tickets_df))]
+                    elif col == 'case_number':
+                        support_tickets_df[col] = [f"CASE{random.randint(10000, 99999)}" for _ in range(len(support_tickets_df))]
+                    elif col == 'category':
+                        support_tickets_df[col] = random.choices(['Payment Failure', 'Refund Request', 'Technical Issue', 'Account Query', 'Others'], k=len(support_tickets_df))
+                    # 'ticket_created_time' and 'ticket_created_date' handled by _safe_load_csv and subsequent normalization
+
+            logger.info(f"Loaded {support_tickets_df.shape[0]} support tickets from {SUPPORT_DATA_CSV}")
+            trace_frame_summary('support_tickets_df', support_tickets_df, 'ticket_created_date')
         else:
-            print("Date range not available for support_tickets_df (or all dates are NaT).")
-    else:
-        support_tickets_df = generate_mock_support_tickets()
-        support_tickets_df['ticket_created_time'] = pd.to_datetime(support_tickets_df['ticket_created_time'], errors='coerce')
-        support_tickets_df['ticket_created_date'] = support_tickets_df['ticket_created_time'].dt.normalize()
-        print(f"Failed to load {SUPPORT_DATA_CSV}. Generated mock support tickets data.")
+            support_tickets_df = generate_mock_support_tickets()
+            support_tickets_df['ticket_created_time'] = pd.to_datetime(support_tickets_df['ticket_created_time'], errors='coerce')
+            support_tickets_df['ticket_created_date'] = support_tickets_df['ticket_created_time'].dt.normalize()
+            logger.warning(f"Failed to load {SUPPORT_DATA_CSV}. Generated mock support tickets data.")
+
+        return support_tickets_df
+
+    # --- Load Graph ---
+    # Stages run concurrently on a thread pool: the three files are read at once (settlement_data.csv
+    # only once, for both the transactions and settlements stages), support tickets never wait on
+    # anything else, and refunds/settlements only block on transactions when they fall back to mock
+    # data. Stages are submitted after their dependencies, so the FIFO pool cannot deadlock on a
+    # waiting stage. Each stage runs in a copy of the caller's context to keep the load trace.
+    with ThreadPoolExecutor(max_workers=CSV_LOAD_WORKERS, thread_name_prefix='csv-load') as pool:
+        def submit_stage(stage, *args):
+            return pool.submit(contextvars.copy_context().run, stage, *args)
+
+        settlements_raw = submit_stage(_read_csv_source, SETTLEMENTS_CSV)
+        refunds_raw = submit_stage(_read_csv_source, REFUNDS_CSV)
+        support_raw = submit_stage(_read_csv_source, SUPPORT_DATA_CSV)
+        transactions_future = submit_stage(lambda: load_transactions(settlements_raw.result()))
+        support_future = submit_stage(lambda: load_support_tickets(support_raw.result()))
+        refunds_future = submit_stage(lambda: load_refunds(refunds_raw.result(), transactions_future))
+        settlements_future = submit_stage(lambda: load_settlements(settlements_raw.result(), transactions_future))
+        analytics_future = submit_stage(build_analytics_tables) # DuckDB reads the CSVs itself
+
+    transactions_df = transactions_future.result()
+    refunds_df = refunds_future.result()
+    settlements_df = settlements_future.result()
+    support_tickets_df = support_future.result()
 
     # Prepare customer-related DataFrames
     # This merge assumes 'customer_id' is present in transactions_df.
@@ -621,104 +1196,380 @@ def load_data_from_csv():
                 for _ in range(len(transactions_df['customer_id'].unique()))
             ]
         })
-        transactions_df_with_customers = pd.merge(transactions_df, customers_df, on='customer_id', how='left')
+        with timed_block('load_phase_duration_seconds', phase='merge', source='customers'):
+            transactions_df_with_customers = pd.merge(transactions_df, customers_df, on='customer_id', how='left')
     else:
-        print("Warning: 'customer_id' column not found or empty in transactions data. Some customer behavior insights may be limited.")
+        logger.warning("'customer_id' column not found or empty in transactions data. Some customer behavior insights may be limited.")
         customers_df = pd.DataFrame()
         transactions_df_with_customers = transactions_df.copy() # Proceed with transactions_df without customer_id merge
 
+    support_tickets_df = support_tickets_df.reset_index(drop=True) # Row positions double as ticket index doc ids
+
+    publish_snapshot({
+        **build_data_snapshot(transactions_df, refunds_df, settlements_df, support_tickets_df, customers_df, transactions_df_with_customers),
+        'analytics_tables': analytics_future.result()
+    })
+    data_ready.set()
+
+
+def warm_up_data():
+    global data_load_error, _data_load_failed_at, _data_load_running
+    try:
+        with trace_scope('data_load'):
+            load_data_from_csv()
+        data_load_error = _data_load_failed_at = None
+        snapshot = data_snapshot
+        logger.info(f"Data load complete (snapshot v{snapshot['version']}): {len(snapshot['transactions'])} transactions, "
+                    f"{len(snapshot['refunds'])} refunds, {len(snapshot['settlements'])} settlements, "
+                    f"{len(snapshot['support_tickets'])} support tickets.")
+        start_alert_scheduler()
+    except Exception as e:
+        data_load_error = str(e)
+        _data_load_failed_at = time.monotonic()
+        logger.exception(f"Background data load failed: {e}")
+    finally:
+        _data_load_running = False
+
+def data_load_retry_after():
+    # Seconds until a failed load may be retried (0 once it may)
+    if _data_load_failed_at is None:
+        return 0
+    return max(0, int(_data_load_failed_at + DATA_LOAD_RETRY_SECONDS - time.monotonic()) + 1)
+
+def start_background_data_load():
+    # Idempotent: the first caller (startup or, under a WSGI server, the first request) starts the
+    # warm-up. Not started at import, so a server that imports the app before forking workers
+    # (gunicorn --preload) does not leave the load thread behind in the parent.
+    global _data_load_running
+    if data_ready.is_set() or _data_load_running:
+        return
+    with _data_load_lock:
+        if data_ready.is_set() or _data_load_running or data_load_retry_after():
+            return
+        _data_load_running = True
+    threading.Thread(target=warm_up_data, name='data-warmup', daemon=True).start()
+
+
+# --- SQL Analytics Backend ---
+def get_analytics_db():
+    global _analytics_db
+    if _analytics_db is None:
+        with _analytics_db_lock:
+            if _analytics_db is None:
+                import duckdb
+                db = duckdb.connect(ANALYTICS_DB_PATH, config={'memory_limit': ANALYTICS_MEMORY_LIMIT})
+                # The file is only a cache of loaded data: tables left by a previous run are dropped
+                for (table,) in db.execute("SELECT table_name FROM duckdb_tables() WHERE schema_name = 'main'").fetchall():
+                    db.execute(f'DROP TABLE "{table}"')
+                _analytics_db = db
+    return _analytics_db
+
+def analytics_query(sql, params=()):
+    # Connections are not thread-safe; each query gets its own cursor on the shared database
+    cursor = get_analytics_db().cursor()
+    try:
+        return cursor.execute(sql, list(params)).fetchall()
+    finally:
+        cursor.close()
+
+def _sql_status(column, success_label, success_keywords):
+    # The loader's status mapping; NULL (an empty cell) is 'Pending' as the loader's 'nan' is
+    success = " OR ".join(f"contains(upper({column}), '{keyword}')" for keyword in success_keywords)
+    return (f"CASE WHEN {success} THEN '{success_label}' "
+            f"WHEN contains(upper({column}), 'FAILED') OR contains(upper({column}), 'DECLINED') THEN 'Failed' ELSE 'Pending' END")
+
+def _sql_method_code(column):
+    # classify_payment_method as a CASE over METHOD_KEYWORD_RULES (first match wins)
+    rules = " ".join(f"WHEN regexp_matches(upper({column}), '{pattern}') THEN {code}" for pattern, code in METHOD_KEYWORD_RULES)
+    return f"CASE {rules} ELSE {METHOD_OTHER} END"
+
+def _analytics_select_sql(name, source, csv_columns):
+    # SELECT producing ANALYTICS_TABLE_COLUMNS[name] from a read_csv source whose columns are all text,
+    # normalized as the pandas loader normalizes the same file
+    renames = TRANSACTIONS_COLUMN_RENAMES if name == 'transactions' else REFUNDS_COLUMN_RENAMES
+    def column(internal):
+        # The CSV column the loader renames to `internal`, else one already called `internal`
+        for csv_name in [old for old, new in renames.items() if new == internal] + [internal]:
+            if csv_name in csv_columns:
+                return '"' + csv_name.replace('"', '""') + '"'
+        return None
+    def text(internal):
+        # The pandas loader fills a missing text column with random values, which SQL cannot reproduce;
+        # such a source stays on pandas rather than showing other merchants and customers than the frames
+        csv_column = column(internal)
+        if csv_column is None:
+            raise ValueError(f"{name} source has no '{internal}' column")
+        return csv_column
+
+    time_column = column('transaction_time' if name == 'transactions' else 'refund_date')
+    if time_column is None:
+        raise ValueError(f"no date column for {name}")
+    formats = ", ".join(f"'{fmt}'" for fmt in COMMON_DATE_FORMATS)
+    moment = f"COALESCE(TRY_CAST({time_column} AS TIMESTAMP), try_strptime({time_column}, [{formats}]))"
+    status = column('status')
+    amount = column('amount')
+    amount_paise = f"COALESCE(round_even(TRY_CAST({amount} AS DOUBLE) * 100, 0), 0)::BIGINT" if amount else "0::BIGINT"
+
+    if name == 'transactions':
+        status_sql = _sql_status(status, 'Success', TRANSACTION_SUCCESS_KEYWORDS) if status else "'Unknown'"
+        method_groups = " ".join(f"WHEN {code} THEN {bits}" for code, bits in METHOD_GROUPS.items())
+        rows = f"""
+            SELECT *, CASE method_code {method_groups} END::TINYINT AS method_groups
+            FROM (
+                SELECT date_trunc('day', moment) AS transaction_date, transaction_id, merchant_display_name, customer_id,
+                       status, payment_method, ({_sql_method_code('payment_method')})::TINYINT AS method_code, amount_paise
+                FROM (
+                    SELECT {moment} AS moment, {text('transaction_id')} AS transaction_id,
+                           {text('merchant_display_name')} AS merchant_display_name, {text('customer_id')} AS customer_id,
+                           {status_sql} AS status, {text('payment_method')} AS payment_method, {amount_paise} AS amount_paise
+                    FROM {source}
+                ) WHERE moment IS NOT NULL
+            )"""
+    else:
+        status_sql = _sql_status(status, 'Completed', REFUND_COMPLETED_KEYWORDS) if status else "'Unknown'"
+        rows = f"""
+            SELECT * FROM (
+                SELECT {moment} AS refund_date, {text('merchant_display_name')} AS merchant_display_name,
+                       {status_sql} AS status, {amount_paise} AS amount_paise
+                FROM {source}
+            ) WHERE refund_date IS NOT NULL"""
+    columns = ANALYTICS_TABLE_COLUMNS[name]
+    return f"SELECT {', '.join(columns)} FROM ({rows}) ORDER BY {columns[0]}"
+
+def _create_analytics_table(db, table, name, path):
+    import duckdb
+    quoted_path = path.replace("'", "''")
+    for encoding in ('utf-8', 'latin-1'): # The loader's encoding fallbacks (cp1252 text reads as latin-1)
+        source = f"read_csv('{quoted_path}', header = true, all_varchar = true, encoding = '{encoding}')"
+        try:
+            csv_columns = [row[0] for row in db.execute(f"DESCRIBE SELECT * FROM {source}").fetchall()]
+            db.execute(f'CREATE OR REPLACE TABLE "{table}" AS {_analytics_select_sql(name, source, csv_columns)}')
+            break
+        except duckdb.InvalidInputException: # Not valid in this encoding
+            if encoding == 'latin-1':
+                raise
+    if db.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0] == 0:
+        raise ValueError(f"{path} has no rows with a readable date")
+
+def write_analytics_tables():
+    # Reads the CSV sources straight into DuckDB, so the tables never pass through pandas and can
+    # outgrow memory. Returns {'transactions': table, 'refunds': table} with a fresh name per load, so
+    # requests pinned to the previous snapshot keep reading its tables until the generation after next drops them.
+    db = get_analytics_db()
+    generation = uuid.uuid4().hex[:12]
+    tables = {}
+    with _analytics_db_lock:
+        try:
+            for name, path in (('transactions', SETTLEMENTS_CSV), ('refunds', REFUNDS_CSV)):
+                tables[name] = f"{name}_{generation}"
+                _create_analytics_table(db, tables[name], name, path)
+        except Exception:
+            for table in tables.values():
+                db.execute(f'DROP TABLE IF EXISTS "{table}"')
+            raise
+        _analytics_table_generations.append(tables)
+        while len(_analytics_table_generations) > 2:
+            for table in _analytics_table_generations.popleft().values():
+                db.execute(f'DROP TABLE IF EXISTS "{table}"')
+    return tables
+
+def build_analytics_tables():
+    # Load stage for ANALYTICS_BACKEND=duckdb, run alongside the pandas stages: the new snapshot's
+    # 'analytics_tables', or None to keep the pandas helpers. tests/test_analytics_backends.py checks
+    # the SQL-backed helpers against the pandas path.
+    if ANALYTICS_BACKEND != 'duckdb':
+        return None
+    if importlib.util.find_spec('duckdb') is None:
+        logger.warning("ANALYTICS_BACKEND=duckdb but the duckdb package is not installed; using pandas.")
+        return None
+    try:
+        with timed_block('load_phase_duration_seconds', phase='analytics_tables', source=ANALYTICS_DB_PATH):
+            tables = write_analytics_tables()
+    except Exception as e:
+        logger.warning(f"Could not build DuckDB analytics tables ({e}); using pandas.")
+        return None
+    logger.info(f"Analytics backend: DuckDB tables {tables['transactions']} and {tables['refunds']} in {ANALYTICS_DB_PATH}.")
+    return tables
+
+def sql_tables():
+    # Tables of the pinned snapshot, or None when helpers should use pandas
+    return get_snapshot().get('analytics_tables')
+
+def _sql_merchant_filter(params):
+    merchant = get_active_merchant()
+    if merchant is None:
+        return ""
+    params.append(merchant)
+    return " AND merchant_display_name = ?"
+
+def _sql_method_filter(method_keyword, params):
+    # Same rule as payment_method_mask, on the stored taxonomy columns
+    group_bit = METHOD_GROUP_KEYWORDS.get(method_keyword.lower())
+    if group_bit is not None:
+        params.append(int(group_bit))
+        return "(method_groups & ?) != 0"
+    params.append(int(classify_payment_method(method_keyword)))
+    return "method_code = ?"
+
+def _day_range(start_date, end_date):
+    # [start, end] in whole days as timestamps, so the date column filter is a pushed-down range
+    return (datetime.datetime.combine(start_date, datetime.time()),
+            datetime.datetime.combine(end_date + datetime.timedelta(days=1), datetime.time()))
+
+def sql_total_amount_received(tables, target_date):
+    params = list(_day_range(target_date, target_date))
+    where = "transaction_date >= ? AND transaction_date < ? AND status = 'Success'" + _sql_merchant_filter(params)
+    return int(analytics_query(f'SELECT COALESCE(SUM(amount_paise), 0) FROM "{tables["transactions"]}" WHERE {where}', params)[0][0])
+
+def sql_completed_refunds(tables, start_date, end_date):
+    params = list(_day_range(start_date, end_date))
+    where = "refund_date >= ? AND refund_date < ? AND status = 'Completed'" + _sql_merchant_filter(params)
+    count, amount_paise = analytics_query(f'SELECT COUNT(*), COALESCE(SUM(amount_paise), 0) FROM "{tables["refunds"]}" WHERE {where}', params)[0]
+    return int(count), int(amount_paise)
+
+def sql_payment_method_performance(tables, start_date, end_date):
+    params = list(_day_range(start_date, end_date))
+    where = ("transaction_date >= ? AND transaction_date < ? AND status = 'Success' AND payment_method IS NOT NULL"
+             + _sql_merchant_filter(params))
+    rows = analytics_query(
+        f'SELECT payment_method, SUM(amount_paise), COUNT(transaction_id) FROM "{tables["transactions"]}" '
+        f'WHERE {where} GROUP BY payment_method ORDER BY 2 DESC, 1', params
+    )
+    return [
+        {'payment_method': method, 'total_amount_paise': int(total), 'num_transactions': int(count),
+         'avg_transaction_value_paise': int(total) // int(count)}
+        for method, total, count in rows
+    ]
+
+def sql_customer_payment_stats(tables, payment_method):
+    # Same figures as the pandas path of analyze_customer_payment_behavior, in one scan
+    params = []
+    method_filter = _sql_method_filter(payment_method, params)
+    merchant_params = []
+    merchant_filter = _sql_merchant_filter(merchant_params)
+    row = analytics_query(f"""
+        WITH relevant AS (
+            SELECT customer_id, transaction_id, amount_paise, ({method_filter}) AS is_method
+            FROM "{tables['transactions']}"
+            WHERE status = 'Success' AND customer_id IS NOT NULL AND payment_method IS NOT NULL{merchant_filter}
+        ), per_customer AS (
+            SELECT customer_id, COUNT(transaction_id) AS all_count,
+                   COUNT(transaction_id) FILTER (WHERE is_method) AS method_count,
+                   BOOL_OR(is_method) AS used_method
+            FROM relevant GROUP BY customer_id
+        )
+        SELECT (SELECT COUNT(*) FROM relevant),
+               (SELECT COUNT(*) FROM relevant WHERE is_method),
+               COUNT(*) FILTER (WHERE used_method),
+               COUNT(*) FILTER (WHERE method_count > 1),
+               (SELECT AVG(amount_paise) FROM relevant WHERE is_method),
+               (SELECT AVG(amount_paise) FROM relevant),
+               COUNT(*),
+               COUNT(*) FILTER (WHERE all_count > 1)
+        FROM per_customer
+    """, params + merchant_params)[0]
+    keys = ('relevant_rows', 'method_rows', 'method_customers', 'method_repeat_customers',
+            'method_avg_paise', 'overall_avg_paise', 'overall_customers', 'overall_repeat_customers')
+    return dict(zip(keys, row))
+
+def sql_status_counts(tables):
+    params = []
+    where = "TRUE" + _sql_merchant_filter(params)
+    total, successful = analytics_query(
+        f"""SELECT COUNT(*), COUNT(*) FILTER (WHERE status = 'Success') FROM "{tables['transactions']}" WHERE {where}""", params
+    )[0]
+    return int(total), int(successful)
+
 
 # --- Helper Functions for Data Retrieval & Analysis ---
 # (No changes to helper functions, as their logic was sound, the problem was data types into them)
+@instrumented_helper
 def get_total_amount_received(date_obj=None):
+    transactions_df = get_scoped_frame('transactions')
     # Ensure date_obj is a date object for comparison
     if date_obj and isinstance(date_obj, datetime.datetime):
         target_date = date_obj.date()
     else:
         target_date = date_obj if date_obj else datetime.date.today()
 
-    # Ensure transaction_date is of datetime.date type by converting to datetime64[ns] and then .dt.date
+    tables = sql_tables()
+    if tables:
+        return sql_total_amount_received(tables, target_date)
+
     if not transactions_df.empty and 'transaction_date' in transactions_df.columns:
-        # Convert to datetime64[ns] (if not already) then extract date part
-        if not pd.api.types.is_datetime64_any_dtype(transactions_df['transaction_date']):
-             transactions_df['transaction_date'] = pd.to_datetime(transactions_df['transaction_date'], errors='coerce').dt.normalize()
         # Filter using the .dt.date accessor
         daily_transactions = transactions_df[
             (transactions_df['transaction_date'].dt.date == target_date) &
             (transactions_df['status'] == 'Success')
         ]
     else: # If transaction_date column is missing or empty
-        print("DEBUG: 'transaction_date' column not found or empty in transactions_df.")
-        return 0.0
+        trace_event("'transaction_date' column not found or empty in transactions_df.")
+        return 0
 
     if daily_transactions.empty:
-        print(f"DEBUG: No successful transactions found for date {target_date.isoformat()}")
-        return 0.0 # Return 0.0 if no matching data
-    print(f"DEBUG: Found {daily_transactions.shape[0]} successful transactions for date {target_date.isoformat()}")
-    return daily_transactions['amount'].sum()
+        trace_event("No successful transactions found", date=target_date.isoformat())
+        return 0 # Return 0 paise if no matching data
+    trace_event("Found successful transactions", date=target_date.isoformat(), count=daily_transactions.shape[0])
+    return int(daily_transactions['amount_paise'].sum())
 
+@instrumented_helper
 def get_refunds_yesterday():
+    refunds_df = get_scoped_frame('refunds')
     yesterday = datetime.date.today() - datetime.timedelta(days=1)
-    
-    # Ensure refunds_df 'refund_date' is a datetime object and then extract date part
-    if not refunds_df.empty and 'refund_date' in refunds_df.columns:
-        if not pd.api.types.is_datetime64_any_dtype(refunds_df['refund_date']):
-            refunds_df['refund_date'] = pd.to_datetime(refunds_df['refund_date'], errors='coerce').dt.normalize()
-        refunds_df.dropna(subset=['refund_date'], inplace=True) # Drop rows where date parsing failed
-    else:
-        return 0, 0.0 # No refund data available
+
+    tables = sql_tables()
+    if tables:
+        return sql_completed_refunds(tables, yesterday, yesterday)
+
+    if refunds_df.empty or 'refund_date' not in refunds_df.columns:
+        return 0, 0 # No refund data available
 
     daily_refunds = refunds_df[
         (refunds_df['refund_date'].dt.date == yesterday) & # Compare date parts only
         (refunds_df['status'] == 'Completed')
     ]
-    refund_amount = daily_refunds['amount'].sum() if not daily_refunds.empty else 0.0
-    return daily_refunds.shape[0], refund_amount
+    refund_amount_paise = int(daily_refunds['amount_paise'].sum())
+    return daily_refunds.shape[0], refund_amount_paise
 
+@instrumented_helper
 def get_payment_method_performance(period='week'):
+    transactions_df = get_scoped_frame('transactions')
     end_date = datetime.date.today()
-    if period == 'week':
-        start_date = end_date - datetime.timedelta(weeks=1)
-    elif period == 'month':
-        start_date = end_date - datetime.timedelta(days=30)
-    else:
-        start_date = end_date - datetime.timedelta(weeks=1)
+    start_date = end_date - datetime.timedelta(days=PERIOD_LOOKBACK_DAYS.get(period, 7))
+
+    tables = sql_tables()
+    if tables:
+        return sql_payment_method_performance(tables, start_date, end_date)
 
-    # Ensure transaction_date is a date object for comparison
     if not transactions_df.empty and 'transaction_date' in transactions_df.columns:
-        if not pd.api.types.is_datetime64_any_dtype(transactions_df['transaction_date']):
-             transactions_df['transaction_date'] = pd.to_datetime(transactions_df['transaction_date'], errors='coerce').dt.normalize()
-        
         filtered_transactions = transactions_df[
             (transactions_df['transaction_date'].dt.date >= start_date) &
             (transactions_df['transaction_date'].dt.date <= end_date) &
             (transactions_df['status'] == 'Success')
         ]
     else:
-        print("DEBUG: 'transaction_date' column not found or empty in transactions_df for payment method performance.")
+        trace_event("'transaction_date' column not found or empty in transactions_df for payment method performance.")
         return []
 
     if filtered_transactions.empty:
         return []
 
     performance = filtered_transactions.groupby('payment_method').agg(
-        total_amount=('amount', 'sum'),
+        total_amount_paise=('amount_paise', 'sum'),
         num_transactions=('transaction_id', 'count')
     ).reset_index()
 
-    performance['avg_transaction_value'] = performance['total_amount'] / performance['num_transactions']
-    performance = performance.sort_values(by='total_amount', ascending=False)
+    performance['avg_transaction_value_paise'] = performance['total_amount_paise'] // performance['num_transactions']
+    performance = performance.sort_values(by='total_amount_paise', ascending=False)
     return performance.to_dict(orient='records')
 
+@instrumented_helper
 def analyze_refund_spike_root_cause(date_obj=None):
+    refunds_df = get_scoped_frame('refunds')
+    transactions_df = get_scoped_frame('transactions')
     target_date = date_obj if date_obj else datetime.date.today() - datetime.timedelta(days=1)
 
-    # Ensure refunds_df 'refund_date' is a datetime object and then extract date part
-    if not refunds_df.empty and 'refund_date' in refunds_df.columns:
-        if not pd.api.types.is_datetime64_any_dtype(refunds_df['refund_date']):
-            refunds_df['refund_date'] = pd.to_datetime(refunds_df['refund_date'], errors='coerce').dt.normalize()
-        refunds_df.dropna(subset=['refund_date'], inplace=True) # Drop rows where date parsing failed
-    else:
+    if refunds_df.empty or 'refund_date' not in refunds_df.columns:
         return f"No refund data available to analyze spike on {target_date.isoformat()}."
 
     daily_refunds = refunds_df[
@@ -771,69 +1622,149 @@ def analyze_refund_spike_root_cause(date_obj=None):
                 "There are no immediate indications of a specific widespread technical issue (like gateway timeouts) "
                 "directly linked to these refunds in the transaction data. Consider reviewing customer feedback or product/service quality for the affected period.")
 
-def analyze_payment_method_trend(method_keyword='Mobile', period='week'):
-    end_date = datetime.date.today()
-    if period == 'week':
-        start_date = end_date - datetime.timedelta(weeks=1)
-    elif period == 'month':
-        start_date = end_date - datetime.timedelta(days=30)
-    else:
-        start_date = end_date - datetime.timedelta(weeks=1)
+@instrumented_helper
+def scan_refund_spikes(start_date=None, end_date=None, limit=10):
+    # Ranks the completed-refund spike days between start_date and end_date (default: the whole history),
+    # worst first. Daily counts and amounts for the entire history come from one bincount pass; each day
+    # is scored against the trailing REFUND_SPIKE_BASELINE_DAYS days before it (median and interquartile
+    # spread), so weekly patterns and slow growth don't read as spikes. Returns a list of dicts.
+    refunds_df = get_scoped_frame('refunds')
+    if refunds_df.empty or 'refund_date' not in refunds_df.columns:
+        return []
+    completed = refunds_df[(refunds_df['status'] == 'Completed') & refunds_df['refund_date'].notna()]
+    if completed.empty:
+        return []
 
-    # Ensure transaction_date is a date object for comparison
-    if not transactions_df.empty and 'transaction_date' in transactions_df.columns:
-        if not pd.api.types.is_datetime64_any_dtype(transactions_df['transaction_date']):
-             transactions_df['transaction_date'] = pd.to_datetime(transactions_df['transaction_date'], errors='coerce').dt.normalize()
-        
-        filtered_transactions = transactions_df[
-            (transactions_df['transaction_date'].dt.date >= start_date) &
-            (transactions_df['transaction_date'].dt.date <= end_date) &
-            (transactions_df['status'] == 'Success')
-        ]
-    else:
-        print("DEBUG: 'transaction_date' column not found or empty in transactions_df for payment method performance.")
-        return {
-            "answer": "No transaction data available to analyze payment method trend.",
-            "chartData": {"labels": [], "data": [], "type": "line"}
+    days = completed['refund_date'].to_numpy().astype('datetime64[D]')
+    first_day = days.min()
+    day_offsets = (days - first_day).astype(np.int64)
+    amounts = completed['amount_paise'].to_numpy()
+    daily = pd.DataFrame({
+        'refunds': np.bincount(day_offsets),
+        'amount_paise': np.bincount(day_offsets, weights=amounts)
+    }, index=pd.date_range(first_day, periods=day_offsets.max() + 1, freq='D'))
+
+    # Baselines only look at earlier days: the rolling window ends on the previous day
+    window = daily.rolling(REFUND_SPIKE_BASELINE_DAYS, min_periods=REFUND_SPIKE_MIN_BASELINE_DAYS)
+    baseline = window.median().shift(1)
+    spread = ((window.quantile(0.75) - window.quantile(0.25)) / 1.349).shift(1) # IQR as a standard deviation
+    # Quiet baselines have no spread; fall back to Poisson noise: sqrt(n) refunds of a typical amount each
+    expected_noise = np.sqrt(baseline['refunds'].clip(lower=1))
+    count_scale = np.maximum(spread['refunds'], expected_noise)
+    amount_scale = np.maximum(spread['amount_paise'], expected_noise * amounts.mean())
+    scores = np.maximum((daily['refunds'] - baseline['refunds']) / count_scale,
+                        (daily['amount_paise'] - baseline['amount_paise']) / amount_scale)
+
+    in_range = baseline['refunds'].notna() & (daily['refunds'] > baseline['refunds']) & (scores >= REFUND_SPIKE_MIN_SCORE)
+    if start_date:
+        in_range &= daily.index >= pd.Timestamp(start_date)
+    if end_date:
+        in_range &= daily.index <= pd.Timestamp(end_date)
+    spike_offsets = np.flatnonzero(in_range.to_numpy())
+    spike_offsets = spike_offsets[np.argsort(-scores.to_numpy()[spike_offsets], kind='stable')][:limit]
+    if len(spike_offsets) == 0:
+        return []
+
+    # Reasons and gateway-timeout links for the ranked days only, again as (rank, value) bincounts
+    rank_of_day = np.full(len(daily), -1)
+    rank_of_day[spike_offsets] = np.arange(len(spike_offsets))
+    spike_rows = completed[rank_of_day[day_offsets] >= 0]
+    spike_ranks = rank_of_day[day_offsets[rank_of_day[day_offsets] >= 0]]
+
+    reason_counts = np.zeros((len(spike_offsets), 0), dtype=np.int64)
+    reason_names = []
+    if 'reason' in spike_rows.columns:
+        reason_codes, reason_names = pd.factorize(spike_rows['reason'])
+        known = reason_codes >= 0
+        reason_counts = np.bincount(spike_ranks[known] * len(reason_names) + reason_codes[known],
+                                    minlength=len(spike_offsets) * len(reason_names)).reshape(len(spike_offsets), len(reason_names))
+
+    linked_counts = np.zeros(len(spike_offsets), dtype=np.int64)
+    peak_hours = [None] * len(spike_offsets)
+    transactions_df = get_scoped_frame('transactions')
+    if {'gateway_timeout', 'transaction_time'} <= set(transactions_df.columns) and 'transaction_id' in spike_rows.columns:
+        timeouts = transactions_df.loc[
+            transactions_df['gateway_timeout'].astype(bool) & transactions_df['transaction_time'].notna(),
+            ['transaction_id', 'transaction_time']
+        ].drop_duplicates('transaction_id')
+        linked = pd.merge(pd.DataFrame({'rank': spike_ranks, 'transaction_id': spike_rows['transaction_id'].to_numpy()}),
+                          timeouts, on='transaction_id')
+        linked_counts = np.bincount(linked['rank'], minlength=len(spike_offsets))
+        hour_counts = np.bincount(linked['rank'] * 24 + linked['transaction_time'].dt.hour,
+                                  minlength=len(spike_offsets) * 24).reshape(len(spike_offsets), 24)
+        peak_hours = [int(hours.argmax()) if hours.any() else None for hours in hour_counts]
+
+    spikes = []
+    for rank, offset in enumerate(spike_offsets):
+        refunds = int(daily['refunds'].iat[offset])
+        top_reasons = np.argsort(-reason_counts[rank], kind='stable')[:2] if len(reason_names) else []
+        spikes.append({
+            'date': daily.index[offset].date(),
+            'refunds': refunds,
+            'amount_paise': int(daily['amount_paise'].iat[offset]),
+            'baseline_refunds': float(baseline['refunds'].iat[offset]),
+            'baseline_amount_paise': float(baseline['amount_paise'].iat[offset]),
+            'score': float(scores.iat[offset]),
+            'reasons': [(reason_names[i], int(reason_counts[rank, i]) / refunds) for i in top_reasons if reason_counts[rank, i]],
+            'gateway_timeout_refunds': int(linked_counts[rank]),
+            'gateway_timeout_peak_hour': peak_hours[rank]
+        })
+    return spikes
+
+@instrumented_helper
+def summarize_refund_spikes(period=None, limit=5):
+    # /ask answer and chart for "worst refund days"; period is a PERIOD_LOOKBACK_DAYS key or None for all history
+    end_date = datetime.date.today()
+    start_date = end_date - datetime.timedelta(days=PERIOD_LOOKBACK_DAYS[period]) if period else None
+    spikes = scan_refund_spikes(start_date, end_date if period else None, limit)
+    span = f"in the last {period}" if period else "in your refund history"
+    if not spikes:
+        return {"answer": f"No completed refund spikes stand out {span}: every day is within the normal range of the days before it.", "chartData": {}}
+
+    lines = []
+    for spike in spikes:
+        reasons = ", ".join(f"'{reason}' ({share:.0%})" for reason, share in spike['reasons']) or "unrecorded reasons"
+        line = (f"- **{spike['date'].isoformat()}**: {spike['refunds']:,} refunds totaling {format_rupees(spike['amount_paise'])} "
+                f"(usually {spike['baseline_refunds']:.0f}), mostly {reasons}")
+        if spike['gateway_timeout_refunds']:
+            line += (f"; {spike['gateway_timeout_refunds']} linked to gateway timeouts"
+                     f"{' around ' + str(spike['gateway_timeout_peak_hour']) + ':00' if spike['gateway_timeout_peak_hour'] is not None else ''}")
+        lines.append(line)
+    return {
+        "answer": f"Your worst completed refund days {span}, ranked by how far they exceed the preceding {REFUND_SPIKE_BASELINE_DAYS} days:<br>" + "<br>".join(lines),
+        "chartData": {
+            "labels": [spike['date'].isoformat() for spike in spikes],
+            "data": [spike['refunds'] for spike in spikes],
+            "type": "bar"
         }
+    }
+
+@instrumented_helper
+def analyze_payment_method_trend(method_keyword='Mobile', period='week'):
+    # Daily amounts come from the pre-bucketed 'day' index rather than a groupby over raw transactions
+    end_date = datetime.date.today()
+    start_date = end_date - datetime.timedelta(days=PERIOD_LOOKBACK_DAYS.get(period, 7))
 
-    method_name = method_keyword
     if method_keyword.lower() == 'mobile':
-        method_transactions = filtered_transactions[
-            (filtered_transactions['payment_method'].str.contains('UPI|Wallet', case=False, na=False))
-        ]
         method_name = "mobile payments (UPI and Wallets)"
     else:
-        method_transactions = filtered_transactions[filtered_transactions['payment_method'].str.contains(method_keyword, case=False, na=False)]
         method_name = f"{method_keyword} payments"
 
-    if method_transactions.empty:
+    daily_amounts = get_bucketed_series('transactions', start_date, end_date, 'day', method_keyword, 'Success', 'amount_paise')
+    if daily_amounts.empty:
         return {
             "answer": f"No successful {method_name} found for the selected period ({start_date.isoformat()} to {end_date.isoformat()}).",
             "chartData": {"labels": [], "data": [], "type": "line"}
         }
 
-    daily_amounts = method_transactions.groupby(transactions_df['transaction_date'].dt.date)['amount'].sum().reset_index()
-    daily_amounts.columns = ['date', 'total_amount']
-    daily_amounts = daily_amounts.sort_values('date')
-
     # Calculate previous period for comparison
     time_delta = end_date - start_date
     previous_period_start = start_date - (time_delta + datetime.timedelta(days=1))
     previous_period_end = start_date - datetime.timedelta(days=1)
+    previous_amounts = get_bucketed_series('transactions', previous_period_start, previous_period_end, 'day', method_keyword, 'Success', 'amount_paise')
 
-    prev_filtered_transactions = transactions_df[
-        (transactions_df['transaction_date'].dt.date >= previous_period_start) &
-        (transactions_df['transaction_date'].dt.date <= previous_period_end) &
-        (transactions_df['status'] == 'Success')
-    ]
-    prev_method_transactions = prev_filtered_transactions[
-        (prev_filtered_transactions['payment_method'].str.contains(method_keyword, case=False, na=False)) |
-        (method_keyword.lower() == 'mobile' and (prev_filtered_transactions['payment_method'].str.contains('UPI|Wallet', case=False, na=False)))
-    ]
-
-    current_period_sum = method_transactions['amount'].sum()
-    previous_period_sum = prev_method_transactions['amount'].sum()
+    current_period_sum = daily_amounts.sum()
+    previous_period_sum = previous_amounts.sum()
 
     change_percent = 0
     if previous_period_sum > 0:
@@ -849,45 +1780,62 @@ def analyze_payment_method_trend(method_keyword='Mobile', period='week'):
 
     answer = f"{trend_message}<br>Here's a breakdown of daily successful transactions for {method_name} over the last {period}:"
 
-    chart_labels = [d.isoformat() for d in daily_amounts['date']]
-    chart_data = daily_amounts['total_amount'].tolist()
-
     return {
         "answer": answer,
-        "chartData": {"labels": chart_labels, "data": chart_data, "type": "line"}
+        "chartData": build_series_chart(daily_amounts, 'day', 'line', in_rupees=True)
     }
 
-def analyze_customer_payment_behavior(payment_method='UPI'):
-    # Ensure customer_id is available before proceeding with merge
-    if 'customer_id' not in transactions_df.columns:
-        return "Customer ID data is not available to analyze customer behavior."
-
+def _customer_payment_stats(transactions_df_with_customers, payment_method):
+    # Counts and averages behind analyze_customer_payment_behavior (sql_customer_payment_stats is the SQL twin)
     relevant_transactions = transactions_df_with_customers[
         transactions_df_with_customers['status'] == 'Success'
     ].dropna(subset=['customer_id', 'payment_method'])
+    method_transactions = relevant_transactions[payment_method_mask(relevant_transactions, payment_method)]
+    transactions_per_customer = method_transactions.groupby('customer_id')['transaction_id'].count()
+    return {
+        'relevant_rows': len(relevant_transactions),
+        'method_rows': len(method_transactions),
+        'method_customers': method_transactions['customer_id'].nunique(),
+        'method_repeat_customers': int((transactions_per_customer > 1).sum()),
+        'method_avg_paise': method_transactions['amount_paise'].mean(),
+        'overall_avg_paise': relevant_transactions['amount_paise'].mean(),
+        'overall_customers': relevant_transactions['customer_id'].nunique(),
+        'overall_repeat_customers': int((relevant_transactions.groupby('customer_id')['transaction_id'].count() > 1).sum())
+    }
 
-    if relevant_transactions.empty:
-        return "No successful transactions found to analyze customer behavior."
+@instrumented_helper
+def analyze_customer_payment_behavior(payment_method='UPI'):
+    sketches = get_sketches()
+    tables = sql_tables()
+    if sketches:
+        stats = sketch_customer_payment_stats(sketches, payment_method)
+    elif tables:
+        stats = sql_customer_payment_stats(tables, payment_method)
+    else:
+        transactions_df = get_scoped_frame('transactions')
+        # Ensure customer_id is available before proceeding with merge
+        if 'customer_id' not in transactions_df.columns:
+            return "Customer ID data is not available to analyze customer behavior."
+        stats = _customer_payment_stats(get_scoped_frame('transactions_with_customers'), payment_method)
 
-    method_transactions = relevant_transactions[relevant_transactions['payment_method'].str.contains(payment_method, case=False, na=False)]
+    if stats['relevant_rows'] == 0:
+        return "No successful transactions found to analyze customer behavior."
 
-    if method_transactions.empty:
+    if stats['method_rows'] == 0:
         return f"No successful transactions found for {payment_method} to analyze customer behavior."
 
-    total_customers_for_method = method_transactions['customer_id'].nunique()
+    total_customers_for_method = stats['method_customers']
     if total_customers_for_method == 0:
         return f"No distinct customers using {payment_method} found for repeat rate analysis."
 
-    transactions_per_customer = method_transactions.groupby('customer_id')['transaction_id'].count()
-    repeat_customers = transactions_per_customer[transactions_per_customer > 1].index
-    num_repeat_customers = len(repeat_customers)
+    num_repeat_customers = stats['method_repeat_customers']
 
     repeat_rate = (num_repeat_customers / total_customers_for_method) * 100 if total_customers_for_method > 0 else 0
 
-    avg_order_value = method_transactions['amount'].mean()
+    avg_order_value = stats['method_avg_paise']
 
-    overall_avg_order_value = relevant_transactions['amount'].mean()
-    overall_repeat_rate = (relevant_transactions.groupby('customer_id')['transaction_id'].count() > 1).sum() / relevant_transactions['customer_id'].nunique() * 100 if relevant_transactions['customer_id'].nunique() > 0 else 0
+    overall_avg_order_value = stats['overall_avg_paise']
+    overall_repeat_rate = stats['overall_repeat_customers'] / stats['overall_customers'] * 100 if stats['overall_customers'] > 0 else 0
 
     aov_comparison = ""
     if overall_avg_order_value > 0:
@@ -906,13 +1854,24 @@ def analyze_customer_payment_behavior(payment_method='UPI'):
             repeat_rate_comparison = f"This is **{abs(repeat_rate_diff_percent):.2f}% lower** than your overall repeat rate."
 
 
+    approximate_note = ""
+    if sketches:
+        repeat_rate_bound = stats['repeat_rate_bound']
+        approximate_note = (f" _Approximate answer from sketches: repeat rates are within ±{repeat_rate_bound:.2f} percentage points (95% confidence); average order values are exact._"
+                            if repeat_rate_bound else " _Answered from sketches; at this data size the figures are exact._")
+
     return (f"Customers who pay via **{payment_method}** have a repeat rate of **{repeat_rate:.2f}%** ({repeat_rate_comparison}). "
-            f"Their average order value is **₹{avg_order_value:,.2f}** ({aov_comparison}). "
-            f"This suggests {payment_method} users are often valuable customers.")
+            f"Their average order value is **{format_rupees(avg_order_value)}** ({aov_comparison}). "
+            f"This suggests {payment_method} users are often valuable customers.{approximate_note}")
 
+@instrumented_helper
 def generate_emi_recommendation(min_order_value=5000):
+    sketches = get_sketches()
+    if sketches:
+        return _approximate_emi_recommendation(sketches, min_order_value)
+    transactions_df = get_scoped_frame('transactions')
     high_value_transactions = transactions_df[
-        (transactions_df['amount'] >= min_order_value) &
+        (transactions_df['amount_paise'] >= rupees_to_paise(min_order_value)) &
         (transactions_df['status'] == 'Success')
     ]
 
@@ -923,15 +1882,45 @@ def generate_emi_recommendation(min_order_value=5000):
     top_categories_str = ", ".join(top_categories) if top_categories else "various categories"
 
     potential_uplift_percent = random.uniform(5, 15)
-    estimated_boost_value = high_value_transactions['amount'].sum() * (potential_uplift_percent / 100)
+    estimated_boost_paise = high_value_transactions['amount_paise'].sum() * (potential_uplift_percent / 100)
 
     return (f"Consider enabling **EMI (Equated Monthly Installment) options for orders above ₹{min_order_value:,}**. "
             f"This can significantly boost conversions for high-value purchases, especially in categories like **{top_categories_str}**. "
             f"We estimate this could lead to a **{potential_uplift_percent:.2f}% increase in conversions** for eligible orders, "
-            f"potentially unlocking **₹{estimated_boost_value:,.2f}** in additional sales annually. "
+            f"potentially unlocking **{format_rupees(estimated_boost_paise)}** in additional sales annually. "
             "Many customers prefer flexible payment options for larger purchases.")
 
+def _approximate_emi_recommendation(sketches, min_order_value):
+    # generate_emi_recommendation answered from the snapshot's sketches, with the error bounds stated
+    high_value = sketch_high_value_orders(sketches, rupees_to_paise(min_order_value))
+    if round(high_value['orders']) == 0:
+        return f"No high-value successful transactions (above ₹{min_order_value:,}) to analyze for EMI recommendations. Consider lowering the minimum order value for analysis."
+
+    top_categories = list(high_value['top_keys'].get('product_category', {}).get('candidates', {}))[:3]
+    top_categories_str = ", ".join(top_categories) if top_categories else "various categories"
+    top_cities = list(high_value['top_keys'].get('city', {}).get('candidates', {}))[:2]
+    top_methods = list(high_value['top_keys'].get('payment_method', {}).get('candidates', {}))[:2]
+
+    potential_uplift_percent = random.uniform(5, 15)
+    estimated_boost_paise = high_value['amount_paise'] * (potential_uplift_percent / 100)
+    count_bound = max((top['count_bound'] for top in high_value['top_keys'].values()), default=0)
+    ranked_from = high_value['band_start_paise']
+
+    answer = (f"Consider enabling **EMI (Equated Monthly Installment) options for orders above ₹{min_order_value:,}**. "
+              f"These are about **{high_value['share_of_orders']:.1f}%** of your successful orders (your median order is about {format_rupees(high_value['median_paise'])}). "
+              f"EMI can significantly boost conversions for high-value purchases, especially in categories like **{top_categories_str}**. ")
+    if top_cities and top_methods:
+        answer += f"Most of these orders come from **{', '.join(top_cities)}** and are paid by **{', '.join(top_methods)}**. "
+    answer += (f"We estimate this could lead to a **{potential_uplift_percent:.2f}% increase in conversions** for eligible orders, "
+               f"potentially unlocking **{format_rupees(estimated_boost_paise)}** in additional sales annually. "
+               "Many customers prefer flexible payment options for larger purchases. "
+               f"_Approximate answer from sketches: the order count is within ±{high_value['orders_bound']:,} and the order total within ±{format_rupees(high_value['amount_bound_paise'])}; "
+               f"rankings count orders from {format_rupees(ranked_from)} up, each overestimated by at most {count_bound:,.0f} orders (99% confidence)._")
+    return answer
+
+@instrumented_helper
 def predict_weekend_transactions():
+    transactions_df = get_scoped_frame('transactions')
     today = datetime.date.today()
     next_saturday = today + datetime.timedelta(days=(5 - today.weekday() + 7) % 7)
     next_sunday = next_saturday + datetime.timedelta(days=1)
@@ -942,11 +1931,7 @@ def predict_weekend_transactions():
         past_saturday = today - datetime.timedelta(days=(today.weekday() + 2) % 7 + (i-1)*7) # Go back to last Sat, then 7 days for previous
         past_sunday = past_saturday + datetime.timedelta(days=1)
 
-        # Ensure transaction_date is of datetime.date type
         if not transactions_df.empty and 'transaction_date' in transactions_df.columns:
-            if not pd.api.types.is_datetime64_any_dtype(transactions_df['transaction_date']):
-                transactions_df['transaction_date'] = pd.to_datetime(transactions_df['transaction_date'], errors='coerce').dt.normalize()
-            
             sat_txns = transactions_df[
                 (transactions_df['transaction_date'].dt.date == past_saturday) &
                 (transactions_df['status'] == 'Success')
@@ -958,7 +1943,7 @@ def predict_weekend_transactions():
             if sat_txns > 0 or sun_txns > 0: # Only add if there was actual data for that weekend
                 weekend_txns_data.extend([sat_txns, sun_txns])
         else:
-            print("DEBUG: 'transaction_date' column not found or empty in transactions_df for weekend prediction.")
+            trace_event("'transaction_date' column not found or empty in transactions_df for weekend prediction.")
             return "Not enough historical weekend data to make a reliable prediction."
 
 
@@ -977,16 +1962,22 @@ def predict_weekend_transactions():
             "Consider optimizing your stock and staffing for potential higher demand!")
 
 
+@instrumented_helper
 def get_success_rate_and_benchmark():
-    total_transactions = transactions_df.shape[0]
-    successful_transactions = transactions_df[transactions_df['status'] == 'Success'].shape[0]
+    tables = sql_tables()
+    if tables:
+        total_transactions, successful_transactions = sql_status_counts(tables)
+    else:
+        success_cube = get_scoped_frame('success_cube')
+        total_transactions = int(success_cube['total'].sum())
+        successful_transactions = int(success_cube['success'].sum())
 
     if total_transactions == 0:
         return "No transactions found to calculate success rate."
 
     success_rate = (successful_transactions / total_transactions) * 100
 
-    industry_average = random.uniform(82, 88)
+    industry_average = SUCCESS_RATE_BENCHMARK
 
     comparison = ""
     if success_rate > industry_average:
@@ -999,14 +1990,79 @@ def get_success_rate_and_benchmark():
     return (f"Your current payment success rate is **{success_rate:.2f}%**. "
             f"{comparison}")
 
+@instrumented_helper
+def analyze_success_rate_segments(method_keyword=None, start_hour=None, end_hour=None, city=None, merchant=None):
+    # Success rate for one slice of the success-rate cube, with the segments adding the most failures
+    scope_parts = [f"{method_keyword} payments" if method_keyword else "all payments"]
+    if start_hour is not None or end_hour is not None:
+        scope_parts.append(f"between {start_hour or 0:02d}:00 and {end_hour if end_hour is not None else 24:02d}:00")
+    if city:
+        scope_parts.append(f"in {city}")
+    if merchant:
+        scope_parts.append(f"for {merchant}")
+    scope = " ".join(scope_parts)
+
+    drilldown = success_rate_drilldown(method_keyword, start_hour, end_hour, city, merchant)
+    if not drilldown['total']:
+        return {"answer": f"No transactions found for {scope}.", "chartData": {}}
+
+    answer = (f"The payment success rate for {scope} is **{drilldown['success_rate']:.2f}%** "
+              f"({drilldown['success']:,} of {drilldown['total']:,} transactions; {drilldown['failed']:,} failed, {drilldown['pending']:,} pending).")
+    if drilldown['failure_segments']:
+        segment_lines = "<br>".join(
+            f"- **{segment['label']}**: {segment['failure_rate']:.2f}% failed ({segment['failed']:,} of {segment['transactions']:,}), "
+            f"{segment['share_of_failures']:.1f}% of all failures here"
+            for segment in drilldown['failure_segments']
+        )
+        answer += f" The segments adding the most failures beyond the average are:<br>{segment_lines}"
+    return {
+        "answer": answer,
+        "chartData": {
+            "labels": list(drilldown['hourly_success_rate']),
+            "data": [round(rate, 2) for rate in drilldown['hourly_success_rate'].values()],
+            "type": "bar"
+        }
+    }
+
+def parse_success_rate_filters(query):
+    # Drill-down filters named in a lowercase /ask query: payment method, an hour range
+    # ("between 14:00 and 16:00", "from 2pm to 4pm"), and a city or merchant from the cube
+    filters = {}
+    for keyword, method in [("mobile", "Mobile"), ("upi", "UPI"), ("credit card", "Credit Card"), ("debit card", "Debit Card"), ("net banking", "Net Banking"), ("wallet", "Wallet")]:
+        if keyword in query:
+            filters['method_keyword'] = method
+            break
+
+    hour_match = re.search(r'(?:between|from)\s+(\d{1,2})(?::(\d{2}))?\s*(am|pm)?\s+(?:and|to|-)\s+(\d{1,2})(?::(\d{2}))?\s*(am|pm)?', query)
+    if hour_match:
+        def to_hour(hour, meridiem):
+            hour = int(hour)
+            if meridiem:
+                hour = hour % 12 + (12 if meridiem == 'pm' else 0)
+            return hour
+        start_hour = to_hour(hour_match.group(1), hour_match.group(3))
+        end_hour = to_hour(hour_match.group(4), hour_match.group(6) or hour_match.group(3))
+        if hour_match.group(5) and hour_match.group(5) != '00':
+            end_hour += 1 # "until 16:30" includes the 16:00 hour
+        if 0 <= start_hour <= 24 and 0 <= end_hour <= 24:
+            filters['start_hour'], filters['end_hour'] = start_hour, end_hour
+
+    success_cube = get_scoped_frame('success_cube')
+    for dimension, name in (('city', 'city'), ('merchant_display_name', 'merchant')):
+        if dimension == 'merchant_display_name' and get_active_merchant() is not None:
+            continue
+        for value in success_cube[dimension].cat.categories:
+            if isinstance(value, str) and value != 'Unknown' and re.search(rf'\b{re.escape(value.lower())}\b', query):
+                filters[name] = value
+                break
+    return filters
+
+@instrumented_helper
 def analyze_transaction_volume_deviation(period='day'):
+    transactions_df = get_scoped_frame('transactions')
     today = datetime.date.today()
     
-    # Ensure 'transaction_date' is a date object for comparison
     if not transactions_df.empty and 'transaction_date' in transactions_df.columns:
-        if not pd.api.types.is_datetime64_any_dtype(transactions_df['transaction_date']):
-            transactions_df['transaction_date'] = pd.to_datetime(transactions_df['transaction_date'], errors='coerce').dt.normalize()
-        
         today_txns = transactions_df[
             (transactions_df['transaction_date'].dt.date == today) &
             (transactions_df['status'] == 'Success')
@@ -1049,146 +2105,2148 @@ def analyze_transaction_volume_deviation(period='day'):
                                 "Investigate potential issues or campaigns affecting sales.")
             }
     else:
-        print("DEBUG: 'transaction_date' column not found or empty in transactions_df for transaction volume deviation.")
+        trace_event("'transaction_date' column not found or empty in transactions_df for transaction volume deviation.")
     return None
 
 
-# --- AI (OpenAI GPT) Integration ---
-def get_ai_response(query, context_data):
+# --- Data Snapshots ---
+# All frames and derived indexes are published together as one read-only snapshot. Writers build
+# a complete new snapshot off to the side and swap the `data_snapshot` reference in one assignment;
+# each request pins the snapshot it started with (g.snapshot), so readers take no locks and never
+# see a half-built reload. Frames inside a snapshot must not be modified: derive new frames instead.
+# The loader guarantees the date columns are datetime64, so handlers never need to coerce them.
+def build_data_snapshot(transactions, refunds, settlements, support_tickets, customers, transactions_with_customers):
+    # One merchant-keyed pass builds both the all-merchants indexes and every partition's indexes
+    time_bucket_indexes, merchant_time_bucket_indexes = split_time_bucket_indexes(
+        compute_time_bucket_indexes(transactions, refunds, by='merchant_display_name'), 'merchant_display_name')
+    success_cube = build_success_cube(transactions)
+    logger.info(f"Built time-bucket indexes: {len(time_bucket_indexes['transactions']['hour'])} hourly transaction buckets, "
+                f"{len(time_bucket_indexes['refunds']['day'])} daily refund buckets.")
+    merchant_partitions = build_merchant_partitions(transactions, refunds, settlements, transactions_with_customers,
+                                                    merchant_time_bucket_indexes, success_cube)
+    return {
+        'transactions': transactions,
+        'refunds': refunds,
+        'settlements': settlements,
+        'support_tickets': support_tickets,
+        'customers': customers,
+        'transactions_with_customers': transactions_with_customers,
+        'time_bucket_indexes': time_bucket_indexes,
+        'merchant_partitions': merchant_partitions,
+        'success_cube': success_cube,
+        'support_ticket_index': build_support_ticket_index(support_tickets)
+    }
+
+def publish_snapshot(contents):
+    # Swaps in a new snapshot built from `contents` (a dict of every snapshot key except version/published_at)
+    global data_snapshot
+    with _snapshot_write_lock:
+        snapshot = MappingProxyType({**contents, 'version': data_snapshot['version'] + 1, 'published_at': time.time()})
+        data_snapshot = snapshot
+    _alerts_wakeup.set() # New data: re-evaluate alerts now rather than at the next interval
+    for frame_name in ('transactions', 'refunds', 'settlements', 'support_tickets', 'customers'):
+        set_gauge('frame_rows', len(snapshot[frame_name]), frame=frame_name)
+    return snapshot
+
+def get_snapshot():
+    # The snapshot pinned by the current request or snapshot_scope, else the latest published one
+    snapshot = _snapshot_scope.get()
+    if snapshot is None and has_request_context():
+        snapshot = g.get('snapshot')
+    return snapshot if snapshot is not None else data_snapshot
+
+@contextmanager
+def snapshot_scope(snapshot=None):
+    # Pins one snapshot for a block of helper calls outside a request, e.g. a background job
+    token = _snapshot_scope.set(snapshot if snapshot is not None else data_snapshot)
+    try:
+        yield
+    finally:
+        _snapshot_scope.reset(token)
+
+
+# --- Per-Merchant Partitions ---
+# Frames are split by merchant_display_name once per snapshot. A request that names a
+# merchant (X-Merchant-Name header or ?merchant=) only ever touches that merchant's rows;
+# requests without a merchant use the snapshot's full frames.
+def _split_by_merchant(df):
+    if df.empty or 'merchant_display_name' not in df.columns:
+        return {}
+    return {merchant: frame for merchant, frame in df.groupby('merchant_display_name', sort=False)}
+
+def build_merchant_partitions(transactions, refunds, settlements, transactions_with_customers, time_bucket_indexes_by_merchant, success_cube):
+    transactions_by_merchant = _split_by_merchant(transactions)
+    refunds_by_merchant = _split_by_merchant(refunds)
+    settlements_by_merchant = _split_by_merchant(settlements)
+    with_customers_by_merchant = _split_by_merchant(transactions_with_customers)
+    cubes_by_merchant = split_success_cube(success_cube)
+
+    partitions = {}
+    for merchant, merchant_transactions in transactions_by_merchant.items():
+        merchant_refunds = refunds_by_merchant.get(merchant, refunds.iloc[0:0])
+        partitions[merchant] = MappingProxyType({
+            'transactions': merchant_transactions,
+            'refunds': merchant_refunds,
+            'settlements': settlements_by_merchant.get(merchant, settlements.iloc[0:0]),
+            'transactions_with_customers': with_customers_by_merchant.get(merchant, transactions_with_customers.iloc[0:0]),
+            'time_bucket_indexes': time_bucket_indexes_by_merchant.get(merchant) or empty_time_bucket_indexes(),
+            'success_cube': cubes_by_merchant.get(merchant, success_cube.iloc[0:0])
+        })
+    logger.info(f"Built {len(partitions)} merchant partitions.")
+    return MappingProxyType(partitions)
+
+def get_active_merchant():
+    merchant = _merchant_scope.get()
+    if merchant is None and has_request_context():
+        merchant = g.get('merchant')
+    return merchant
+
+@contextmanager
+def merchant_scope(merchant):
+    # Scopes helper calls to one merchant outside of a request, e.g. `with merchant_scope('Acme'): get_alerts_data()`
+    token = _merchant_scope.set(merchant)
+    try:
+        yield
+    finally:
+        _merchant_scope.reset(token)
+
+def get_scoped_frame(name):
+    # name: 'transactions', 'refunds', 'settlements', 'transactions_with_customers', 'time_bucket_indexes'
+    # or 'success_cube'
+    snapshot = get_snapshot()
+    merchant = get_active_merchant()
+    if merchant is not None:
+        partition = snapshot['merchant_partitions'].get(merchant)
+        record_cache_lookup('merchant_partitions', partition is not None)
+        if partition is not None:
+            return partition[name]
+    return snapshot[name]
+
+
+# --- Approximate Query Sketches ---
+# Sketches over the active scope's successful transactions, built on the first approximate request
+# and cached per (snapshot version, merchant) like the cohorts, so loads without approximate
+# traffic never build them. That first build hashes and sorts every row of the scope, so it is
+# slower than the exact answer; the requests after it read the small sketches only. Transactions
+# are only ever replaced by a full reload, and a snapshot that changes nothing else (a ticket
+# append) keeps the same frame, so its sketches carry over instead of being rebuilt. The sketches are:
+# - per payment method, a bottom-k sample of customer hashes with each customer's row count
+#   (distinct and repeat customers) plus exact row and amount totals;
+# - a log-bucketed order-value histogram (quantiles, and orders and amounts above a threshold);
+# - per order-value band, count-min tables with top-K candidates for SKETCH_TOP_K_COLUMNS.
+_SKETCH_HASH_SPACE = 2 ** 64
+_SKETCH_GAMMA = (1 + SKETCH_VALUE_RELATIVE_ACCURACY) / (1 - SKETCH_VALUE_RELATIVE_ACCURACY)
+_SKETCH_LOG_GAMMA = np.log(_SKETCH_GAMMA)
+
+_sketch_cache = {} # (snapshot version, merchant) -> (scoped transactions frame, sketches)
+_sketch_cache_lock = threading.Lock()
+
+def approximate_requested():
+    return has_request_context() and (request.headers.get(APPROXIMATE_HEADER) == '1' or request.args.get('approx') == '1')
+
+def get_sketches():
+    # Sketches for the pinned snapshot and active merchant when the request opted into approximate
+    # answers, else None
+    if not approximate_requested():
+        return None
+    version, merchant = key = (get_snapshot()['version'], get_active_merchant())
+    transactions = get_scoped_frame('transactions')
+    entry = _sketch_cache.get(key) or next(
+        (cached for (_, cached_merchant), cached in list(_sketch_cache.items()) if cached_merchant == merchant and cached[0] is transactions),
+        None
+    )
+    record_cache_lookup('sketches', entry is not None)
+    if entry is None:
+        with timed_block('helper_duration_seconds', helper='build_sketches'):
+            entry = (transactions, build_sketches(transactions))
+    with _sketch_cache_lock:
+        # Only versions older than the newest are evicted; a request pinned to an older snapshot
+        # uses its sketches without caching them
+        newest = max([cached_version for cached_version, _ in _sketch_cache] + [version])
+        if version == newest:
+            for stale_key in [k for k in _sketch_cache if k[0] < newest]:
+                del _sketch_cache[stale_key]
+            _sketch_cache[key] = entry
+    return entry[1]
+
+def _hash_values(values, hash_key='sketch0000000000'):
+    # Deterministic uint64 hashes (stable across processes and snapshots); hash_key must be 16 characters
+    return pd.util.hash_array(np.asarray(values, dtype=object), hash_key=hash_key)
+
+def build_distinct_sketch(sorted_hashes):
+    # sorted_hashes: one hash per row, ascending. Keeps the distinct hashes below `limit` (at most
+    # SKETCH_DISTINCT_SAMPLE_SIZE of them) with their row counts, scanning only the prefix that holds them.
+    prefix_length = SKETCH_DISTINCT_SAMPLE_SIZE * 4
+    while True:
+        prefix = sorted_hashes[:prefix_length]
+        starts = np.flatnonzero(np.r_[True, prefix[1:] != prefix[:-1]])
+        if len(starts) > SKETCH_DISTINCT_SAMPLE_SIZE or len(prefix) == len(sorted_hashes):
+            break
+        prefix_length *= 4
+    # Only the last run can continue past the prefix, and it is trimmed off unless the prefix is everything
+    return _trim_distinct_sketch(prefix[starts], np.diff(np.r_[starts, len(prefix)]), _SKETCH_HASH_SPACE)
+
+def _trim_distinct_sketch(distinct_hashes, counts, limit):
+    if len(distinct_hashes) > SKETCH_DISTINCT_SAMPLE_SIZE:
+        limit = int(distinct_hashes[SKETCH_DISTINCT_SAMPLE_SIZE])
+        distinct_hashes, counts = distinct_hashes[:SKETCH_DISTINCT_SAMPLE_SIZE], counts[:SKETCH_DISTINCT_SAMPLE_SIZE]
+    return {'hashes': distinct_hashes, 'counts': counts.astype(np.int64), 'limit': limit}
+
+def distinct_sketch_estimate(sketch):
+    # (distinct customers, customers with more than one row, repeat-fraction 95% bound, distinct-count relative 95% bound);
+    # the bounds are 0 while the sketch still holds every customer
+    retained = len(sketch['hashes'])
+    repeat_fraction = float((sketch['counts'] > 1).mean()) if retained else 0.0
+    if sketch['limit'] >= _SKETCH_HASH_SPACE:
+        return retained, int((sketch['counts'] > 1).sum()), 0.0, 0.0
+    distinct = retained / (sketch['limit'] / _SKETCH_HASH_SPACE)
+    repeat_bound = 2 * np.sqrt(repeat_fraction * (1 - repeat_fraction) / retained)
+    return distinct, distinct * repeat_fraction, float(repeat_bound), 2 / np.sqrt(retained)
+
+def build_value_sketch(amounts_paise):
+    # Histogram over bins (gamma^(i-1), gamma^i] of the amounts, with per-bin counts and paise sums
+    # (exact: float64 adds whole paise exactly below 2^53 paise, about ₹90 trillion)
+    amounts = np.asarray(amounts_paise, dtype=np.int64)
+    bins = np.ceil(np.log(np.maximum(amounts, 1)) / _SKETCH_LOG_GAMMA).astype(np.int64)
+    first_bin = bins.min() if len(bins) else 0
+    counts = np.bincount(bins - first_bin)
+    sums = np.bincount(bins - first_bin, weights=amounts).astype(np.int64)
+    occupied = np.flatnonzero(counts)
+    return {'bins': occupied + first_bin, 'counts': counts[occupied], 'sums': sums[occupied]}
+
+def value_sketch_quantile(sketch, q):
+    # Order value (paise) at quantile q, within SKETCH_VALUE_RELATIVE_ACCURACY of the true value
+    cumulative = np.cumsum(sketch['counts'])
+    if len(cumulative) == 0:
+        return None
+    position = np.searchsorted(cumulative, q * (cumulative[-1] - 1), side='right')
+    return 2 * _SKETCH_GAMMA ** sketch['bins'][position] / (_SKETCH_GAMMA + 1)
+
+def value_sketch_above(sketch, threshold_paise):
+    # (orders, paise, orders bound, paise bound) for values >= threshold. Only the bin holding the
+    # threshold is split (assuming its values are spread evenly), so the bounds are that bin's totals.
+    threshold_bin = int(np.ceil(np.log(max(threshold_paise, 1)) / _SKETCH_LOG_GAMMA))
+    lower, upper = _SKETCH_GAMMA ** (threshold_bin - 1), _SKETCH_GAMMA ** threshold_bin
+    share = min(max((upper - threshold_paise) / (upper - lower), 0.0), 1.0)
+    above = sketch['bins'] > threshold_bin
+    straddling = sketch['bins'] == threshold_bin
+    straddling_orders, straddling_paise = int(sketch['counts'][straddling].sum()), int(sketch['sums'][straddling].sum())
+    return (int(sketch['counts'][above].sum()) + share * straddling_orders,
+            int(sketch['sums'][above].sum()) + share * straddling_paise,
+            straddling_orders, straddling_paise)
+
+def _count_min_columns(keys):
+    # Column of each key in every count-min row, from one independently keyed hash per row: shape (depth, keys)
+    return np.stack([
+        (_hash_values(keys, f'countmin{row:08d}') % np.uint64(SKETCH_COUNT_MIN_WIDTH)).astype(np.intp)
+        for row in range(SKETCH_COUNT_MIN_DEPTH)
+    ])
+
+def count_min_estimates(table, keys):
+    # Never below the true counts; above them by at most total * e / width with probability 1 - e^-depth
+    return table[np.arange(SKETCH_COUNT_MIN_DEPTH)[:, None], _count_min_columns(keys)].min(axis=0)
+
+def _top_k_candidates(table, keys):
+    if not keys:
+        return {}
+    estimates = count_min_estimates(table, keys)
+    return {keys[i]: int(estimates[i]) for i in np.argsort(-estimates, kind='stable')[:SKETCH_TOP_K]}
+
+def build_top_k_sketch(keys, counts):
+    # keys: list of distinct keys (str); counts: their row counts
+    table = np.zeros((SKETCH_COUNT_MIN_DEPTH, SKETCH_COUNT_MIN_WIDTH), dtype=np.int64)
+    columns = _count_min_columns(keys)
+    for row in range(SKETCH_COUNT_MIN_DEPTH):
+        np.add.at(table[row], columns[row], counts)
+    return {'table': table, 'total': int(counts.sum()), 'candidates': _top_k_candidates(table, keys)}
+
+def merge_top_k_sketches(sketches):
+    table = np.sum([sketch['table'] for sketch in sketches], axis=0)
+    keys = list(dict.fromkeys(key for sketch in sketches for key in sketch['candidates']))
+    return {'table': table, 'total': sum(sketch['total'] for sketch in sketches), 'candidates': _top_k_candidates(table, keys)}
+
+def _value_bands(amounts_paise):
+    # Index into SKETCH_VALUE_BAND_EDGES_PAISE of each amount's band (-1 below ₹1)
+    return np.searchsorted(SKETCH_VALUE_BAND_EDGES_PAISE, amounts_paise, side='right') - 1
+
+def _method_sketch_key(method_keyword):
+    # Key of the customer sketch that payment_method_mask(df, method_keyword) selects
+    group_bit = METHOD_GROUP_KEYWORDS.get(method_keyword.lower())
+    return ('group', group_bit) if group_bit is not None else ('method', classify_payment_method(method_keyword))
+
+def build_sketches(transactions):
+    if transactions.empty or 'amount_paise' not in transactions.columns:
+        return None
+    # Row masks over the column arrays rather than filtered frames, so no frame is copied
+    successful = (transactions['status'] == 'Success').to_numpy()
+    amounts = transactions['amount_paise'].to_numpy()[successful]
+
+    customer_methods = {}
+    if 'customer_id' in transactions.columns:
+        # The rows _customer_payment_stats counts: successful, with a customer and a payment method
+        relevant = successful & transactions['customer_id'].notna().to_numpy() & transactions['payment_method'].notna().to_numpy()
+        # Rows are put in hash order once; each method's sketch then reads a prefix of its rows
+        hashes = _hash_values(transactions['customer_id'].to_numpy()[relevant])
+        hash_order = np.argsort(hashes)
+        hashes = hashes[hash_order]
+        relevant_amounts = transactions['amount_paise'].to_numpy()[relevant][hash_order]
+        method_codes = transactions['method_code'].to_numpy()[relevant][hash_order]
+        method_groups = transactions['method_groups'].to_numpy()[relevant][hash_order]
+        masks = {'all': np.ones(len(hashes), dtype=bool)}
+        masks.update({('method', code): method_codes == code for code in METHOD_NAMES})
+        masks.update({('group', bit): (method_groups & bit) != 0 for bit in METHOD_GROUP_KEYWORDS.values()})
+        for key, mask in masks.items():
+            if mask.any():
+                customer_methods[key] = {
+                    'customers': build_distinct_sketch(hashes[mask]),
+                    'rows': int(mask.sum()),
+                    'amount_paise': int(relevant_amounts[mask].sum())
+                }
+
+    top_k = {}
+    band_positions = _value_bands(amounts) + 1 # Band -1 (below ₹1) at position 0
+    band_count = len(SKETCH_VALUE_BAND_EDGES_PAISE) + 1
+    for column in SKETCH_TOP_K_COLUMNS:
+        if column not in transactions.columns:
+            continue
+        # Row counts per (band, key) in one bincount over the column's factorized codes (-1 = missing)
+        codes, keys = pd.factorize(transactions[column])
+        codes = codes[successful]
+        present = codes >= 0
+        band_key_counts = np.bincount(
+            band_positions[present] * len(keys) + codes[present], minlength=band_count * len(keys)
+        ).reshape(band_count, len(keys))
+        for position, key_counts in enumerate(band_key_counts):
+            nonzero = np.flatnonzero(key_counts)
+            if len(nonzero):
+                top_k.setdefault(position - 1, {})[column] = build_top_k_sketch([str(keys[i]) for i in nonzero], key_counts[nonzero])
+
+    return {'customer_methods': customer_methods, 'order_values': build_value_sketch(amounts), 'top_k': top_k}
+
+def sketch_customer_payment_stats(sketches, payment_method):
+    # The figures of _customer_payment_stats, estimated from the sketches, plus 'repeat_rate_bound' (percentage points)
+    overall = sketches['customer_methods'].get('all')
+    method = sketches['customer_methods'].get(_method_sketch_key(payment_method))
+    if overall is None or method is None:
+        return {'relevant_rows': overall['rows'] if overall else 0, 'method_rows': 0}
+    method_customers, method_repeat, method_bound, _ = distinct_sketch_estimate(method['customers'])
+    overall_customers, overall_repeat, overall_bound, _ = distinct_sketch_estimate(overall['customers'])
+    return {
+        'relevant_rows': overall['rows'],
+        'method_rows': method['rows'],
+        'method_customers': method_customers,
+        'method_repeat_customers': method_repeat,
+        'method_avg_paise': method['amount_paise'] / method['rows'],
+        'overall_avg_paise': overall['amount_paise'] / overall['rows'],
+        'overall_customers': overall_customers,
+        'overall_repeat_customers': overall_repeat,
+        'repeat_rate_bound': max(method_bound, overall_bound) * 100
+    }
+
+def sketch_high_value_orders(sketches, min_order_value_paise):
+    # Orders and paise at or above the threshold, with bounds, the value quantiles around it and the
+    # top keys per SKETCH_TOP_K_COLUMNS over the bands from the one holding the threshold
+    orders, amount_paise, orders_bound, amount_bound = value_sketch_above(sketches['order_values'], min_order_value_paise)
+    first_band = int(_value_bands([min_order_value_paise])[0])
+    band_parts = [columns for band, columns in sketches['top_k'].items() if band >= first_band]
+    top_keys = {}
+    for column in SKETCH_TOP_K_COLUMNS:
+        parts = [part[column] for part in band_parts if column in part]
+        if parts:
+            merged = merge_top_k_sketches(parts)
+            top_keys[column] = {'candidates': merged['candidates'], 'count_bound': merged['total'] * np.e / SKETCH_COUNT_MIN_WIDTH}
+    total_orders = int(sketches['order_values']['counts'].sum())
+    return {
+        'orders': orders,
+        'amount_paise': amount_paise,
+        'orders_bound': orders_bound,
+        'amount_bound_paise': amount_bound,
+        'share_of_orders': orders / total_orders * 100 if total_orders else 0.0,
+        'median_paise': value_sketch_quantile(sketches['order_values'], 0.5),
+        'band_start_paise': int(SKETCH_VALUE_BAND_EDGES_PAISE[max(first_band, 0)]),
+        'top_keys': top_keys
+    }
+
+# --- Success-Rate Cube ---
+# Transaction status counts per non-empty (merchant, city, payment method, hour of day) cell, built
+# once per snapshot; each merchant partition gets the all-merchants cube's cells for that merchant
+# (split_success_cube). Drill-downs filter and sum cells, so they never touch transaction rows.
+SUCCESS_CUBE_COUNTS = ['success', 'failed', 'pending', 'total']
+_METHOD_GROUP_BITS = np.array([METHOD_GROUPS[code] for code in sorted(METHOD_GROUPS)], dtype=np.int8)
+
+def build_success_cube(transactions):
+    if transactions.empty or 'status' not in transactions.columns:
+        return _sum_cube_cells(pd.DataFrame({column: pd.Series(dtype=np.int64) for column in SUCCESS_CUBE_DIMENSIONS + SUCCESS_CUBE_COUNTS}))
+    status = transactions['status']
+    cells = pd.DataFrame({
+        'merchant_display_name': transactions['merchant_display_name'].fillna('Unknown') if 'merchant_display_name' in transactions.columns else 'Unknown',
+        'city': transactions['city'].fillna('Unknown') if 'city' in transactions.columns else 'Unknown',
+        'method_code': transactions['method_code'],
+        'hour': transactions['transaction_time'].dt.hour.fillna(-1).astype(np.int8), # -1: no transaction time
+        'success': (status == 'Success').astype(np.int64),
+        'failed': (status == 'Failed').astype(np.int64),
+        'pending': (status == 'Pending').astype(np.int64),
+        'total': np.int64(1)
+    })
+    return _sum_cube_cells(cells)
+
+def _sum_cube_cells(cells):
+    cube = cells.groupby(SUCCESS_CUBE_DIMENSIONS, sort=False, observed=True)[SUCCESS_CUBE_COUNTS].sum().reset_index()
+    # Categorical names keep drill-down filters to integer comparisons; method_groups lets
+    # payment_method_mask filter cells exactly as it filters transactions
+    return cube.assign(
+        merchant_display_name=cube['merchant_display_name'].astype('category'),
+        city=cube['city'].astype('category'),
+        method_groups=_METHOD_GROUP_BITS[cube['method_code'].to_numpy(dtype=np.intp)]
+    )
+
+def _category_mask(column, value):
+    # Case-insensitive match of a categorical column, comparing each category name once
+    matches = [category for category in column.cat.categories if str(category).lower() == value.lower()]
+    return column.isin(matches).to_numpy()
+
+def split_success_cube(cube):
+    # One merchant's cells per merchant, cut from the all-merchants cube in a single pass
+    return {merchant: cells.reset_index(drop=True) for merchant, cells in cube.groupby('merchant_display_name', sort=False, observed=True)}
+
+def success_cube_cells(method_keyword=None, start_hour=None, end_hour=None, city=None, merchant=None):
+    # Cells of the active scope's cube matching every given filter. Hours select [start_hour, end_hour),
+    # wrapping past midnight when start_hour > end_hour.
+    cube = get_scoped_frame('success_cube')
+    mask = np.ones(len(cube), dtype=bool)
+    if method_keyword:
+        mask &= payment_method_mask(cube, method_keyword).to_numpy()
+    if start_hour is not None or end_hour is not None:
+        hours = cube['hour'].to_numpy()
+        after_start = hours >= (start_hour if start_hour is not None else 0)
+        before_end = hours < (end_hour if end_hour is not None else 24)
+        mask &= (after_start | before_end) if start_hour is not None and end_hour is not None and start_hour > end_hour else (after_start & before_end)
+    if city:
+        mask &= _category_mask(cube['city'], city)
+    if merchant:
+        mask &= _category_mask(cube['merchant_display_name'], merchant)
+    return cube[mask]
+
+def _format_segment(dimension, value):
+    if dimension == 'method_code':
+        return METHOD_NAMES[value]
+    if dimension == 'hour':
+        return f"{value:02d}:00-{value + 1:02d}:00" if value >= 0 else "unknown time"
+    return value
+
+def rank_failure_segments(cells, limit=3):
+    # Single dimensions and pairs of dimensions ranked by excess failures: failures beyond what the
+    # cells' overall failure rate predicts for the segment's volume. Dimensions with a single value
+    # in `cells` (e.g. the city a drill-down filtered on) are skipped.
+    total = cells['total'].sum()
+    if total == 0:
+        return []
+    failure_rate = cells['failed'].sum() / total
+    dimensions = [dimension for dimension in SUCCESS_CUBE_DIMENSIONS if cells[dimension].nunique() > 1]
+    segments = []
+    for size in (1, 2):
+        for group in itertools.combinations(dimensions, size):
+            grouped = cells.groupby(list(group), sort=False, observed=True)[['failed', 'total']].sum()
+            grouped = grouped[grouped['total'] >= SUCCESS_CUBE_MIN_SEGMENT_TRANSACTIONS]
+            excess = grouped['failed'] - grouped['total'] * failure_rate
+            for key, excess_failures in excess[excess > 0].nlargest(limit).items():
+                values = key if isinstance(key, tuple) else (key,)
+                segments.append({
+                    'segment': {dimension: (int(value) if dimension in ('method_code', 'hour') else value) for dimension, value in zip(group, values)},
+                    'label': ", ".join(str(_format_segment(dimension, value)) for dimension, value in zip(group, values)),
+                    'transactions': int(grouped.at[key, 'total']),
+                    'failed': int(grouped.at[key, 'failed']),
+                    'excess_failures': float(excess_failures)
+                })
+    segments.sort(key=lambda segment: segment['excess_failures'], reverse=True)
+    failed_total = cells['failed'].sum()
+    for segment in segments:
+        segment['failure_rate'] = segment['failed'] / segment['transactions'] * 100
+        segment['share_of_failures'] = segment['failed'] / failed_total * 100
+    return segments[:limit]
+
+def success_rate_drilldown(method_keyword=None, start_hour=None, end_hour=None, city=None, merchant=None):
+    # Status counts, success rate, hourly success rates and failure hotspots for one slice of the cube
+    for name, hour in (('start_hour', start_hour), ('end_hour', end_hour)):
+        if hour is not None and not 0 <= hour <= 24:
+            raise ValueError(f"{name} must be between 0 and 24.")
+    cells = success_cube_cells(method_keyword, start_hour, end_hour, city, merchant)
+    totals = {count: int(cells[count].sum()) for count in SUCCESS_CUBE_COUNTS}
+    by_hour = cells[cells['hour'] >= 0].groupby('hour')[['success', 'total']].sum()
+    return {
+        **totals,
+        'success_rate': totals['success'] / totals['total'] * 100 if totals['total'] else None,
+        'hourly_success_rate': {f"{hour:02d}:00": row.success / row.total * 100 for hour, row in by_hour.iterrows()},
+        'failure_segments': rank_failure_segments(cells)
+    }
+
+# --- Intraday Time-Bucket Index ---
+# Hourly and 15-minute aggregates over transactions and refunds so intraday questions
+# ("when did failures peak yesterday", "hourly UPI volume today") and their charts
+# are answered from a few hundred pre-aggregated rows instead of the raw frames.
+def build_time_bucket_index(df, time_col, freq, by=None):
+    # by: an extra key column (e.g. merchant_display_name) grouped after the others, so each
+    # value's rows are still sorted by bucket and can be split off with split_time_bucket_indexes
+    by = by if by in df.columns else None
+    if df.empty or time_col not in df.columns:
+        return pd.DataFrame(columns=TIME_BUCKET_COLUMNS)
+    if 'method_code' not in df.columns:
+        df = add_payment_method_taxonomy(df)
+
+    bucket_keys = pd.DataFrame({
+        'bucket': pd.to_datetime(df[time_col], errors='coerce').dt.floor(freq),
+        'payment_method': df['payment_method'].fillna('Unknown') if 'payment_method' in df.columns else 'Unknown',
+        'method_code': df['method_code'],
+        'method_groups': df['method_groups'],
+        'status': df['status'].fillna('Unknown') if 'status' in df.columns else 'Unknown',
+        'amount_paise': df['amount_paise'] if 'amount_paise' in df.columns else 0
+    }).dropna(subset=['bucket'])
+    if by:
+        bucket_keys[by] = df[by]
+
+    keys = TIME_BUCKET_KEYS + ([by] if by else [])
+    index = bucket_keys.groupby(keys, sort=True, dropna=False).agg(
+        count=('amount_paise', 'size'),
+        amount_paise=('amount_paise', 'sum')
+    ).reset_index()
+    return index[TIME_BUCKET_COLUMNS + ([by] if by else [])]
+
+def rollup_time_bucket_index(index, period_freq, by=None):
+    # Re-buckets an index to a coarser period ('D', 'W-SUN', 'M'); rows stay sorted by bucket
+    if index.empty:
+        return index
+    by = by if by in index.columns else None
+    rolled = index.assign(bucket=index['bucket'].dt.to_period(period_freq).dt.start_time)
+    rolled = rolled.groupby(TIME_BUCKET_KEYS + ([by] if by else []), sort=True, dropna=False).agg(
+        count=('count', 'sum'),
+        amount_paise=('amount_paise', 'sum')
+    ).reset_index()
+    return rolled[TIME_BUCKET_COLUMNS + ([by] if by else [])]
+
+def _time_bucket_resolutions(df, time_col, intraday=True, by=None):
+    # intraday=False for date-only time columns: the day index is bucketed from the rows directly
+    # and the intraday indexes stay empty
+    if intraday:
+        indexes = {resolution: build_time_bucket_index(df, time_col, freq, by) for resolution, freq in TIME_BUCKET_FREQUENCIES.items()}
+    else:
+        indexes = {resolution: pd.DataFrame(columns=TIME_BUCKET_COLUMNS) for resolution in TIME_BUCKET_FREQUENCIES}
+        indexes['day'] = build_time_bucket_index(df, time_col, 'D', by)
+    for resolution, (base_resolution, period_freq) in TIME_BUCKET_ROLLUPS.items():
+        if resolution not in indexes:
+            indexes[resolution] = rollup_time_bucket_index(indexes[base_resolution], period_freq, by)
+    return indexes
+
+def empty_time_bucket_indexes():
+    empty = pd.DataFrame(columns=TIME_BUCKET_COLUMNS) # Indexes are never modified in place, so one frame serves every slot
+    return {source: {resolution: empty for resolution in [*TIME_BUCKET_FREQUENCIES, *TIME_BUCKET_ROLLUPS]}
+            for source in ('transactions', 'refunds')}
+
+def split_time_bucket_indexes(keyed_indexes, by):
+    # Splits indexes built with an extra `by` key into the indexes over all rows and one set of
+    # indexes per value of `by` (rows with no value only count towards the totals)
+    overall, by_value = {}, {}
+    for source, resolutions in keyed_indexes.items():
+        overall[source] = {}
+        for resolution, index in resolutions.items():
+            if index.empty or by not in index.columns:
+                overall[source][resolution] = index[TIME_BUCKET_COLUMNS]
+                continue
+            overall[source][resolution] = index.groupby(TIME_BUCKET_KEYS, sort=True).agg(
+                count=('count', 'sum'),
+                amount_paise=('amount_paise', 'sum')
+            ).reset_index()[TIME_BUCKET_COLUMNS]
+            for value, rows in index.groupby(by, sort=False):
+                if value not in by_value:
+                    by_value[value] = empty_time_bucket_indexes()
+                by_value[value][source][resolution] = rows[TIME_BUCKET_COLUMNS].reset_index(drop=True)
+    return overall, by_value
+
+def compute_time_bucket_indexes(transactions, refunds, by=None):
+    # Refund rows carry no payment method of their own; borrow it from the original transaction
+    refunds_with_method = refunds
+    if not refunds.empty and 'transaction_id' in refunds.columns and 'payment_method' in transactions.columns:
+        method_by_txn = transactions.drop_duplicates('transaction_id').set_index('transaction_id')['payment_method']
+        refunds_with_method = add_payment_method_taxonomy(refunds.assign(payment_method=refunds['transaction_id'].map(method_by_txn)))
+
+    return {
+        'transactions': _time_bucket_resolutions(transactions, 'transaction_time', by=by),
+        'refunds': _time_bucket_resolutions(refunds_with_method, 'refund_date', intraday='refunds' not in TIME_BUCKET_DAILY_SOURCES, by=by)
+    }
+
+def query_time_bucket_range(source, start, end, resolution, method_keyword=None, status=None):
+    # Index rows with start <= bucket < end, optionally filtered by payment method and status.
+    # Indexes are sorted by bucket, so the range is two binary searches.
+    time_bucket_indexes = get_scoped_frame('time_bucket_indexes')
+    index = time_bucket_indexes.get(source, {}).get(resolution)
+    if index is None or index.empty:
+        return pd.DataFrame(columns=TIME_BUCKET_COLUMNS)
+
+    first, last = index['bucket'].searchsorted([pd.Timestamp(start), pd.Timestamp(end)])
+    rows = index.iloc[first:last]
+    if method_keyword:
+        rows = rows[payment_method_mask(rows, method_keyword)]
+    if status:
+        rows = rows[rows['status'] == status]
+    return rows
+
+def query_time_bucket_index(source='transactions', date_obj=None, resolution='hour', method_keyword=None, status=None):
+    # Returns the index rows for one day
+    day_start = pd.Timestamp(date_obj if date_obj else datetime.date.today())
+    return query_time_bucket_range(source, day_start, day_start + pd.Timedelta(days=1), resolution, method_keyword, status)
+
+def get_bucketed_series(source, start_date, end_date, resolution, method_keyword=None, status=None, metric='count'):
+    # Per-bucket totals of an index column ('count' or 'amount_paise') for buckets starting on start_date..end_date inclusive
+    rows = query_time_bucket_range(source, pd.Timestamp(start_date), pd.Timestamp(end_date) + pd.Timedelta(days=1),
+                                   resolution, method_keyword, status)
+    return rows.groupby('bucket')[metric].sum().sort_index()
+
+def downsample_lttb(x, y, max_points):
+    # Largest-Triangle-Three-Buckets: returns the positions of at most max_points points that keep the
+    # visual shape (peaks and dips) of the series. The first and last points are always kept; every
+    # bucket in between contributes the point forming the largest triangle with the previously kept
+    # point and the mean of the next bucket.
+    n = len(y)
+    if max_points >= n or max_points < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    edges = np.linspace(1, n - 1, max_points - 1).astype(int)
+    selected = np.empty(max_points, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    kept = 0
+    for i in range(max_points - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        next_x, next_y = x[end:next_end].mean(), y[end:next_end].mean()
+        areas = np.abs((x[kept] - next_x) * (y[start:end] - y[kept]) - (x[kept] - x[start:end]) * (next_y - y[kept]))
+        kept = start + int(np.argmax(areas))
+        selected[i + 1] = kept
+    return selected
+
+def chart_point_budget():
+    if has_request_context():
+        return g.get('chart_max_points', CHART_MAX_POINTS)
+    return CHART_MAX_POINTS
+
+def format_bucket_label(bucket, resolution):
+    if resolution in TIME_BUCKET_FREQUENCIES:
+        return bucket.strftime('%H:%M')
+    if resolution == 'month':
+        return bucket.strftime('%b %Y')
+    return bucket.date().isoformat()
+
+def build_series_chart(series, resolution, chart_type='line', in_rupees=False, max_points=None):
+    # Chart.js payload for a bucket-indexed series, downsampled to the point budget
+    max_points = max_points if max_points else chart_point_budget()
+    if len(series) > max_points:
+        series = series.iloc[downsample_lttb(series.index.asi8, series.to_numpy(), max_points)]
+    return {
+        "labels": [format_bucket_label(bucket, resolution) for bucket in series.index],
+        "data": paise_to_rupees(series).tolist() if in_rupees else series.tolist(),
+        "type": chart_type
+    }
+
+@instrumented_helper
+def get_intraday_series(source='transactions', date_obj=None, resolution='hour', method_keyword=None, status=None, metric='count'):
+    rows = query_time_bucket_index(source, date_obj, resolution, method_keyword, status)
+    if rows.empty:
+        return {"labels": [], "data": [], "type": "bar"}
+
+    # metric is an index column: 'count' or 'amount_paise' (charted in rupees). Buckets without rows
+    # are charted as zero so the day's axis has no gaps.
+    day_start = pd.Timestamp(date_obj if date_obj else datetime.date.today())
+    all_buckets = pd.date_range(day_start, day_start + pd.Timedelta(days=1), freq=TIME_BUCKET_FREQUENCIES[resolution], inclusive='left')
+    series = rows.groupby('bucket')[metric].sum().reindex(all_buckets, fill_value=0)
+    return build_series_chart(series if metric == 'amount_paise' else series.astype(int), resolution, 'bar',
+                              in_rupees=metric == 'amount_paise')
+
+@instrumented_helper
+def get_intraday_peak(source='transactions', date_obj=None, resolution='hour', method_keyword=None, status=None):
+    rows = query_time_bucket_index(source, date_obj, resolution, method_keyword, status)
+    if rows.empty:
+        return None
+
+    counts = rows.groupby('bucket')['count'].sum()
+    peak_bucket = counts.idxmax()
+    return {
+        "bucket": peak_bucket,
+        "count": int(counts.loc[peak_bucket]),
+        "total_count": int(counts.sum())
+    }
+
+
+# --- Settlement Reconciliation ---
+# Matches settlements to successful transactions one-to-one: each settlement is paired with the
+# latest unused successful transaction of the same amount (to the paisa) in the preceding
+# SETTLEMENT_MATCH_TOLERANCE_DAYS. Settlements that are daily aggregates (as in the mock data)
+# are then matched against a day's successful total within SETTLEMENT_AMOUNT_TOLERANCE, each
+# day paying out once. Candidates are filtered by amount before the nearest in time is chosen.
+# Everything is vectorized; contested matches are resolved in rounds.
+def assign_one_to_one(pairs, left_key, right_key):
+    # Greedy one-to-one assignment over candidate pairs sorted best first: each round every left
+    # takes its best remaining right, each contested right goes to its best left, and the rest retry
+    assigned = []
+    while not pairs.empty:
+        winners = pairs.drop_duplicates(left_key).drop_duplicates(right_key)
+        assigned.append(winners)
+        pairs = pairs[~pairs[left_key].isin(winners[left_key]) & ~pairs[right_key].isin(winners[right_key])]
+    return pd.concat(assigned) if assigned else pairs
+
+@instrumented_helper
+def reconcile_settlements(tolerance_days=SETTLEMENT_MATCH_TOLERANCE_DAYS, amount_tolerance=SETTLEMENT_AMOUNT_TOLERANCE):
+    settlements = get_scoped_frame('settlements')
+    transactions = get_scoped_frame('transactions')
+
+    if settlements.empty or 'settlement_date' not in settlements.columns:
+        return None
+
+    payouts = pd.DataFrame({
+        'settlement_id': settlements['settlement_id'] if 'settlement_id' in settlements.columns else settlements.index.astype(str),
+        'settlement_date': pd.to_datetime(settlements['settlement_date'], errors='coerce'),
+        'gross_amount_paise': settlements['gross_amount_paise'] if 'gross_amount_paise' in settlements.columns else 0,
+        'fees_paise': settlements['fees_paise'] if 'fees_paise' in settlements.columns else 0,
+        'net_amount_paise': settlements['net_amount_paise'] if 'net_amount_paise' in settlements.columns else 0
+    }).dropna(subset=['settlement_date'])
+    payouts = payouts[payouts['net_amount_paise'] != 0] # Zero-value rows are not payouts
+    if payouts.empty:
+        return None
+    payouts['amount_key'] = payouts['gross_amount_paise']
+    payouts = payouts.sort_values('settlement_date').reset_index(drop=True)
+
+    successful = transactions[transactions['status'] == 'Success'] if 'status' in transactions.columns else transactions.iloc[0:0]
+    candidates = pd.DataFrame({
+        'transaction_id': successful['transaction_id'].astype(str) if 'transaction_id' in successful.columns else '',
+        'transaction_time': pd.to_datetime(successful['transaction_time'], errors='coerce') if 'transaction_time' in successful.columns else pd.NaT,
+        'payment_method': successful['payment_method'] if 'payment_method' in successful.columns else 'Unknown',
+        'amount_key': successful['amount_paise'] if 'amount_paise' in successful.columns else 0
+    }).dropna(subset=['transaction_time']).sort_values('transaction_time')
+
+    tolerance = pd.Timedelta(days=tolerance_days)
+    amount_tolerance_paise = rupees_to_paise(amount_tolerance)
+    payouts['row_id'] = payouts.index
+    candidates['candidate_id'] = np.arange(len(candidates))
+
+    # Transaction pass: an as-of join proposes the latest same-amount transaction for each open
+    # settlement; a transaction proposed to several settlements goes to the nearest in time and
+    # the others retry against the transactions still unused
+    transaction_matches = []
+    open_payouts, unused = payouts, candidates
+    while not open_payouts.empty and not unused.empty:
+        proposals = pd.merge_asof(
+            open_payouts[['row_id', 'settlement_date', 'amount_key']], unused,
+            left_on='settlement_date', right_on='transaction_time',
+            by='amount_key', direction='backward', tolerance=tolerance
+        ).dropna(subset=['candidate_id'])
+        if proposals.empty:
+            break
+        proposals['gap'] = proposals['settlement_date'] - proposals['transaction_time']
+        winners = proposals.sort_values('gap', kind='stable').drop_duplicates('candidate_id')
+        transaction_matches.append(winners[['row_id', 'transaction_id', 'transaction_time', 'payment_method']])
+        open_payouts = open_payouts[~open_payouts['row_id'].isin(winners['row_id'])]
+        unused = unused[~unused['candidate_id'].isin(winners['candidate_id'])]
+    matched = payouts.merge(pd.concat(transaction_matches) if transaction_matches else
+                            pd.DataFrame(columns=['row_id', 'transaction_id', 'transaction_time', 'payment_method']),
+                            on='row_id', how='left') # Keeps the payouts' order, so the index is still row_id
+    matched['match_type'] = np.where(matched['transaction_id'].notna(), 'transaction', 'unmatched')
+
+    # Daily pass: settlements that pay out a whole day's successful volume. Each pending settlement
+    # is paired with the days in its window whose total is within the amount tolerance, then the
+    # nearest day (smallest amount difference on ties) wins, one settlement per day.
+    pending = matched.loc[matched['match_type'] == 'unmatched', ['row_id', 'settlement_date', 'amount_key']]
+    if not pending.empty and not candidates.empty:
+        daily_totals = candidates.groupby(candidates['transaction_time'].dt.normalize())['amount_key'].sum().rename('daily_amount_key')
+        offsets = pd.DataFrame({'offset': pd.to_timedelta(np.arange(int(tolerance_days) + 1), unit='D')})
+        pairs = pending.assign(settlement_day=pending['settlement_date'].dt.normalize()).merge(offsets, how='cross')
+        pairs['day'] = pairs['settlement_day'] - pairs['offset']
+        pairs = pairs.join(daily_totals, on='day', how='inner')
+        pairs['amount_gap'] = (pairs['daily_amount_key'] - pairs['amount_key']).abs()
+        pairs = pairs[pairs['amount_gap'] <= amount_tolerance_paise].sort_values(['offset', 'amount_gap', 'row_id'])
+        daily_matches = assign_one_to_one(pairs, 'row_id', 'day')
+        matched.loc[daily_matches['row_id'].to_numpy(), 'match_type'] = 'daily'
+
+    matched['expected_net_paise'] = matched['gross_amount_paise'] - matched['fees_paise']
+    matched['shortfall_paise'] = matched['expected_net_paise'] - matched['net_amount_paise']
+    matched['fee_rate'] = matched['fees_paise'] / matched['gross_amount_paise'].where(matched['gross_amount_paise'] > 0)
+
+    unmatched = matched[matched['match_type'] == 'unmatched']
+    short_paid = matched[matched['shortfall_paise'] > amount_tolerance_paise]
+
+    # Fee-rate drift per day: each day's weighted fee rate against the mean of the 7 days before it
+    by_day = matched.groupby(matched['settlement_date'].dt.normalize()).agg(
+        gross_amount_paise=('gross_amount_paise', 'sum'),
+        fees_paise=('fees_paise', 'sum')
+    )
+    by_day['fee_rate'] = by_day['fees_paise'] / by_day['gross_amount_paise'].where(by_day['gross_amount_paise'] > 0)
+    by_day['baseline_fee_rate'] = by_day['fee_rate'].shift(1).rolling(7, min_periods=1).mean()
+    by_day['drift_bps'] = (by_day['fee_rate'] - by_day['baseline_fee_rate']) * 10000
+
+    # Fee-rate drift per method: the last 7 days of settlements against everything before them
+    method_rows = matched[matched['match_type'] == 'transaction']
+    by_method = pd.DataFrame(columns=['payment_method', 'recent_fee_rate', 'prior_fee_rate', 'drift_bps'])
+    if not method_rows.empty:
+        window_start = matched['settlement_date'].max().normalize() - pd.Timedelta(days=6)
+        period = np.where(method_rows['settlement_date'] >= window_start, 'recent', 'prior')
+        sums = method_rows.groupby(['payment_method', period])[['fees_paise', 'gross_amount_paise']].sum()
+        rates = (sums['fees_paise'] / sums['gross_amount_paise'].where(sums['gross_amount_paise'] > 0)).unstack()
+        rates = rates.reindex(columns=['recent', 'prior'])
+        by_method = pd.DataFrame({
+            'payment_method': rates.index,
+            'recent_fee_rate': rates['recent'].to_numpy(),
+            'prior_fee_rate': rates['prior'].to_numpy(),
+            'drift_bps': ((rates['recent'] - rates['prior']) * 10000).to_numpy()
+        }).sort_values('drift_bps', ascending=False, na_position='last').reset_index(drop=True)
+
+    return {
+        "settlement_count": int(len(matched)),
+        "matched_count": int((matched['match_type'] != 'unmatched').sum()),
+        "unmatched": unmatched[['settlement_id', 'settlement_date', 'gross_amount_paise', 'net_amount_paise']],
+        "short_paid": short_paid[['settlement_id', 'settlement_date', 'expected_net_paise', 'net_amount_paise', 'shortfall_paise']],
+        "daily_fee_rates": by_day.reset_index().rename(columns={'settlement_date': 'date'}),
+        "method_fee_rates": by_method
+    }
+
+def summarize_settlement_reconciliation():
+    result = reconcile_settlements()
+    if result is None:
+        return {
+            "answer": "No settlement data available to reconcile.",
+            "chartData": {"labels": [], "data": [], "type": "line"}
+        }
+
+    daily = result["daily_fee_rates"].dropna(subset=['fee_rate'])
+    answer = (f"Reconciled **{result['settlement_count']:,}** settlements: **{result['matched_count']:,}** matched successful transactions, "
+              f"**{len(result['unmatched']):,}** are unmatched and **{len(result['short_paid']):,}** were short-paid "
+              f"({format_rupees(result['short_paid']['shortfall_paise'].sum())} in total).")
+    if not daily.empty:
+        latest = daily.iloc[-1]
+        answer += f"<br>The fee rate on {latest['date'].date().isoformat()} was **{latest['fee_rate'] * 100:.2f}%**"
+        if pd.notna(latest['drift_bps']):
+            answer += f" ({latest['drift_bps']:+.1f} bps against the previous 7-day average)"
+        answer += "."
+    drifting_methods = result["method_fee_rates"].dropna(subset=['drift_bps'])
+    if not drifting_methods.empty:
+        top = drifting_methods.iloc[0]
+        answer += (f" The biggest fee-rate change this week is on **{top['payment_method']}**: "
+                   f"{top['prior_fee_rate'] * 100:.2f}% → {top['recent_fee_rate'] * 100:.2f}% ({top['drift_bps']:+.1f} bps).")
+    answer += "<br>The chart shows the daily fee rate (%)."
+
+    return {
+        "answer": answer,
+        "chartData": build_series_chart((daily.set_index('date')['fee_rate'] * 100).round(4), 'day', 'line')
+    }
+
+def get_settlement_alerts():
+    result = reconcile_settlements()
+    if result is None:
+        return []
+
+    alerts = []
+    if not result["short_paid"].empty:
+        alerts.append({
+            "type": "alert",
+            "title": "Short-Paid Settlements Detected",
+            "description": (f"**{len(result['short_paid']):,}** settlements were paid out below gross minus fees, "
+                            f"a shortfall of **{format_rupees(result['short_paid']['shortfall_paise'].sum())}**. Raise these with your acquirer.")
+        })
+    if not result["unmatched"].empty:
+        alerts.append({
+            "type": "alert",
+            "title": "Unmatched Settlements",
+            "description": (f"**{len(result['unmatched']):,}** of {result['settlement_count']:,} settlements "
+                            f"({format_rupees(result['unmatched']['gross_amount_paise'].sum())}) could not be matched to a successful transaction.")
+        })
+    daily = result["daily_fee_rates"].dropna(subset=['drift_bps'])
+    if not daily.empty and daily.iloc[-1]['drift_bps'] > FEE_RATE_DRIFT_ALERT_BPS:
+        latest = daily.iloc[-1]
+        alerts.append({
+            "type": "alert",
+            "title": "Settlement Fee Rate Increased",
+            "description": (f"Your fee rate on {latest['date'].date().isoformat()} was **{latest['fee_rate'] * 100:.2f}%**, "
+                            f"**{latest['drift_bps']:.1f} bps** above the previous 7-day average. Check for MDR changes.")
+        })
+    return alerts
+
+
+# --- Support Ticket Text Index ---
+# Positional inverted index over ticket subjects and categories. Term lookups are a dict hit,
+# phrases intersect postings and check positions, and prefixes walk a sorted term list,
+# so searches cost O(matching tickets) rather than a regex over every subject.
+def tokenize_ticket_text(text):
+    if not isinstance(text, str):
+        return []
+    return TICKET_TOKEN_PATTERN.findall(text.lower())
+
+def _index_ticket_rows(index, tickets, first_doc_id):
+    # Returns a new index extended with `tickets`; the old index is left untouched for readers of older
+    # snapshots. Only the postings of terms that occur in the new tickets are copied.
+    postings = dict(index['postings'])
+    copied_terms = set()
+    subjects = tickets['subject'] if 'subject' in tickets.columns else [None] * len(tickets)
+    categories = tickets['category'] if 'category' in tickets.columns else [None] * len(tickets)
+
+    for offset, (subject, category) in enumerate(zip(subjects, categories)):
+        doc_id = first_doc_id + offset
+        positioned_tokens = list(enumerate(tokenize_ticket_text(subject)))
+        positioned_tokens += [(TICKET_CATEGORY_POSITION_OFFSET + i, token) for i, token in enumerate(tokenize_ticket_text(category))]
+        for position, token in positioned_tokens:
+            if token not in copied_terms:
+                postings[token] = dict(postings.get(token, {}))
+                copied_terms.add(token)
+            postings[token].setdefault(doc_id, []).append(position)
+
+    new_dates = pd.to_datetime(tickets['ticket_created_time'], errors='coerce').to_numpy(dtype='datetime64[ns]')
+    new_terms = [term for term in copied_terms if term not in index['postings']]
+    return {
+        'postings': postings,
+        'doc_dates': np.concatenate([index['doc_dates'], new_dates]),
+        'sorted_terms': sorted(index['sorted_terms'] + new_terms) if new_terms else index['sorted_terms']
+    }
+
+def build_support_ticket_index(support_tickets):
+    index = {'postings': {}, 'doc_dates': np.array([], dtype='datetime64[ns]'), 'sorted_terms': []}
+    if not support_tickets.empty:
+        index = _index_ticket_rows(index, support_tickets, 0)
+    logger.info(f"Indexed {len(index['doc_dates'])} support tickets ({len(index['postings'])} distinct terms).")
+    return index
+
+def validate_new_tickets(items):
+    # Rejects a POST /tickets body before anything is indexed: each item must be an object with a
+    # parseable ticket_created_time and text (or null) subject and category. Raises ValueError.
+    if not isinstance(items, list) or not items:
+        raise ValueError("Expected a JSON list of tickets.")
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            raise ValueError(f"Ticket {i} is not an object.")
+        created = item.get('ticket_created_time')
+        if not isinstance(created, str) or pd.isna(pd.to_datetime(created, errors='coerce')):
+            raise ValueError(f"Ticket {i} needs a parseable 'ticket_created_time'.")
+        for field in ('subject', 'category'):
+            if item.get(field) is not None and not isinstance(item[field], str):
+                raise ValueError(f"Ticket {i} has a non-text '{field}'.")
+
+def append_support_tickets(new_tickets_df):
+    # Publishes a snapshot with the tickets appended, extending the index instead of rebuilding it.
+    # Returns (tickets added, total tickets).
+    new_tickets_df = new_tickets_df.copy()
+    new_tickets_df['ticket_created_time'] = pd.to_datetime(new_tickets_df['ticket_created_time'], errors='coerce')
+    new_tickets_df = new_tickets_df.dropna(subset=['ticket_created_time'])
+    new_tickets_df['ticket_created_date'] = new_tickets_df['ticket_created_time'].dt.normalize()
+
+    with _snapshot_write_lock:
+        current = data_snapshot
+        support_tickets = current['support_tickets']
+        snapshot = publish_snapshot({
+            **current,
+            'support_tickets': pd.concat([support_tickets, new_tickets_df], ignore_index=True),
+            'support_ticket_index': _index_ticket_rows(current['support_ticket_index'], new_tickets_df, len(support_tickets))
+        })
+    return len(new_tickets_df), len(snapshot['support_tickets'])
+
+def _term_docs(index, term):
+    return set(index['postings'].get(term, {}))
+
+def _prefix_docs(index, prefix):
+    sorted_terms = index['sorted_terms']
+    docs = set()
+    i = bisect.bisect_left(sorted_terms, prefix)
+    while i < len(sorted_terms) and sorted_terms[i].startswith(prefix):
+        docs.update(index['postings'][sorted_terms[i]])
+        i += 1
+    return docs
+
+def _phrase_docs(index, tokens):
+    if not tokens:
+        return set()
+    postings = index['postings']
+    candidates = set.intersection(*(_term_docs(index, token) for token in tokens))
+    matches = set()
+    for doc_id in candidates:
+        first_positions = postings[tokens[0]][doc_id]
+        following_positions = [set(postings[token][doc_id]) for token in tokens[1:]]
+        if any(all(start + i + 1 in positions for i, positions in enumerate(following_positions)) for start in first_positions):
+            matches.add(doc_id)
+    return matches
+
+@instrumented_helper
+def search_support_tickets(query, start_date=None, end_date=None, limit=50):
+    # Query syntax: plain words must all appear, "quoted text" is an exact phrase, word* is a prefix
+    snapshot = get_snapshot()
+    support_tickets = snapshot['support_tickets']
+    index = snapshot['support_ticket_index']
+    matching_docs = None
+    for phrase, word in re.findall(r'"([^"]+)"|(\S+)', query.lower()):
+        if phrase:
+            docs = _phrase_docs(index, tokenize_ticket_text(phrase))
+        elif word.endswith('*'):
+            prefix_tokens = tokenize_ticket_text(word[:-1])
+            docs = _prefix_docs(index, prefix_tokens[0]) if prefix_tokens else set()
+        else:
+            tokens = tokenize_ticket_text(word)
+            if not tokens:
+                continue
+            docs = _term_docs(index, tokens[0]) if len(tokens) == 1 else _phrase_docs(index, tokens)
+        matching_docs = docs if matching_docs is None else matching_docs & docs
+        if not matching_docs:
+            break
+
+    if not matching_docs:
+        return support_tickets.iloc[0:0], 0
+
+    doc_ids = np.fromiter(matching_docs, dtype=np.int64, count=len(matching_docs))
+    doc_dates = index['doc_dates'][doc_ids]
+    in_range = np.ones(len(doc_ids), dtype=bool)
+    if start_date:
+        in_range &= doc_dates >= np.datetime64(pd.Timestamp(start_date))
+    if end_date:
+        in_range &= doc_dates < np.datetime64(pd.Timestamp(end_date) + pd.Timedelta(days=1))
+    doc_ids, doc_dates = doc_ids[in_range], doc_dates[in_range]
+
+    newest_first = doc_ids[np.argsort(doc_dates)[::-1]]
+    return support_tickets.iloc[newest_first[:limit]], len(doc_ids)
+
+@instrumented_helper
+def get_trending_ticket_terms(window_days=30, top_n=5):
+    # Compares how many tickets mention each term in the latest window against the window before it
+    index = get_snapshot()['support_ticket_index']
+    doc_dates = index['doc_dates']
+    if len(doc_dates) == 0:
+        return []
+
+    recent_start = doc_dates.max() - np.timedelta64(window_days, 'D')
+    prior_start = recent_start - np.timedelta64(window_days, 'D')
+    trends = []
+    for term, docs in index['postings'].items():
+        if term in TICKET_TREND_STOPWORDS or term.isdigit() or len(term) < 3:
+            continue
+        term_dates = doc_dates[np.fromiter(docs, dtype=np.int64, count=len(docs))]
+        recent = int((term_dates > recent_start).sum())
+        if recent < 2:
+            continue
+        prior = int(((term_dates > prior_start) & (term_dates <= recent_start)).sum())
+        trends.append({"term": term, "recent_tickets": recent, "previous_tickets": prior})
+
+    trends.sort(key=lambda t: (t["recent_tickets"] - t["previous_tickets"], t["recent_tickets"]), reverse=True)
+    return trends[:top_n]
+
+
+# --- Customer Cohorts ---
+# Cohort = signup month; activity is measured in whole months since signup (0 .. COHORT_MAX_MONTHS-1).
+# Customers are integer-coded with pd.factorize and every matrix is one np.bincount over
+# (cohort, month offset) codes, so a load with millions of customers is a few vector passes.
+# Results are cached per (snapshot version, merchant); transactions dated before a customer's
+# signup month are ignored.
+COHORT_MAX_MONTHS = 12
+COHORT_METRICS = ('retention', 'revenue', 'repeat')
+_cohort_cache = {} # (snapshot version, merchant) -> cohort dict
+_cohort_cache_lock = threading.Lock()
+
+def _month_number(dates):
+    # Months since 1970-01 (NaT becomes a large negative number; callers mask it out first)
+    return dates.to_numpy(dtype='datetime64[ns]').astype('datetime64[M]').astype(np.int64)
+
+def compute_customer_cohorts(transactions_with_customers, max_months=COHORT_MAX_MONTHS):
+    empty = {'cohorts': [], 'cohort_sizes': np.zeros(0, dtype=np.int64), 'active_customers': np.zeros((0, max_months), dtype=np.int64),
+             'revenue_paise': np.zeros((0, max_months), dtype=np.int64), 'repeat_customers': np.zeros((0, max_months), dtype=np.int64)}
+    if transactions_with_customers.empty or 'signup_date' not in transactions_with_customers.columns:
+        return empty
+    rows = transactions_with_customers.loc[
+        transactions_with_customers['status'] == 'Success',
+        ['customer_id', 'signup_date', 'transaction_date', 'transaction_time', 'amount_paise']
+    ]
+    # signup_date is an ISO string per row but there are few distinct values, so parse those only
+    signup_codes, signup_values = pd.factorize(rows['signup_date'])
+    signup_dates = pd.to_datetime(pd.Series(signup_values), errors='coerce')
+    signup_valid = np.r_[signup_dates.notna().to_numpy(), False][signup_codes] # Code -1 (missing) picks the False
+    keep = rows['customer_id'].notna().to_numpy() & signup_valid & rows['transaction_date'].notna().to_numpy()
+    signup_month = _month_number(signup_dates)[signup_codes][keep]
+    offsets = _month_number(rows['transaction_date'])[keep] - signup_month
+    in_window = (offsets >= 0) & (offsets < max_months)
+    if not in_window.any():
+        return empty
+
+    rows = rows[keep][in_window]
+    offsets = offsets[in_window].astype(np.int64)
+    customer_codes, _ = pd.factorize(rows['customer_id'])
+    cohort_codes, cohort_months = pd.factorize(signup_month[in_window], sort=True)
+    n_customers, n_cohorts = int(customer_codes.max()) + 1, len(cohort_months)
+    cell_codes = cohort_codes * max_months + offsets
+    cells = n_cohorts * max_months
+
+    customer_cohort = np.empty(n_customers, dtype=np.int64)
+    customer_cohort[customer_codes] = cohort_codes # Signup month is per customer, so any row will do
+    cohort_sizes = np.bincount(customer_cohort, minlength=n_cohorts)
+
+    # Distinct (customer, month offset) pairs -> active customers per cell
+    active_pairs = np.zeros(n_customers * max_months, dtype=bool)
+    active_pairs[customer_codes * max_months + offsets] = True
+    pair_ids = np.flatnonzero(active_pairs)
+    active_customers = np.bincount(customer_cohort[pair_ids // max_months] * max_months + pair_ids % max_months, minlength=cells)
+
+    revenue_paise = np.rint(np.bincount(cell_codes, weights=rows['amount_paise'].to_numpy(dtype=np.float64), minlength=cells)).astype(np.int64)
+
+    # Month offset of each customer's second purchase -> cumulative repeat customers per cohort
+    order = np.lexsort((rows['transaction_time'].to_numpy(), customer_codes))
+    sorted_customers = customer_codes[order]
+    positions = np.arange(len(order))
+    group_starts = np.maximum.accumulate(np.where(np.r_[True, sorted_customers[1:] != sorted_customers[:-1]], positions, 0))
+    second_rows = order[positions - group_starts == 1] # Rank 1 within each customer's purchases
+    repeat_customers = np.cumsum(np.bincount(cell_codes[second_rows], minlength=cells).reshape(n_cohorts, max_months), axis=1)
+
+    return {
+        'cohorts': [f"{1970 + month // 12:04d}-{month % 12 + 1:02d}" for month in cohort_months],
+        'cohort_sizes': cohort_sizes,
+        'active_customers': active_customers.reshape(n_cohorts, max_months),
+        'revenue_paise': revenue_paise.reshape(n_cohorts, max_months),
+        'repeat_customers': repeat_customers
+    }
+
+def get_customer_cohorts():
+    # Cohorts for the pinned snapshot and active merchant, computed once per snapshot version
+    snapshot = get_snapshot()
+    key = (snapshot['version'], get_active_merchant())
+    cohorts = _cohort_cache.get(key)
+    record_cache_lookup('cohorts', cohorts is not None)
+    if cohorts is None:
+        with timed_block('helper_duration_seconds', helper='compute_customer_cohorts'):
+            cohorts = compute_customer_cohorts(get_scoped_frame('transactions_with_customers'))
+        with _cohort_cache_lock:
+            for stale_key in [k for k in _cohort_cache if k[0] != snapshot['version']]:
+                del _cohort_cache[stale_key]
+            _cohort_cache[key] = cohorts
+    return cohorts
+
+def _observed_months(cohorts):
+    # Month offsets each cohort has actually lived through (later cells are not zero retention, just unknown)
+    latest = datetime.date.today().year * 12 + datetime.date.today().month - 1
+    starts = np.array([int(c[:4]) * 12 + int(c[5:]) - 1 for c in cohorts['cohorts']], dtype=np.int64)
+    return np.minimum(latest - starts + 1, COHORT_MAX_MONTHS)
+
+def cohort_matrix(metric='retention'):
+    # JSON-ready matrix for /api/cohorts: one row per signup month, one column per month since signup
+    if metric not in COHORT_METRICS:
+        raise ValueError(f"metric must be one of: {', '.join(COHORT_METRICS)}")
+    cohorts = get_customer_cohorts()
+    sizes = cohorts['cohort_sizes']
+    observed = _observed_months(cohorts)
+    if metric == 'retention':
+        values = cohorts['active_customers'] / np.maximum(sizes, 1)[:, None] * 100
+    elif metric == 'repeat':
+        values = cohorts['repeat_customers'] / np.maximum(sizes, 1)[:, None] * 100
+    else:
+        values = paise_to_rupees(cohorts['revenue_paise'])
+    return {
+        "metric": metric,
+        "months_since_signup": list(range(COHORT_MAX_MONTHS)),
+        "cohorts": [
+            {"cohort": cohort, "customers": int(size), "values": [round(float(v), 2) for v in row[:months]]}
+            for cohort, size, row, months in zip(cohorts['cohorts'], sizes, values, observed)
+        ]
+    }
+
+def _weighted_curve(counts, sizes, observed):
+    # Pools cohorts per month offset, counting only cohorts old enough to have reached that offset
+    reached = np.arange(COHORT_MAX_MONTHS)[None, :] < observed[:, None]
+    customers = (sizes[:, None] * reached).sum(axis=0)
+    numerators = (counts * reached).sum(axis=0)
+    months = int((customers > 0).sum())
+    return (numerators[:months] / customers[:months] * 100).round(2), months
+
+@instrumented_helper
+def analyze_customer_cohorts(metric='retention'):
+    cohorts = get_customer_cohorts()
+    if not cohorts['cohorts']:
+        return {"answer": "No successful transactions with customer signup dates were found to build cohorts.",
+                "chartData": {"labels": [], "data": [], "type": "line"}}
+
+    sizes = cohorts['cohort_sizes']
+    observed = _observed_months(cohorts)
+    summary = f"Built **{len(cohorts['cohorts'])}** monthly signup cohorts covering **{int(sizes.sum()):,}** paying customers."
+    if metric == 'revenue':
+        revenue = cohorts['revenue_paise'].sum(axis=1)
+        top = int(revenue.argmax())
+        answer = (f"{summary} The **{cohorts['cohorts'][top]}** cohort has generated the most revenue: "
+                  f"**{format_rupees(revenue[top])}** from {int(sizes[top]):,} customers "
+                  f"({format_rupees(revenue[top] // max(int(sizes[top]), 1))} per customer).<br>The chart shows total revenue by signup cohort.")
+        return {"answer": answer, "chartData": {"labels": cohorts['cohorts'], "data": paise_to_rupees(revenue).tolist(), "type": "bar"}}
+
+    counts = cohorts['repeat_customers'] if metric == 'repeat' else cohorts['active_customers']
+    curve, months = _weighted_curve(counts, sizes, observed)
+    labels = [f"Month {m}" for m in range(months)]
+    if metric == 'repeat':
+        answer = (f"{summary} **{curve[-1]:.2f}%** of customers made a second purchase within {months} months of signing up"
+                  + (f" (**{curve[0]:.2f}%** within their signup month)" if months > 1 else "") + ".<br>"
+                  "The chart shows the cumulative share of customers with a repeat purchase by month since signup.")
+    else:
+        tail = curve[1:] if months > 1 else curve
+        answer = (f"{summary} On average **{tail.mean():.2f}%** of a cohort is active in a month after signup"
+                  + (f", and **{curve[-1]:.2f}%** are still buying {months - 1} months in" if months > 1 else "") + ".<br>"
+                  "The chart shows the share of each cohort active by month since signup (all cohorts pooled).")
+    return {"answer": answer, "chartData": {"labels": labels, "data": curve.tolist(), "type": "line"}}
+
+
+# --- Time-Series API ---
+# /api/timeseries answers chart refreshes straight from the time-bucket indexes, without the
+# keyword router or the LLM. Responses carry an ETag derived from the snapshot version and the
+# query, so a polling dashboard gets a 304 until the data is reloaded or tickets change it.
+TIMESERIES_METRICS = {
+    # metric: (index source, index column)
+    'transactions': ('transactions', 'count'),
+    'amount': ('transactions', 'amount_paise'),
+    'success_rate': ('transactions', 'count'),
+    'refunds': ('refunds', 'count'),
+    'refund_amount': ('refunds', 'amount_paise')
+}
+TIMESERIES_GROUPS = ('method', 'status', 'merchant')
+TIMESERIES_DEFAULT_DAYS = 30
+TIMESERIES_MAX_BUCKETS = 5000
+
+def timeseries_etag(params):
+    snapshot = get_snapshot()
+    key = json.dumps([get_active_merchant(), sorted(params.items())])
+    return f"v{snapshot['version']}-{hashlib.sha1(key.encode()).hexdigest()[:16]}"
+
+def _timeseries_values(metric, start, end, granularity, group_by=None, method_keyword=None, status=None):
+    # Series indexed by bucket (or bucket x group) for the active merchant scope
+    source, column = TIMESERIES_METRICS[metric]
+    rows = query_time_bucket_range(source, start, end, granularity, method_keyword, None if metric == 'success_rate' else status)
+    keys = ['bucket'] + ({'method': ['method_code'], 'status': ['status']}.get(group_by, []))
+    if metric == 'success_rate':
+        totals = rows.groupby(keys)['count'].sum()
+        successes = rows[rows['status'] == 'Success'].groupby(keys)['count'].sum().reindex(totals.index, fill_value=0)
+        return (successes / totals * 100).round(2)
+    values = rows.groupby(keys)[column].sum()
+    return paise_to_rupees(values).round(2) if column == 'amount_paise' else values
+
+@instrumented_helper
+def get_timeseries(metric='transactions', start_date=None, end_date=None, granularity='day', group_by=None, method_keyword=None, status=None):
+    # Returns a table with one row per bucket and one column per group ('total' when ungrouped).
+    # Raises ValueError for invalid parameters.
+    if metric not in TIMESERIES_METRICS:
+        raise ValueError(f"metric must be one of: {', '.join(TIMESERIES_METRICS)}.")
+    if granularity not in TIME_BUCKET_FREQUENCIES and granularity not in TIME_BUCKET_ROLLUPS:
+        raise ValueError(f"granularity must be one of: {', '.join([*TIME_BUCKET_FREQUENCIES, *TIME_BUCKET_ROLLUPS])}.")
+    if group_by is not None and group_by not in TIMESERIES_GROUPS:
+        raise ValueError(f"group_by must be one of: {', '.join(TIMESERIES_GROUPS)}.")
+    if metric == 'success_rate' and group_by == 'status':
+        raise ValueError("success_rate cannot be grouped by status.")
+    if TIMESERIES_METRICS[metric][0] in TIME_BUCKET_DAILY_SOURCES and granularity in TIME_BUCKET_FREQUENCIES:
+        raise ValueError(f"{metric} is only recorded per day; use day, week or month granularity.")
+
+    end = pd.Timestamp(end_date) if end_date else pd.Timestamp(datetime.date.today())
+    start = pd.Timestamp(start_date) if start_date else end - pd.Timedelta(days=TIMESERIES_DEFAULT_DAYS)
+    if granularity in TIME_BUCKET_ROLLUPS: # Include the whole week / month that `from` falls in
+        start = start.to_period(TIME_BUCKET_ROLLUPS[granularity][1]).start_time
+    status = status.capitalize() if status else None
+    end_exclusive = end + pd.Timedelta(days=1)
+
+    if group_by == 'merchant':
+        merchant = get_active_merchant()
+        merchants = [merchant] if merchant else list(get_snapshot()['merchant_partitions'])
+        columns = {}
+        for name in merchants:
+            with merchant_scope(name):
+                columns[name] = _timeseries_values(metric, start, end_exclusive, granularity, None, method_keyword, status)
+        table = pd.DataFrame(columns)
+    else:
+        values = _timeseries_values(metric, start, end_exclusive, granularity, group_by, method_keyword, status)
+        table = values.unstack() if group_by else values.to_frame('total')
+        if group_by == 'method':
+            table = table.rename(columns=METHOD_NAMES)
+
+    table = table.sort_index()
+    if len(table) > TIMESERIES_MAX_BUCKETS:
+        raise ValueError(f"That range has {len(table):,} {granularity} buckets; use a coarser granularity or a shorter range.")
+    if metric != 'success_rate':
+        table = table.fillna(0) # A bucket with no rows for a group is a true zero
+    return table, start, end
+
+def timeseries_payload(table, metric, granularity, start, end):
+    bucket_format = '%Y-%m-%dT%H:%M' if granularity in TIME_BUCKET_FREQUENCIES else '%Y-%m-%d'
+    is_count = TIMESERIES_METRICS[metric][1] == 'count' and metric != 'success_rate'
+    series = []
+    for name in table.columns:
+        column = table[name].astype('int64') if is_count else table[name]
+        series.append({"name": str(name), "data": column.astype(object).where(column.notna(), None).tolist()})
+    return {
+        "metric": metric,
+        "granularity": granularity,
+        "from": start.date().isoformat(),
+        "to": end.date().isoformat(),
+        "unit": "count" if is_count else ("percent" if metric == 'success_rate' else "INR"),
+        "labels": [bucket.strftime(bucket_format) for bucket in table.index],
+        "series": series,
+        "version": get_snapshot()['version']
+    }
+
+
+# --- Bulk Export ---
+# /export/<dataset> streams the rows behind an insight as chunked CSV or an Arrow IPC stream.
+# The pinned frame is filtered and serialized EXPORT_CHUNK_ROWS rows at a time, so memory stays
+# flat however many rows match. CSV carries rupees; Arrow keeps the exact int64 *_paise columns.
+EXPORT_CHUNK_ROWS = 50000
+EXPORT_DATE_COLUMNS = {'transactions': 'transaction_date', 'refunds': 'refund_date', 'settlements': 'settlement_date'}
+EXPORT_HIDDEN_COLUMNS = {'method_code', 'method_groups'}
+EXPORT_MIMETYPES = {'csv': 'text/csv', 'arrow': 'application/vnd.apache.arrow.stream'}
+
+def export_row_filter(dataset, frame, start_date=None, end_date=None, method_keyword=None, status=None):
+    # Returns chunk -> boolean row mask for the given filters; raises ValueError for filters that can't apply
+    date_col = EXPORT_DATE_COLUMNS[dataset]
+    start = pd.Timestamp(start_date) if start_date else None
+    end = pd.Timestamp(end_date) + pd.Timedelta(days=1) if end_date else None
+    if status and 'status' not in frame.columns:
+        raise ValueError(f"{dataset} rows have no status to filter on.")
+
+    method_lookup = None
+    if method_keyword and 'method_code' not in frame.columns:
+        # Refunds carry no payment method of their own; borrow it from the original transaction
+        transactions = get_scoped_frame('transactions')
+        if dataset != 'refunds' or 'transaction_id' not in frame.columns or 'method_code' not in transactions.columns:
+            raise ValueError(f"{dataset} rows have no payment method to filter on.")
+        method_lookup = transactions.drop_duplicates('transaction_id').set_index('transaction_id')[['method_code', 'method_groups']]
+
+    def chunk_mask(chunk):
+        mask = np.ones(len(chunk), dtype=bool)
+        if start is not None:
+            mask &= (chunk[date_col] >= start).to_numpy()
+        if end is not None:
+            mask &= (chunk[date_col] < end).to_numpy()
+        if status:
+            mask &= (chunk['status'].str.lower() == status.lower()).to_numpy()
+        if method_keyword:
+            if method_lookup is not None:
+                methods = method_lookup.reindex(chunk['transaction_id']).fillna(0).astype(np.int8)
+                mask &= payment_method_mask(methods, method_keyword).to_numpy()
+            else:
+                mask &= payment_method_mask(chunk, method_keyword).to_numpy()
+        return mask
+    return chunk_mask
+
+def _export_chunks(frame, chunk_mask):
+    columns = [col for col in frame.columns if col not in EXPORT_HIDDEN_COLUMNS]
+    for start in range(0, len(frame), EXPORT_CHUNK_ROWS):
+        chunk = frame.iloc[start:start + EXPORT_CHUNK_ROWS]
+        mask = chunk_mask(chunk)
+        if mask.any():
+            yield chunk.loc[mask, columns]
+
+def stream_export_csv(frame, chunk_mask):
+    columns = [col for col in frame.columns if col not in EXPORT_HIDDEN_COLUMNS]
+    paise_columns = [col for col in columns if col.endswith('_paise')]
+    rupee_names = {col: col[:-len('_paise')] for col in paise_columns}
+    yield ','.join(rupee_names.get(col, col) for col in columns) + '\n'
+    for rows in _export_chunks(frame, chunk_mask):
+        rows = rows.assign(**{col: paise_to_rupees(rows[col]) for col in paise_columns})
+        yield rows.to_csv(index=False, header=False, float_format='%.2f')
+
+def stream_export_arrow(frame, chunk_mask):
+    import pyarrow as pa
+    sink = io.BytesIO()
+    schema = None
+    writer = None
+    for rows in _export_chunks(frame, chunk_mask):
+        batch = pa.RecordBatch.from_pandas(rows, schema=schema, preserve_index=False)
+        if writer is None:
+            schema = batch.schema
+            writer = pa.ipc.new_stream(sink, schema)
+        writer.write_batch(batch)
+        yield sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+    if writer is None: # No matching rows: still send a valid, empty stream
+        columns = [col for col in frame.columns if col not in EXPORT_HIDDEN_COLUMNS]
+        writer = pa.ipc.new_stream(sink, pa.Schema.from_pandas(frame[columns].iloc[0:0], preserve_index=False))
+    writer.close()
+    yield sink.getvalue()
+
+
+# --- LLM Tools ---
+# Analysis helpers the model can call in tool-calling mode. Each tool has a JSON schema the
+# arguments are validated against before anything runs, and a runner that calls the helper and
+# converts paise to rupee strings. Runners may return {'answer', 'chartData'}; the chart is kept
+# for the response instead of being sent back to the model.
+_DATE_PARAMETER = {'type': 'string', 'format': 'date', 'description': 'Date as YYYY-MM-DD.'}
+_PERIOD_PARAMETER = {'type': 'string', 'enum': list(PERIOD_LOOKBACK_DAYS), 'description': 'Lookback window ending today.'}
+
+def _tool_parameters(properties=None, required=()):
+    return {'type': 'object', 'properties': properties or {}, 'required': list(required), 'additionalProperties': False}
+
+def _tool_refunds_yesterday():
+    count, amount_paise = get_refunds_yesterday()
+    return {'refund_count': count, 'refund_amount': format_rupees(amount_paise)}
+
+def _tool_payment_method_performance(period='week'):
+    return [
+        {'payment_method': p['payment_method'], 'total_amount': format_rupees(p['total_amount_paise']),
+         'num_transactions': int(p['num_transactions']), 'avg_transaction_value': format_rupees(p['avg_transaction_value_paise'])}
+        for p in get_payment_method_performance(period)
+    ]
+
+def _tool_search_support_tickets(query, limit=10):
+    tickets, total = search_support_tickets(query, limit=limit)
+    return {
+        'total_matches': total,
+        'tickets': [
+            {'created': row.ticket_created_time.date().isoformat(),
+             'category': row.category if isinstance(row.category, str) else None,
+             'subject': row.subject if isinstance(row.subject, str) else None}
+            for row in tickets.itertuples()
+        ]
+    }
+
+LLM_TOOLS = {
+    'get_total_amount_received': {
+        'description': 'Total amount of successful payments received on a date.',
+        'parameters': _tool_parameters({'date': {**_DATE_PARAMETER, 'description': 'Date as YYYY-MM-DD; defaults to today.'}}),
+        'run': lambda date=None: {'date': (date or datetime.date.today()).isoformat(), 'amount': format_rupees(get_total_amount_received(date))}
+    },
+    'get_refunds_yesterday': {
+        'description': "Count and total amount of yesterday's completed refunds.",
+        'parameters': _tool_parameters(),
+        'run': _tool_refunds_yesterday
+    },
+    'get_payment_method_performance': {
+        'description': 'Successful amount, transaction count and average value per payment method.',
+        'parameters': _tool_parameters({'period': _PERIOD_PARAMETER}),
+        'run': _tool_payment_method_performance
+    },
+    'analyze_refund_spike_root_cause': {
+        'description': 'Explains what drove completed refunds on a date (most common reason, linked gateway timeouts).',
+        'parameters': _tool_parameters({'date': {**_DATE_PARAMETER, 'description': 'Date as YYYY-MM-DD; defaults to yesterday.'}}),
+        'run': lambda date=None: analyze_refund_spike_root_cause(date)
+    },
+    'summarize_refund_spikes': {
+        'description': 'Ranks the worst completed-refund days against the days before each one, with dominant reasons and gateway-timeout links. Omit period to scan the whole history.',
+        'parameters': _tool_parameters({'period': _PERIOD_PARAMETER}),
+        'run': lambda period=None: summarize_refund_spikes(period)
+    },
+    'analyze_payment_method_trend': {
+        'description': 'Change in successful amount for a payment method against the previous period, with a daily chart.',
+        'parameters': _tool_parameters({
+            'method': {'type': 'string', 'description': "Payment method or family, e.g. 'UPI', 'Credit Card', 'Wallet', 'Mobile' (UPI and wallets)."},
+            'period': _PERIOD_PARAMETER
+        }, required=['method']),
+        'run': lambda method, period='week': analyze_payment_method_trend(method, period)
+    },
+    'analyze_customer_payment_behavior': {
+        'description': 'Repeat rate and average order value of customers paying with a method, compared to all customers.',
+        'parameters': _tool_parameters({'payment_method': {'type': 'string', 'description': "e.g. 'UPI' or 'Credit Card'."}}),
+        'run': lambda payment_method='UPI': analyze_customer_payment_behavior(payment_method)
+    },
+    'generate_emi_recommendation': {
+        'description': 'Recommendation on offering EMI for orders above a value in rupees.',
+        'parameters': _tool_parameters({'min_order_value': {'type': 'integer', 'minimum': 0, 'maximum': 10000000}}),
+        'run': lambda min_order_value=5000: generate_emi_recommendation(min_order_value)
+    },
+    'predict_weekend_transactions': {
+        'description': 'Forecast of successful transactions for the upcoming weekend.',
+        'parameters': _tool_parameters(),
+        'run': predict_weekend_transactions
+    },
+    'get_success_rate_and_benchmark': {
+        'description': 'Overall payment success rate compared with the industry average.',
+        'parameters': _tool_parameters(),
+        'run': get_success_rate_and_benchmark
+    },
+    'analyze_success_rate_segments': {
+        'description': 'Success rate for a slice of payments (method, hour range, city, merchant) and the segments adding the most failures.',
+        'parameters': _tool_parameters({
+            'method': {'type': 'string', 'description': "Payment method or group, e.g. 'UPI', 'Credit Card', 'Mobile', 'Card'."},
+            'start_hour': {'type': 'integer', 'minimum': 0, 'maximum': 23, 'description': 'First hour of day included (0-23).'},
+            'end_hour': {'type': 'integer', 'minimum': 1, 'maximum': 24, 'description': 'Hour of day the range ends before (1-24).'},
+            'city': {'type': 'string', 'description': 'City name.'}
+        }),
+        'run': lambda method=None, start_hour=None, end_hour=None, city=None: analyze_success_rate_segments(method, start_hour, end_hour, city)
+    },
+    'analyze_transaction_volume_deviation': {
+        'description': "Today's successful transaction count against the 30-day daily average.",
+        'parameters': _tool_parameters(),
+        'run': lambda: analyze_transaction_volume_deviation('day') or 'No unusual transaction volume today.'
+    },
+    'summarize_settlement_reconciliation': {
+        'description': 'Settlement matching (matched, unmatched, short-paid) and fee-rate drift, with a daily fee-rate chart.',
+        'parameters': _tool_parameters(),
+        'run': summarize_settlement_reconciliation
+    },
+    'search_support_tickets': {
+        'description': "Support tickets whose subject or category match a query (terms, 'prefix*', \"exact phrase\"), newest first.",
+        'parameters': _tool_parameters({
+            'query': {'type': 'string'},
+            'limit': {'type': 'integer', 'minimum': 1, 'maximum': 20}
+        }, required=['query']),
+        'run': _tool_search_support_tickets
+    },
+}
+LLM_TOOL_SPECS = [
+    {'type': 'function', 'function': {'name': name, 'description': tool['description'], 'parameters': tool['parameters']}}
+    for name, tool in LLM_TOOLS.items()
+]
+
+def validate_tool_arguments(parameters, raw_arguments):
+    # Returns the arguments as helper keyword arguments (dates parsed); raises ValueError with a
+    # message the model can act on
+    try:
+        arguments = json.loads(raw_arguments or '{}')
+    except json.JSONDecodeError as e:
+        raise ValueError(f"arguments are not valid JSON: {e}")
+    if not isinstance(arguments, dict):
+        raise ValueError("arguments must be a JSON object")
+
+    properties = parameters['properties']
+    unknown = sorted(set(arguments) - set(properties))
+    if unknown:
+        raise ValueError(f"unknown argument(s): {', '.join(unknown)}")
+    missing = [name for name in parameters['required'] if arguments.get(name) is None]
+    if missing:
+        raise ValueError(f"missing required argument(s): {', '.join(missing)}")
+
+    kwargs = {}
+    for name, value in arguments.items():
+        if value is None:
+            continue
+        spec = properties[name]
+        if spec['type'] == 'integer':
+            if isinstance(value, bool) or not isinstance(value, int):
+                raise ValueError(f"'{name}' must be an integer")
+            if not spec.get('minimum', value) <= value <= spec.get('maximum', value):
+                raise ValueError(f"'{name}' must be between {spec['minimum']} and {spec['maximum']}")
+        elif spec['type'] == 'string':
+            if not isinstance(value, str) or not value.strip():
+                raise ValueError(f"'{name}' must be a non-empty string")
+            if 'enum' in spec and value not in spec['enum']:
+                raise ValueError(f"'{name}' must be one of: {', '.join(spec['enum'])}")
+            if spec.get('format') == 'date':
+                try:
+                    value = datetime.date.fromisoformat(value)
+                except ValueError:
+                    raise ValueError(f"'{name}' must be a date as YYYY-MM-DD")
+        kwargs[name] = value
+    return kwargs
+
+def run_llm_tool(name, raw_arguments, charts):
+    # Runs one tool call and returns the JSON string sent back to the model
+    tool = LLM_TOOLS.get(name)
+    if tool is None:
+        increment_counter('llm_tool_calls_total', tool='unknown', outcome='invalid')
+        return compact_json({'error': f"Unknown tool '{name}'."})
+    try:
+        kwargs = validate_tool_arguments(tool['parameters'], raw_arguments)
+    except ValueError as e:
+        increment_counter('llm_tool_calls_total', tool=name, outcome='invalid')
+        return compact_json({'error': f"Invalid arguments for {name}: {e}"})
+    try:
+        result = tool['run'](**kwargs)
+    except Exception as e:
+        increment_counter('llm_tool_calls_total', tool=name, outcome='error')
+        logger.warning(f"LLM tool {name} failed: {e}")
+        return compact_json({'error': f"{name} failed: {e}"})
+    increment_counter('llm_tool_calls_total', tool=name, outcome='success')
+    if isinstance(result, dict) and 'chartData' in result:
+        if result['chartData'].get('data'):
+            charts.append(result['chartData'])
+        result = {key: value for key, value in result.items() if key != 'chartData'}
+    return truncate_to_tokens(compact_json({'result': result}), LLM_TOOL_RESULT_TOKEN_BUDGET)
+
+
+# --- Prompt Building ---
+# Static: identical bytes on every call, so it (with the tool list) forms the cached prompt prefix
+AI_SYSTEM_PROMPT = """You are an intelligent payment insights assistant for online merchants.
+Your goal is to provide concise, actionable, and data-backed answers and insights based on the provided payment data.
+If the user's query is about a specific metric, provide the direct answer.
+If the query is about trends, comparisons, or root causes, use the provided data to explain "why" or "how".
+Always try to format numerical values clearly (e.g., ₹1,234.56, 15%).
+If chart data is returned, clearly state what the chart represents in the answer.
+If you cannot fulfill a request, politely state so and, if relevant, mention the available data range listed under "Facts" in the user's message.
+Be proactive in suggesting additional insights when relevant.
+Data comes from the backend context in the user's message or, when tools are offered, from tool calls: request only what the query needs. Amounts are in rupees. If a tool returns an error, fix the arguments or answer with the data you have.
+Output format: always return a JSON object {"question": "<the merchant's question>", "answer": "<the answer, may contain HTML <br>>", "chartData": {"labels": [...], "data": [...], "type": "line" | "bar" | "pie"}}. Use {} for chartData when no chart applies."""
+
+def compact_json(value):
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False, default=str)
+
+def _get_token_encoder():
+    global _token_encoder
+    if _token_encoder is None:
+        try:
+            import tiktoken
+            _token_encoder = tiktoken.get_encoding('o200k_base') # gpt-4o's encoding
+        except Exception: # Not installed, or its BPE file cannot be fetched
+            _token_encoder = False
+    return _token_encoder
+
+def count_tokens(text):
+    encoder = _get_token_encoder()
+    if encoder:
+        return len(encoder.encode(text))
+    return (len(text.encode('utf-8')) + 3) // 4 # About 4 bytes per token for English text and JSON
+
+def truncate_to_tokens(text, max_tokens):
+    if count_tokens(text) <= max_tokens:
+        return text
+    marker = ' …[truncated]'
+    keep = max(max_tokens - count_tokens(marker), 0)
+    encoder = _get_token_encoder()
+    if encoder:
+        return encoder.decode(encoder.encode(text)[:keep]) + marker
+    return text.encode('utf-8')[:keep * 4].decode('utf-8', errors='ignore') + marker
+
+def _data_range_info():
+    transactions_df = get_scoped_frame('transactions')
+    refunds_df = get_scoped_frame('refunds')
     # Determine the date range of the actual loaded data
     txn_min_date = transactions_df['transaction_date'].min().date().isoformat() if not transactions_df.empty and 'transaction_date' in transactions_df.columns and not transactions_df['transaction_date'].isnull().all() else "N/A"
     txn_max_date = transactions_df['transaction_date'].max().date().isoformat() if not transactions_df.empty and 'transaction_date' in transactions_df.columns and not transactions_df['transaction_date'].isnull().all() else "N/A"
     refund_min_date = refunds_df['refund_date'].min().date().isoformat() if not refunds_df.empty and 'refund_date' in refunds_df.columns and not refunds_df['refund_date'].isnull().all() else "N/A"
     refund_max_date = refunds_df['refund_date'].max().date().isoformat() if not refunds_df.empty and 'refund_date' in refunds_df.columns and not refunds_df['refund_date'].isnull().all() else "N/A"
 
-    data_range_info = (
+    return (
         f"Available Transaction Data: {txn_min_date} to {txn_max_date}. "
-        f"Available Refund Data: {refund_min_date} to {refund_max_date}. "
-        f"Please try querying dates within these ranges."
+        f"Available Refund Data: {refund_min_date} to {refund_max_date}."
     )
 
-    context_str = ""
-    if context_data:
-        for key, value in context_data.items():
-            if isinstance(value, list) or isinstance(value, dict):
-                context_str += f"- {key}: {json.dumps(value, indent=2)}\n"
-            else:
-                context_str += f"- {key}: {value}\n"
+def build_ai_user_message(query, context_items=(), reserved_tokens=0):
+    # context_items: (label, value) pairs, highest priority first. Layout is query, context, then the
+    # per-call facts. The system prompt, this message and reserved_tokens (e.g. the tool list) stay
+    # within LLM_PROMPT_TOKEN_BUDGET.
+    head = f"My query: {query}"
+    tail = f"\n\nFacts: Today is {datetime.date.today().isoformat()}. {_data_range_info()}"
+    remaining = (LLM_PROMPT_TOKEN_BUDGET - reserved_tokens - 2 * LLM_MESSAGE_OVERHEAD_TOKENS
+                 - count_tokens(AI_SYSTEM_PROMPT) - count_tokens(head) - count_tokens(tail))
+
+    lines = []
+    for label, value in context_items:
+        line = f"- {label}: {value if isinstance(value, str) else compact_json(value)}"
+        cost = count_tokens(line) + 1 # +1 for the newline
+        if cost > remaining:
+            if remaining >= LLM_MIN_CONTEXT_ITEM_TOKENS:
+                lines.append(truncate_to_tokens(line, remaining - 1))
+            break
+        lines.append(line)
+        remaining -= cost
+    if len(lines) < len(context_items) or (lines and lines[-1].endswith('[truncated]')):
+        trace_event('prompt_context_truncated', kept=len(lines), total=len(context_items), budget=LLM_PROMPT_TOKEN_BUDGET)
+
+    context = "\n\nRelevant data provided by backend:\n" + "\n".join(lines) if lines else ""
+    return head + context + tail
+
+@functools.lru_cache(maxsize=None)
+def tool_specs_tokens():
+    # LLM_TOOL_SPECS never changes, so it is counted once
+    return count_tokens(compact_json(LLM_TOOL_SPECS))
+
+def count_message_tokens(messages):
+    total = 0
+    for message in messages:
+        total += LLM_MESSAGE_OVERHEAD_TOKENS + count_tokens(message.get('content') or '')
+        for call in message.get('tool_calls', ()):
+            total += count_tokens(call['function']['name']) + count_tokens(call['function']['arguments'] or '')
+    return total
+
+def fit_tool_results_to_budget(messages):
+    # Cuts tool results, oldest first, to LLM_TRIMMED_TOOL_RESULT_TOKENS until the messages and the
+    # tool list fit LLM_PROMPT_TOKEN_BUDGET. Messages are replaced, never edited in place.
+    excess = count_message_tokens(messages) + tool_specs_tokens() - LLM_PROMPT_TOKEN_BUDGET
+    trimmed = 0
+    for position, message in enumerate(messages):
+        if excess <= 0:
+            break
+        if message['role'] != 'tool':
+            continue
+        content = truncate_to_tokens(message['content'], LLM_TRIMMED_TOOL_RESULT_TOKENS)
+        saved = count_tokens(message['content']) - count_tokens(content)
+        if saved > 0:
+            messages[position] = {**message, 'content': content}
+            excess -= saved
+            trimmed += 1
+    if trimmed:
+        trace_event('prompt_tool_results_trimmed', trimmed=trimmed, over_budget=max(excess, 0), budget=LLM_PROMPT_TOKEN_BUDGET)
+
 
+# --- AI (OpenAI GPT) Integration ---
+def _is_transient_llm_error(e):
+    status_code = getattr(e, 'status_code', None)
+    if status_code is not None:
+        return status_code in (408, 409, 429) or status_code >= 500
+    import openai # Already imported by get_openai_client whenever a call was attempted
+    return isinstance(e, openai.APIConnectionError) # Includes APITimeoutError
+
+def llm_circuit_allows_call():
+    with _llm_circuit_lock:
+        if _llm_circuit['state'] == 'closed':
+            return True
+        if _llm_circuit['state'] == 'open' and time.time() - _llm_circuit['opened_at'] >= LLM_CIRCUIT_RESET_SECONDS:
+            _llm_circuit['state'] = 'half_open' # This caller is the single trial
+            return True
+        return False
+
+def record_llm_outcome(success):
+    with _llm_circuit_lock:
+        if success:
+            _llm_circuit.update(state='closed', failures=0)
+        else:
+            _llm_circuit['failures'] += 1
+            if _llm_circuit['state'] == 'half_open' or _llm_circuit['failures'] >= LLM_CIRCUIT_FAILURE_THRESHOLD:
+                _llm_circuit.update(state='open', opened_at=time.time())
+        set_gauge('llm_circuit_open', 0 if _llm_circuit['state'] == 'closed' else 1)
+
+def call_openai_with_retries(kwargs):
+    # The circuit is checked once and told one outcome per logical call, retries included. Only
+    # transient errors (timeouts, 429, 5xx) count as failures: a bad request, rejected key or missing
+    # credentials says nothing about whether the API is up, and still ends a half-open trial.
+    if not llm_circuit_allows_call():
+        increment_counter('llm_calls_total', outcome='circuit_open')
+        raise RuntimeError("OpenAI circuit breaker is open")
+    for attempt in range(LLM_RETRY_ATTEMPTS + 1):
+        try:
+            with timed_block('llm_call_duration_seconds', model="gpt-4o"), trace_span('openai.chat.completions.create', model="gpt-4o", attempt=attempt):
+                response = get_openai_client().chat.completions.create(model="gpt-4o", **kwargs)
+        except Exception as e:
+            transient = _is_transient_llm_error(e)
+            if attempt == LLM_RETRY_ATTEMPTS or not transient:
+                record_llm_outcome(success=not transient)
+                increment_counter('llm_calls_total', outcome='error')
+                raise
+            increment_counter('llm_calls_total', outcome='retry')
+            time.sleep(random.uniform(0, LLM_RETRY_BASE_DELAY_SECONDS * 2 ** attempt))
+            continue
+        record_llm_outcome(success=True)
+        increment_counter('llm_calls_total', outcome='success')
+        return response
+
+def create_chat_completion(**kwargs):
+    # Single call site for OpenAI chat completions. Concurrent calls with identical arguments against
+    # the same data share one upstream call (and its result or error).
+    scope = [get_snapshot()['version'], get_active_merchant()]
+    fingerprint = hashlib.sha1(compact_json([scope, kwargs]).encode('utf-8')).hexdigest()
+    with _llm_inflight_lock:
+        flight = _llm_inflight.get(fingerprint)
+        leader = flight is None
+        if leader:
+            flight = _llm_inflight[fingerprint] = {'done': threading.Event(), 'response': None, 'error': None}
+    if not leader:
+        increment_counter('llm_calls_total', outcome='coalesced')
+        flight['done'].wait()
+        if flight['error'] is not None:
+            raise flight['error']
+        return flight['response']
+
+    try:
+        response = flight['response'] = call_openai_with_retries(kwargs)
+    except Exception as e:
+        flight['error'] = e
+        raise
+    finally:
+        with _llm_inflight_lock:
+            del _llm_inflight[fingerprint]
+        flight['done'].set()
+
+    usage = getattr(response, 'usage', None)
+    if usage is not None:
+        increment_counter('llm_tokens_total', usage.prompt_tokens, kind='prompt')
+        increment_counter('llm_tokens_total', usage.completion_tokens, kind='completion')
+        cached_tokens = getattr(getattr(usage, 'prompt_tokens_details', None), 'cached_tokens', None)
+        if cached_tokens:
+            increment_counter('llm_tokens_total', cached_tokens, kind='cached_prompt')
+    return response
+
+def backend_only_response(query, e):
+    # Deterministic answer from the loaded data when the AI is unavailable; upstream errors are logged, not shown
+    logger.warning(f"OpenAI call failed, answering from the data only: {e}")
+    trace_event('llm_fallback', error=str(e))
+    transactions_df = get_scoped_frame('transactions')
+    refunds_count, refunds_amount_paise = get_refunds_yesterday()
+    answer = ("The AI assistant is temporarily unavailable, so here are the latest figures from your data:<br>"
+              f"- Successful payments today: **{format_rupees(get_total_amount_received(datetime.date.today()))}**<br>"
+              f"- Completed refunds yesterday: **{refunds_count}** ({format_rupees(refunds_amount_paise)})<br>")
+    if not transactions_df.empty:
+        answer += f"- Overall payment success rate: **{(transactions_df['status'] == 'Success').mean() * 100:.2f}%**<br>"
+    answer += ("Questions about refunds, payment methods, success rate, settlements, support tickets or intraday peaks "
+               "are answered directly from your data. Try asking one of those.")
+    return compact_json({"question": query, "answer": answer, "chartData": {}})
+
+def get_ai_response(query, context_items):
     messages = [
-        {"role": "system", "content": f"""You are an intelligent payment insights assistant for online merchants.
-        Your goal is to provide concise, actionable, and data-backed answers and insights based on the provided payment data.
-        If the user's query is about a specific metric, provide the direct answer.
-        If the query is about trends, comparisons, or root causes, use the provided data to explain "why" or "how".
-        Always try to format numerical values clearly (e.g., ₹1,234.56, 15%).
-        If chart data is returned, clearly state what the chart represents in the answer.
-        If you cannot fulfill a request, politely state so and, if relevant, mention the date range of available data: {data_range_info}.
-        Be proactive in suggesting additional insights when relevant.
-        You have access to the following data and functions to answer user queries:
-        - `get_total_amount_received(date_obj)`: Get total successful amount for a date (e.g., datetime.date(2024, 5, 31)).
-        - `get_refunds_yesterday()`: Get count and total amount of refunds for yesterday.
-        - `get_payment_method_performance(period)`: Get performance by payment method ('week' or 'month'). This function returns a list of dictionaries, each with 'payment_method', 'total_amount', and 'num_transactions'.
-        - `analyze_refund_spike_root_cause(date_obj)`: Analyzes why refunds spiked on a given date (defaults to yesterday).
-        - `analyze_payment_method_trend(method, period)`: Analyzes trend for a specific payment method (e.g., 'Mobile', 'UPI', 'Credit Card') over 'week' or 'month'.
-        - `analyze_customer_payment_behavior(payment_method)`: Analyzes repeat rates and AOV for customers using a specific payment method.
-        - `generate_emi_recommendation(min_order_value)`: Provides a recommendation on enabling EMI.
-        - `predict_weekend_transactions()`: Predicts transaction volume for the upcoming weekend.
-        - `get_success_rate_and_benchmark()`: Provides overall payment success rate and industry benchmark comparison.
-        - `analyze_transaction_volume_deviation(period)`: Analyzes daily transaction volume deviation.
-
-        **Output Format:**
-        Always return a JSON object with the following structure:
-        {{
-            "question": "The original question asked by the merchant.",
-            "answer": "The insightful answer, can contain HTML line breaks <br>.",
-            "chartData": {{
-                "labels": ["Label1", "Label2"],
-                "data": [100, 200],
-                "type": "line" | "bar" | "pie" (optional, only if relevant, default 'line')
-            }}
-        }}
-        If no chart is applicable, "chartData" can be an empty object {{}}.
-        """},
-        {"role": "user", "content": f"My query: {query}\n\nRelevant data provided by backend:\n{context_str}"}
+        {"role": "system", "content": AI_SYSTEM_PROMPT},
+        {"role": "user", "content": build_ai_user_message(query, context_items)}
     ]
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
+        response = create_chat_completion(
             messages=messages,
             response_format={"type": "json_object"},
             temperature=0.7
         )
-        ai_output = response.choices[0].message.content
-        return ai_output
+        return response.choices[0].message.content
     except Exception as e:
-        print(f"Error calling OpenAI API: {e}")
-        return json.dumps({"question": query, "answer": f"I'm sorry, I couldn't process that request due to an internal error with the AI. Please try again or rephrase. Error: {e}", "chartData": {}})
+        return backend_only_response(query, e)
+
+def get_ai_tool_response(query):
+    # Tool-calling loop: the model asks for helpers, we run the valid calls and send results back,
+    # for at most LLM_MAX_TOOL_ROUNDS rounds. Returns (response JSON string, charts produced by tools).
+    messages = [
+        {"role": "system", "content": AI_SYSTEM_PROMPT},
+        {"role": "user", "content": build_ai_user_message(query, reserved_tokens=tool_specs_tokens())}
+    ]
+    charts = []
+    tool_results = {} # (name, raw arguments) -> result, so a repeated call does not recompute
+    try:
+        for round_number in range(LLM_MAX_TOOL_ROUNDS + 1):
+            final_round = round_number == LLM_MAX_TOOL_ROUNDS
+            fit_tool_results_to_budget(messages)
+            response = create_chat_completion(
+                messages=messages,
+                tools=LLM_TOOL_SPECS,
+                tool_choice="none" if final_round else "auto",
+                response_format={"type": "json_object"},
+                temperature=0.7
+            )
+            message = response.choices[0].message
+            if not message.tool_calls or final_round:
+                return message.content or '', charts
+
+            calls = message.tool_calls[:LLM_MAX_TOOL_CALLS_PER_ROUND]
+            messages.append({
+                "role": "assistant",
+                "content": message.content,
+                "tool_calls": [
+                    {"id": call.id, "type": "function", "function": {"name": call.function.name, "arguments": call.function.arguments}}
+                    for call in calls
+                ]
+            })
+            for call in calls:
+                key = (call.function.name, call.function.arguments)
+                if key not in tool_results:
+                    with trace_span('llm.tool', tool=call.function.name):
+                        tool_results[key] = run_llm_tool(call.function.name, call.function.arguments, charts)
+                messages.append({"role": "tool", "tool_call_id": call.id, "content": tool_results[key]})
+    except Exception as e:
+        return backend_only_response(query, e), charts
+
+
+# --- Alert Scheduler Jobs ---
+def refresh_alerts(merchant=None):
+    # Returns the cache entry for a merchant scope, recomputing it only if the data or the day changed
+    key = (data_snapshot['version'], datetime.date.today())
+    entry = alert_cache.get(merchant)
+    record_cache_lookup('alerts', entry is not None and entry['key'] == key)
+    if entry is not None and entry['key'] == key:
+        return entry
+    with _alert_refresh_lock: # Concurrent callers wait for one evaluation instead of repeating it
+        snapshot = data_snapshot
+        key = (snapshot['version'], datetime.date.today())
+        entry = alert_cache.get(merchant)
+        if entry is not None and entry['key'] == key:
+            return entry
+        with snapshot_scope(snapshot), merchant_scope(merchant), timed_block('helper_duration_seconds', helper='compute_alerts'):
+            alerts = compute_alerts()
+        with _alerts_changed:
+            changed = entry is None or entry['alerts'] != alerts
+            entry = {'key': key, 'seq': (entry['seq'] if entry else 0) + (1 if changed else 0), 'alerts': alerts}
+            alert_cache[merchant] = entry
+            if changed:
+                _alerts_changed.notify_all()
+    return entry
+
+def run_alert_scheduler():
+    while True:
+        _alerts_wakeup.wait(ALERT_REFRESH_SECONDS)
+        _alerts_wakeup.clear()
+        if not data_ready.is_set():
+            continue
+        known_merchants = data_snapshot['merchant_partitions']
+        for merchant in [None] + [m for m in list(alert_cache) if m is not None]:
+            if merchant is not None and merchant not in known_merchants:
+                alert_cache.pop(merchant, None) # Merchant vanished in a reload
+                continue
+            try:
+                refresh_alerts(merchant)
+            except Exception as e:
+                logger.exception(f"Alert refresh failed for {merchant or 'all merchants'}: {e}")
+
+def start_alert_scheduler():
+    global _alert_scheduler_started
+    with _alert_scheduler_lock:
+        if _alert_scheduler_started:
+            return
+        _alert_scheduler_started = True
+    threading.Thread(target=run_alert_scheduler, name='alert-scheduler', daemon=True).start()
+
+def stream_alert_events(merchant):
+    # Server-sent events: the current alerts first, then each change; a comment line keeps idle connections open
+    last_seq = None
+    has_update = lambda: merchant in alert_cache and alert_cache[merchant]['seq'] != last_seq
+    while True:
+        with _alerts_changed:
+            _alerts_changed.wait_for(has_update, timeout=ALERT_STREAM_HEARTBEAT_SECONDS)
+            entry = alert_cache.get(merchant)
+        if entry is None or entry['seq'] == last_seq:
+            yield ": keep-alive\n\n"
+            continue
+        last_seq = entry['seq']
+        yield f"id: {last_seq}\nevent: alerts\ndata: {json.dumps(entry['alerts'])}\n\n"
+
+
+# --- Admission Control ---
+def acquire_admission(request_class, client):
+    # True once the request holds a slot of its class; False if it should be rejected with 429
+    limits = ADMISSION_LIMITS[request_class]
+    state = _admission_state[request_class]
+    with _admission_lock:
+        if state['active'] < limits['concurrency'] and state['queued'] == 0:
+            state['active'] += 1
+            increment_counter('admission_decisions_total', request_class=request_class, outcome='admitted')
+            return True
+        client_queue = state['clients'].get(client)
+        if state['queued'] >= limits['queue'] or (client_queue and len(client_queue) >= ADMISSION_MAX_QUEUED_PER_CLIENT):
+            increment_counter('admission_decisions_total', request_class=request_class, outcome='rejected')
+            return False
+        waiter = {'granted': False, 'event': threading.Event()}
+        state['clients'].setdefault(client, deque()).append(waiter)
+        state['queued'] += 1
+
+    waited_from = time.perf_counter()
+    waiter['event'].wait(limits['max_wait_seconds'])
+    with _admission_lock:
+        observe_latency('admission_wait_seconds', time.perf_counter() - waited_from, request_class=request_class)
+        if waiter['granted']: # Also covers a grant that raced the timeout
+            increment_counter('admission_decisions_total', request_class=request_class, outcome='queued')
+            return True
+        client_queue = state['clients'][client]
+        client_queue.remove(waiter)
+        if not client_queue:
+            del state['clients'][client]
+        state['queued'] -= 1
+        increment_counter('admission_decisions_total', request_class=request_class, outcome='rejected')
+        return False
+
+def release_admission(request_class):
+    # Hands the slot straight to the next queued client (round-robin), or frees it
+    state = _admission_state[request_class]
+    with _admission_lock:
+        if not state['queued']:
+            state['active'] -= 1
+            return
+        client = next(iter(state['clients']))
+        client_queue = state['clients'].pop(client)
+        waiter = client_queue.popleft()
+        if client_queue:
+            state['clients'][client] = client_queue # Re-inserted last: this client goes to the back of the rotation
+        state['queued'] -= 1
+        waiter['granted'] = True
+        waiter['event'].set()
+
+def admission_client_id():
+    return request.headers.get(ADMISSION_CLIENT_HEADER) or request.remote_addr or 'unknown'
+
+def overloaded_response(request_class):
+    response = jsonify({
+        "status": "overloaded",
+        "error": "The server is busy with other requests. Please retry shortly."
+    })
+    response.headers['Retry-After'] = str(ADMISSION_LIMITS[request_class]['retry_after'])
+    return response, 429
+
+def admit_request_as(request_class):
+    # Moves the current request to another class (e.g. an /ask query that needs the LLM). The old slot
+    # is released first so a request waiting for an LLM slot never blocks cheap requests.
+    # Returns None when admitted, else the 429 response to send.
+    current_class = g.pop('admission_class', None)
+    if current_class is not None:
+        release_admission(current_class)
+    if not acquire_admission(request_class, admission_client_id()):
+        return overloaded_response(request_class)
+    g.admission_class = request_class
+    return None
+
+def release_request_admission():
+    request_class = g.pop('admission_class', None)
+    if request_class is not None:
+        release_admission(request_class)
 
 
 # --- Flask Routes ---
 
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.trace = new_trace(
+        trace_id=request.headers.get(TRACE_ID_HEADER),
+        sampled=True if TRACE_TRUST_SAMPLED_HEADER and request.headers.get(TRACE_SAMPLED_HEADER) == '1' else None
+    )
+    if g.trace['sampled']:
+        g.trace['span_stack'].append(uuid.uuid4().hex[:16]) # Root span id; its record is written in after_request
+        g.trace_started_at = time.time()
+
+@app.after_request
+def attach_request_profile(response):
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        response.headers['X-Profile-Id'] = save_request_profile(profiler, request.endpoint or 'unknown')
+    return response
+
+@app.after_request
+def record_request_latency(response):
+    if 'request_started' in g and request.endpoint != 'metrics':
+        observe_latency('http_request_duration_seconds', time.perf_counter() - g.request_started,
+                        route=request.url_rule.rule if request.url_rule else 'unmatched',
+                        intent=g.get('intent', ''), status=str(response.status_code))
+    return response
+
+@app.after_request
+def finish_request_trace(response):
+    trace = g.get('trace')
+    if trace is None:
+        return response
+    response.headers[TRACE_ID_HEADER] = trace['trace_id']
+    if trace['sampled'] and trace['span_stack']:
+        emit_trace_record({
+            'type': 'span', 'trace_id': trace['trace_id'], 'span_id': trace['span_stack'][0], 'parent_id': None,
+            'name': f"{request.method} {request.url_rule.rule if request.url_rule else request.path}",
+            'start': g.trace_started_at, 'duration_ms': round((time.perf_counter() - g.request_started) * 1000, 3),
+            'intent': g.get('intent'), 'merchant': g.get('merchant'), 'status': response.status_code
+        })
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    return jsonify({"status": "ok"})
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    if data_ready.is_set():
+        return jsonify({"status": "ready"})
+    if data_load_error and not _data_load_running:
+        return jsonify({"status": "load_failed", "error": data_load_error, "retry_in_seconds": data_load_retry_after()}), 503
+    return jsonify({"status": "warming_up", "error": None}), 503
+
+@app.before_request
+def require_loaded_data():
+    # Every request, probes included, starts (or after a failure, retries) the warm-up
+    start_background_data_load()
+    if data_ready.is_set() or request.endpoint not in DATA_ENDPOINTS:
+        return None
+    if data_load_error and not _data_load_running: # A retry in progress reports as warming up
+        response = jsonify({
+            "status": "load_failed",
+            "error": f"The payment data failed to load: {data_load_error}"
+        })
+        retry_after = data_load_retry_after() or WARMUP_RETRY_AFTER_SECONDS
+    else:
+        response = jsonify({
+            "status": "warming_up",
+            "error": "The payment data is still loading. Please retry in a few seconds."
+        })
+        retry_after = WARMUP_RETRY_AFTER_SECONDS
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 503
+
+@app.before_request
+def pin_data_snapshot():
+    # Every helper call in this request reads the same snapshot, even if a reload publishes mid-request
+    g.snapshot = data_snapshot
+
+@app.before_request
+def resolve_merchant_scope():
+    # Every route runs against the merchant named in the header / query string / JSON body, if any
+    json_body = request.get_json(silent=True) if request.is_json else None
+    merchant = (request.headers.get(MERCHANT_HEADER)
+                or request.args.get('merchant')
+                or (json_body.get('merchant') if isinstance(json_body, dict) else None))
+    if merchant is not None and not isinstance(merchant, str): # A JSON list/object would be unhashable in the lookup below
+        return jsonify({"error": "'merchant' must be a string."}), 400
+    if merchant and merchant not in get_snapshot()['merchant_partitions']:
+        return jsonify({"error": f"Unknown merchant '{merchant}'."}), 404
+    g.merchant = merchant or None
+
+@app.before_request
+def admit_request():
+    request_class = ADMISSION_ENDPOINT_CLASSES.get(request.endpoint)
+    if request_class is None:
+        return None
+    return admit_request_as(request_class)
+
+@app.after_request
+def defer_admission_release(response):
+    # Streamed responses (exports) keep their slot until the server closes the body
+    if response.is_streamed and 'admission_class' in g:
+        response.call_on_close(functools.partial(release_admission, g.pop('admission_class')))
+    return response
+
+@app.teardown_request
+def release_admission_slot(error=None):
+    release_request_admission()
+
 @app.route('/')
 def home():
     return "Merchant Payment Insights Backend is running!"
 
 @app.route('/ask', methods=['POST'])
+@profiled_route
 async def ask_insight():
+    transactions_df = get_scoped_frame('transactions')
+    refunds_df = get_scoped_frame('refunds')
     data = request.get_json()
     query = data.get('query', '').lower()
-    print(f"Received query: {query}")
+    trace_event("Received query", query=query)
+    if isinstance(data.get('max_points'), int) and not isinstance(data['max_points'], bool):
+        g.chart_max_points = min(max(data['max_points'], 3), CHART_MAX_POINTS_LIMIT)
 
     insight_answer = "I'm not sure how to answer that specific question with the available data. Can you try rephrasing?"
     chart_data = {"labels": [], "data": [], "type": "line"}
 
-    date_obj_for_query = None
-    import re
+    # Date / month extraction is the regex-heavy part of routing, so it gets its own span
+    with trace_span('ask.parse_query'):
+        date_obj_for_query = None
     
-    # Updated date parsing logic
-    date_patterns_flexible = [
-        r'(\d{4}-\d{2}-\d{2})', #YYYY-MM-DD
-        r'(\d{1,2}/\d{1,2}/\d{4})', # MM/DD/YYYY or D/M/YYYY
-        r'(\d{1,2}-\d{1,2}-\d{4})'  # DD-MM-YYYY or D-M-YYYY
-    ] 
-
-    for pattern in date_patterns_flexible:
-        date_match = re.search(pattern, query)
-        if date_match:
-            date_str = date_match.group(1)
-            try:
-                # Attempt to parse as datetime, then extract date part
-                potential_date = pd.to_datetime(date_str, errors='coerce')
-                if not pd.isna(potential_date):
-                    date_obj_for_query = potential_date.date()
-                    break
-            except ValueError:
-                pass
+        # Updated date parsing logic
+        date_patterns_flexible = [
+            r'(\d{4}-\d{2}-\d{2})', #YYYY-MM-DD
+            r'(\d{1,2}/\d{1,2}/\d{4})', # MM/DD/YYYY or D/M/YYYY
+            r'(\d{1,2}-\d{1,2}-\d{4})'  # DD-MM-YYYY or D-M-YYYY
+        ] 
+
+        for pattern in date_patterns_flexible:
+            date_match = re.search(pattern, query)
+            if date_match:
+                date_str = date_match.group(1)
+                try:
+                    # Attempt to parse as datetime, then extract date part
+                    potential_date = pd.to_datetime(date_str, errors='coerce')
+                    if not pd.isna(potential_date):
+                        date_obj_for_query = potential_date.date()
+                        break
+                except ValueError:
+                    pass
     
-    # Try month names for queries like "June month"
-    month_query_match = re.search(r'(january|february|march|april|may|june|july|august|september|october|november|december)\s+(month|sales|payments)?\s*(in)?\s*(\d{4})?', query, re.IGNORECASE)
-    if month_query_match:
-        month_name = month_query_match.group(1).capitalize()
-        year = None
-        if month_query_match.group(4):
-            try:
-                year = int(month_query_match.group(4))
-            except ValueError:
-                pass
+        # Try month names for queries like "June month"
+        month_query_match = re.search(r'(january|february|march|april|may|june|july|august|september|october|november|december)\s+(month|sales|payments)?\s*(in)?\s*(\d{4})?', query, re.IGNORECASE)
+        if month_query_match:
+            month_name = month_query_match.group(1).capitalize()
+            year = None
+            if month_query_match.group(4):
+                try:
+                    year = int(month_query_match.group(4))
+                except ValueError:
+                    pass
         
-        # Determine the current or relevant year for the data if not specified
-        if year is None:
-            if not transactions_df.empty and 'transaction_date' in transactions_df.columns and not transactions_df['transaction_date'].isnull().all():
-                year = transactions_df['transaction_date'].max().year
-            else:
-                year = datetime.date.today().year
+            # Determine the current or relevant year for the data if not specified
+            if year is None:
+                if not transactions_df.empty and 'transaction_date' in transactions_df.columns and not transactions_df['transaction_date'].isnull().all():
+                    year = transactions_df['transaction_date'].max().year
+                else:
+                    year = datetime.date.today().year
 
-        month_num = datetime.datetime.strptime(month_name, '%B').month
-        # Set date_obj_for_query to the first day of that month for consistent filtering
-        date_obj_for_query = datetime.date(year, month_num, 1)
+            month_num = datetime.datetime.strptime(month_name, '%B').month
+            # Set date_obj_for_query to the first day of that month for consistent filtering
+            date_obj_for_query = datetime.date(year, month_num, 1)
 
     # --- START of New/Modified Error/Date Handling Logic ---
     # Handle explicit "error" queries for a year
     if "error" in query and "2025" in query:
+        g.intent = 'connection_error_help'
         return jsonify({
             "question": data.get('query'),
             "answer": "The 'Connection error' you are seeing is likely due to the backend's inability to reach the external AI service (OpenAI). This is an environment/network issue, not a problem with your data for 2025. Please ensure your backend has internet access.",
@@ -1201,12 +4259,14 @@ async def ask_insight():
         txn_max_date = transactions_df['transaction_date'].max().date() if not transactions_df.empty and 'transaction_date' in transactions_df.columns and not transactions_df['transaction_date'].isnull().all() else None
 
         if txn_max_date and date_obj_for_query > txn_max_date:
+            g.intent = 'out_of_range'
             return jsonify({
                 "question": data.get('query'),
                 "answer": f"I currently only have transaction data up to {txn_max_date.isoformat()}. I cannot provide insights for {date_obj_for_query.isoformat()} as it's outside the available data range.",
                 "chartData": {}
             })
         if txn_min_date and date_obj_for_query < txn_min_date:
+            g.intent = 'out_of_range'
             return jsonify({
                 "question": data.get('query'),
                 "answer": f"I currently only have transaction data from {txn_min_date.isoformat()}. I cannot provide insights for {date_obj_for_query.isoformat()} as it's before the available data range.",
@@ -1215,7 +4275,94 @@ async def ask_insight():
     # --- END of New/Modified Error/Date Handling Logic ---
 
 
-    if any(keyword in query for keyword in ["how much did i receive", "total sales", "total revenue", "earnings", "transactions"]):
+    if "ticket" in query:
+        g.intent = 'support_tickets'
+        search_match = re.search(r'tickets?\s+(?:about|mentioning|containing|with|for)\s+(.+)', query)
+        if search_match:
+            search_text = search_match.group(1).strip(' ?.')
+            # Multi-word searches from plain English are treated as a phrase
+            search_query = f'"{search_text}"' if ' ' in search_text and '"' not in search_text else search_text
+            tickets, total = search_support_tickets(search_query, limit=5)
+            if total:
+                examples = "<br>".join(f"- {row.ticket_created_time.date().isoformat()}: {row.subject}" for row in tickets.itertuples())
+                insight_answer = f"Found **{total:,}** support tickets matching **{search_text}**. Most recent:<br>{examples}"
+            else:
+                insight_answer = f"No support tickets mention **{search_text}**."
+        else:
+            trending = get_trending_ticket_terms()
+            if trending:
+                trend_lines = "<br>".join(
+                    f"- **{t['term']}**: {t['recent_tickets']} tickets in the last 30 days (previous 30 days: {t['previous_tickets']})"
+                    for t in trending
+                )
+                insight_answer = f"These failure reasons and topics are trending in your support tickets:<br>{trend_lines}"
+                chart_data = {"labels": [t['term'] for t in trending], "data": [t['recent_tickets'] for t in trending], "type": "bar"}
+            else:
+                insight_answer = "There are not enough recent support tickets to identify trending issues."
+
+    elif (any(keyword in query for keyword in ["success rate", "failure rate"])
+          and (parse_success_rate_filters(query) or any(keyword in query for keyword in ["segment", "drill", "where", "which"]))):
+        g.intent = 'success_rate_segments'
+        segment_analysis = analyze_success_rate_segments(**parse_success_rate_filters(query))
+        insight_answer = segment_analysis["answer"]
+        chart_data = segment_analysis["chartData"]
+
+    elif "refund" in query and any(keyword in query for keyword in ["hourly", "per hour", "by hour", "15 min", "15-min", "intraday"]):
+        g.intent = 'intraday'
+        # refund_date has no time of day, so refunds are only bucketed per day
+        insight_answer = "Refunds are only recorded per day, without a time of day, so there is no hourly breakdown. Ask for daily refunds instead."
+
+    elif any(keyword in query for keyword in ["hourly", "per hour", "by hour", "15 min", "15-min", "intraday", "peak"]):
+        g.intent = 'intraday'
+        # Intraday questions are answered straight from the time-bucket index
+        target_date_obj = date_obj_for_query or datetime.date.today()
+        if "yesterday" in query:
+            target_date_obj = datetime.date.today() - datetime.timedelta(days=1)
+        resolution = '15min' if ("15 min" in query or "15-min" in query) else 'hour'
+        source = 'refunds' if "refund" in query else 'transactions'
+
+        if "fail" in query:
+            status_filter = 'Failed'
+        elif "pending" in query:
+            status_filter = 'Pending'
+        else:
+            status_filter = 'Completed' if source == 'refunds' else 'Success'
+
+        method_keyword = None
+        for keyword, method in [("mobile", "Mobile"), ("upi", "UPI"), ("credit card", "Credit Card"), ("debit card", "Debit Card"), ("net banking", "Net Banking"), ("wallet", "Wallet")]:
+            if keyword in query:
+                method_keyword = method
+                break
+
+        metric = 'amount_paise' if any(keyword in query for keyword in ["amount", "revenue", "sales", "value"]) else 'count'
+        status_label = {'Success': 'successful', 'Failed': 'failed', 'Pending': 'pending', 'Completed': 'completed'}[status_filter]
+        label = f"{(method_keyword + ' ') if method_keyword else ''}{status_label} {source}"
+        bucket_label = "15-minute" if resolution == '15min' else "hourly"
+
+        chart_data = get_intraday_series(source, target_date_obj, resolution, method_keyword, status_filter, metric)
+        if not chart_data["labels"]:
+            insight_answer = f"No {label} recorded on **{target_date_obj.isoformat()}** to break down by time of day."
+        elif "peak" in query:
+            peak = get_intraday_peak(source, target_date_obj, resolution, method_keyword, status_filter)
+            insight_answer = (f"On **{target_date_obj.isoformat()}**, {label} peaked at **{peak['bucket'].strftime('%H:%M')}** "
+                              f"with **{peak['count']:,}** of the day's {peak['total_count']:,}. "
+                              f"The chart shows the {bucket_label} breakdown.")
+        else:
+            if metric == 'amount_paise':
+                total_str = format_rupees(query_time_bucket_index(source, target_date_obj, resolution, method_keyword, status_filter)['amount_paise'].sum())
+            else:
+                total_str = f"{int(sum(chart_data['data'])):,}"
+            insight_answer = (f"Here is the {bucket_label} breakdown of {label} on **{target_date_obj.isoformat()}** "
+                              f"(total: **{total_str}**).")
+
+    elif any(keyword in query for keyword in ["settlement", "reconcil", "fee rate", "mdr", "short paid", "short-paid"]):
+        g.intent = 'settlements'
+        reconciliation = summarize_settlement_reconciliation()
+        insight_answer = reconciliation["answer"]
+        chart_data = reconciliation["chartData"]
+
+    elif any(keyword in query for keyword in ["how much did i receive", "total sales", "total revenue", "earnings", "transactions"]):
+        g.intent = 'revenue'
         target_date_obj = None
         if "yesterday" in query:
             target_date_obj = datetime.date.today() - datetime.timedelta(days=1)
@@ -1234,33 +4381,37 @@ async def ask_insight():
                 else:
                     end_of_month = target_date_obj.replace(month=target_date_obj.month + 1, day=1) - datetime.timedelta(days=1)
 
-                # Ensure transaction_date is of datetime.date type for filtering
                 if not transactions_df.empty and 'transaction_date' in transactions_df.columns:
-                    if not pd.api.types.is_datetime64_any_dtype(transactions_df['transaction_date']):
-                        transactions_df['transaction_date'] = pd.to_datetime(transactions_df['transaction_date'], errors='coerce').dt.normalize()
-                    
                     monthly_transactions = transactions_df[
                         (transactions_df['transaction_date'].dt.date >= start_of_month) &
                         (transactions_df['transaction_date'].dt.date <= end_of_month) &
                         (transactions_df['status'] == 'Success')
                     ]
-                    amount = monthly_transactions['amount'].sum() if not monthly_transactions.empty else 0.0
-                    if amount > 0:
-                        insight_answer = f"For **{target_date_obj.strftime('%B %Y')}**, you received a total of **₹{amount:,.2f}** in successful payments."
+                    amount_paise = monthly_transactions['amount_paise'].sum()
+                    if amount_paise > 0:
+                        insight_answer = f"For **{target_date_obj.strftime('%B %Y')}**, you received a total of **{format_rupees(amount_paise)}** in successful payments."
                     else:
                         insight_answer = f"No successful payments recorded for **{target_date_obj.strftime('%B %Y')}**. This could be due to no activity or data not yet updated for this period. Please check the available data range: {transactions_df['transaction_date'].min().date().isoformat()} to {transactions_df['transaction_date'].max().date().isoformat()}."
                 else:
                     insight_answer = f"Transaction data not available to analyze for {target_date_obj.strftime('%B %Y')}."
             else: # Daily query
-                amount = get_total_amount_received(target_date_obj)
-                if amount > 0:
-                    insight_answer = f"You received a total of **₹{amount:,.2f}** in successful payments on **{target_date_obj.isoformat()}**."
+                amount_paise = get_total_amount_received(target_date_obj)
+                if amount_paise > 0:
+                    insight_answer = f"You received a total of **{format_rupees(amount_paise)}** in successful payments on **{target_date_obj.isoformat()}**."
                 else:
                     insight_answer = f"No successful payments recorded for **{target_date_obj.isoformat()}**. This could be due to no activity or data not yet updated for this period. Please check the available data range: {transactions_df['transaction_date'].min().date().isoformat()} to {transactions_df['transaction_date'].max().date().isoformat()}."
         else:
             insight_answer = "Please specify a date or month (e.g., 'yesterday', 'today', 'on 2024-05-31', 'January 2025 sales') for the total amount."
 
+    elif any(keyword in query for keyword in ["worst refund days", "refund spike days", "refund spikes", "biggest refund days", "highest refund days", "when did refunds spike"]):
+        g.intent = 'refund_spike_scan'
+        spike_period = next((period for period in ('week', 'month', 'quarter', 'year') if period in query), None)
+        spike_summary = summarize_refund_spikes(spike_period)
+        insight_answer = spike_summary["answer"]
+        chart_data = spike_summary["chartData"]
+
     elif any(keyword in query for keyword in ["refunds spike", "why refunds increased", "refund issue", "root cause refund"]):
+        g.intent = 'refund_root_cause'
         target_date_for_rca = date_obj_for_query or (datetime.date.today() - datetime.timedelta(days=1))
         insight_answer = analyze_refund_spike_root_cause(target_date_for_rca)
         if "No significant completed refund activity" in insight_answer:
@@ -1269,9 +4420,14 @@ async def ask_insight():
             insight_answer += f" Current refund data available from {refund_min_date} to {refund_max_date}."
 
     elif any(keyword in query for keyword in ["payment method performing best", "best payment method", "payment method trend", "mobile payments", "upi payments", "credit card payments", "debit card payments", "net banking payments", "wallet payments"]):
+        g.intent = 'payment_methods'
         period = 'week'
         if "month" in query:
             period = 'month'
+        elif "quarter" in query:
+            period = 'quarter'
+        elif "year" in query:
+            period = 'year'
 
         method_keyword = None
         if "mobile payments" in query or "mobile" in query:
@@ -1296,11 +4452,11 @@ async def ask_insight():
             if performance_data:
                 top_method = performance_data[0]
                 insight_answer = (f"The best performing payment method this {period} by total amount is **{top_method['payment_method']}** "
-                                  f"with **₹{top_method['total_amount']:,.2f}** from **{top_method['num_transactions']} transactions**. "
-                                  f"Average transaction value for {top_method['payment_method']} is ₹{top_method['avg_transaction_value']:,.2f}.")
+                                  f"with **{format_rupees(top_method['total_amount_paise'])}** from **{top_method['num_transactions']} transactions**. "
+                                  f"Average transaction value for {top_method['payment_method']} is {format_rupees(top_method['avg_transaction_value_paise'])}.")
                 chart_data = {
                     "labels": [p['payment_method'] for p in performance_data],
-                    "data": [p['total_amount'] for p in performance_data],
+                    "data": [paise_to_rupees(p['total_amount_paise']) for p in performance_data],
                     "type": "bar"
                 }
             else:
@@ -1309,12 +4465,26 @@ async def ask_insight():
                 insight_answer = f"No payment method data available for the last {period}. Please check the available data range: {txn_min_date} to {txn_max_date}."
 
     elif any(keyword in query for keyword in ["customer behavior", "repeat rates", "upi customer", "credit card customer"]):
+        g.intent = 'customer_behavior'
         payment_method_for_customer_behavior = 'UPI'
         if "credit card" in query:
             payment_method_for_customer_behavior = "Credit Card"
         insight_answer = analyze_customer_payment_behavior(payment_method_for_customer_behavior)
 
+    elif any(keyword in query for keyword in ["cohort", "retention", "repeat purchase", "churn"]):
+        g.intent = 'customer_cohorts'
+        if "revenue" in query or "ltv" in query or "lifetime value" in query:
+            cohort_metric = 'revenue'
+        elif "repeat" in query or "second purchase" in query:
+            cohort_metric = 'repeat'
+        else:
+            cohort_metric = 'retention'
+        cohort_analysis = analyze_customer_cohorts(cohort_metric)
+        insight_answer = cohort_analysis["answer"]
+        chart_data = cohort_analysis["chartData"]
+
     elif any(keyword in query for keyword in ["enable emi", "emi for orders", "boost conversions", "flexible payments"]):
+        g.intent = 'emi_recommendation'
         min_value = 5000
         amount_match = re.search(r'₹(\d+)', query) or re.search(r'above (\d+)', query)
         if amount_match:
@@ -1325,12 +4495,15 @@ async def ask_insight():
         insight_answer = generate_emi_recommendation(min_value)
 
     elif any(keyword in query for keyword in ["expect more transactions this weekend", "weekend prediction", "sales forecast weekend"]):
+        g.intent = 'weekend_forecast'
         insight_answer = predict_weekend_transactions()
 
     elif any(keyword in query for keyword in ["success rate", "industry average", "benchmarking"]):
+        g.intent = 'success_rate'
         insight_answer = get_success_rate_and_benchmark()
 
     elif any(keyword in query for keyword in ["transaction volume today", "sales dip today", "sales surge today"]):
+        g.intent = 'volume_deviation'
         deviation_insight = analyze_transaction_volume_deviation('day')
         if deviation_insight:
             insight_answer = deviation_insight['description']
@@ -1339,19 +4512,34 @@ async def ask_insight():
 
 
     if insight_answer.startswith("I'm not sure"):
-        context_data = {
-            "Total successful payments today": f"₹{get_total_amount_received(datetime.date.today()):,.2f}",
-            "Refunds yesterday (count, amount)": f"{get_refunds_yesterday()[0]} refunds, ₹{get_refunds_yesterday()[1]:,.2f} total",
-            "Payment method performance (last week)": get_payment_method_performance('week'),
-            "Overall success rate": get_success_rate_and_benchmark()
-        }
-        ai_response_json_str = get_ai_response(query, context_data)
+        g.intent = 'llm_fallback'
+        rejected = admit_request_as('llm')
+        if rejected is not None:
+            return rejected
+        if LLM_TOOL_CALLING:
+            ai_response_json_str, tool_charts = get_ai_tool_response(query)
+        else:
+            refunds_count, refunds_amount_paise = get_refunds_yesterday()
+            context_items = [ # Highest priority first; the tail is cut when over the token budget
+                ("Total successful payments today", format_rupees(get_total_amount_received(datetime.date.today()))),
+                ("Refunds yesterday (count, amount)", f"{refunds_count} refunds, {format_rupees(refunds_amount_paise)} total"),
+                ("Overall success rate", get_success_rate_and_benchmark()),
+                ("Payment method performance (last week)", [
+                    {'payment_method': p['payment_method'], 'total_amount': paise_to_rupees(p['total_amount_paise']), 'num_transactions': p['num_transactions']}
+                    for p in get_payment_method_performance('week')
+                ])
+            ]
+            ai_response_json_str = get_ai_response(query, context_items)
+            tool_charts = []
         try:
             ai_response = json.loads(ai_response_json_str)
             insight_answer = ai_response.get("answer", insight_answer)
             chart_data = ai_response.get("chartData", chart_data)
+            if tool_charts and not (isinstance(chart_data, dict) and chart_data.get('data')):
+                chart_data = tool_charts[-1] # The model described a tool's chart without repeating its points
         except json.JSONDecodeError:
-            print(f"Failed to decode AI response JSON from OpenAI: {ai_response_json_str}")
+            logger.warning("Could not decode the AI response as JSON.")
+            trace_event('llm_response_unreadable', response=ai_response_json_str)
             insight_answer = "I received an unreadable response from the AI. Please try again."
 
     return jsonify({
@@ -1360,24 +4548,149 @@ async def ask_insight():
         "chartData": chart_data
     })
 
+@app.route('/tickets/search', methods=['GET'])
+@profiled_route
+def search_tickets():
+    tickets, total = search_support_tickets(
+        request.args.get('q', ''),
+        start_date=request.args.get('from'),
+        end_date=request.args.get('to'),
+        limit=request.args.get('limit', 50, type=int)
+    )
+    return jsonify({
+        "total": total,
+        "tickets": [
+            {
+                "case_number": str(row.case_number) if pd.notna(row.case_number) else None,
+                "ticket_created_time": row.ticket_created_time.isoformat(),
+                "category": row.category if isinstance(row.category, str) else None,
+                "subject": row.subject if isinstance(row.subject, str) else None
+            }
+            for row in tickets.itertuples()
+        ]
+    })
+
+@app.route('/tickets', methods=['POST'])
+def add_tickets():
+    new_tickets = request.get_json(silent=True)
+    try:
+        validate_new_tickets(new_tickets)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    added, total = append_support_tickets(pd.DataFrame(new_tickets))
+    return jsonify({"added": added, "total": total})
+
+@app.route('/api/timeseries', methods=['GET'])
+def api_timeseries():
+    # e.g. /api/timeseries?metric=amount&granularity=week&group_by=method&from=2025-01-01&to=2025-03-31
+    etag = timeseries_etag(request.args.to_dict())
+    if request.if_none_match: # Only revalidations are lookups: a hit is a 304
+        record_cache_lookup('timeseries_etag', request.if_none_match.contains(etag))
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        metric = request.args.get('metric', 'transactions')
+        granularity = request.args.get('granularity', 'day')
+        try:
+            table, start, end = get_timeseries(
+                metric,
+                start_date=request.args.get('from'),
+                end_date=request.args.get('to'),
+                granularity=granularity,
+                group_by=request.args.get('group_by'),
+                method_keyword=request.args.get('method'),
+                status=request.args.get('status')
+            )
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        response = jsonify(timeseries_payload(table, metric, granularity, start, end))
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/api/cohorts', methods=['GET'])
+def api_cohorts():
+    # e.g. /api/cohorts?metric=retention (percent active), repeat (cumulative percent repeat), revenue (rupees)
+    try:
+        return jsonify(cohort_matrix(request.args.get('metric', 'retention')))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+@app.route('/api/success-rate', methods=['GET'])
+def api_success_rate():
+    # e.g. /api/success-rate?method=Credit Card&from_hour=14&to_hour=16&city=Mumbai (every filter optional;
+    # ?merchant= scopes to one merchant as on every data route)
+    try:
+        return jsonify(success_rate_drilldown(
+            method_keyword=request.args.get('method'),
+            start_hour=request.args.get('from_hour', type=int),
+            end_hour=request.args.get('to_hour', type=int),
+            city=request.args.get('city')
+        ))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+@app.route('/export/<dataset>', methods=['GET'])
+def export_rows(dataset):
+    # e.g. /export/settlements?from=2025-01-01&to=2025-01-31&merchant=Acme&format=arrow
+    if dataset not in EXPORT_DATE_COLUMNS:
+        return jsonify({"error": f"Unknown dataset '{dataset}'. Choose one of: {', '.join(EXPORT_DATE_COLUMNS)}."}), 404
+    export_format = request.args.get('format', 'csv').lower()
+    if export_format not in EXPORT_MIMETYPES:
+        return jsonify({"error": "format must be 'csv' or 'arrow'."}), 400
+    if export_format == 'arrow' and importlib.util.find_spec('pyarrow') is None:
+        return jsonify({"error": "Arrow export needs the pyarrow package installed on the server."}), 501
+
+    frame = get_scoped_frame(dataset)
+    try:
+        chunk_mask = export_row_filter(
+            dataset, frame,
+            start_date=request.args.get('from'),
+            end_date=request.args.get('to'),
+            method_keyword=request.args.get('method'),
+            status=request.args.get('status')
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    stream = stream_export_arrow(frame, chunk_mask) if export_format == 'arrow' else stream_export_csv(frame, chunk_mask)
+    extension = 'arrows' if export_format == 'arrow' else 'csv'
+    return Response(stream, mimetype=EXPORT_MIMETYPES[export_format],
+                    headers={'Content-Disposition': f'attachment; filename="{dataset}.{extension}"'})
+
 @app.route('/alerts', methods=['GET'])
+@profiled_route
 def get_alerts():
+    # Served from the alert cache; only the first request after a data change pays for evaluation
+    start_alert_scheduler()
+    return jsonify(refresh_alerts(get_active_merchant())['alerts'])
+
+@app.route('/alerts/stream', methods=['GET'])
+def stream_alerts():
+    # EventSource can't set headers, so dashboards pick a merchant with ?merchant=
+    start_alert_scheduler()
+    merchant = get_active_merchant()
+    refresh_alerts(merchant)
+    return Response(stream_alert_events(merchant), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def compute_alerts():
+    # Evaluates every alert rule for the active snapshot and merchant scope
     alerts = []
 
     yesterday = datetime.date.today() - datetime.timedelta(days=1)
-    refunds_yesterday_count, refunds_yesterday_amount = get_refunds_yesterday()
-    if refunds_yesterday_count > 50 and refunds_yesterday_amount > 15000:
+    refunds_yesterday_count, refunds_yesterday_amount_paise = get_refunds_yesterday()
+    if refunds_yesterday_count > 50 and refunds_yesterday_amount_paise > rupees_to_paise(15000):
         root_cause_msg = analyze_refund_spike_root_cause(yesterday)
         alerts.append({
             "type": "alert",
             "title": "High Refund Activity Detected!",
-            "description": (f"Your refunds spiked to **{refunds_yesterday_count}** yesterday, totaling **₹{refunds_yesterday_amount:,.2f}**. "
+            "description": (f"Your refunds spiked to **{refunds_yesterday_count}** yesterday, totaling **{format_rupees(refunds_yesterday_amount_paise)}**. "
                             f"{root_cause_msg.split('Consider reviewing customer feedback')[0].replace('The completed refund spike on', 'It was primarily caused by')}. "
                             "Immediate action might be required. Review your payment gateway logs.")
         })
 
     mobile_trend = analyze_payment_method_trend('Mobile', 'week')
-    import re
     match_drop = re.search(r'dropped by (\d+\.\d{2})%', mobile_trend['answer'])
     if match_drop:
         drop_percentage = float(match_drop.group(1))
@@ -1431,6 +4744,8 @@ def get_alerts():
     if volume_deviation_alert:
         alerts.append(volume_deviation_alert)
 
+    alerts.extend(get_settlement_alerts())
+
     if not alerts:
         alerts.append({
             "type": "alert",
@@ -1438,15 +4753,12 @@ def get_alerts():
             "description": "Everything looks good! No unusual patterns or specific recommendations at this time."
         })
 
-    return jsonify(alerts)
+    return alerts
 
 
 if __name__ == '__main__':
-    print("Starting Flask backend...")
-    load_data_from_csv() # Load data once when the app starts
-    print(f"\n--- FINAL DATA LOAD SUMMARY ---")
-    print(f"Transactions DF Shape: {transactions_df.shape}")
-    print(f"Refunds DF Shape: {refunds_df.shape}")
-    print(f"Settlements DF Shape: {settlements_df.shape}")
-    print(f"Support Tickets DF Shape: {support_tickets_df.shape}")
+    logger.info("Starting Flask backend...")
+    # With the debug reloader the parent process only watches files; load data in the serving child
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_data_load()
     app.run(debug=True)